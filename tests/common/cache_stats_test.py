@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for cache_stats.py."""
+
+from tests.common import testing
+
+from titan.common.lib.google.apputils import basetest
+from titan.common import cache_stats
+from titan.common import sharded_cache
+
+class CacheStatsTest(testing.BaseTestCase):
+
+  def testRecord(self):
+    self.assertEqual({}, cache_stats.GetRequestLocalStats())
+    cache_stats.Record('foo', hits=1, num_bytes=3)
+    cache_stats.Record('foo', misses=2)
+    cache_stats.Record('bar', evictions=1)
+    expected = {
+        'foo': {'hits': 1, 'misses': 2, 'evictions': 0, 'bytes': 3},
+        'bar': {'hits': 0, 'misses': 0, 'evictions': 1, 'bytes': 0},
+    }
+    self.assertEqual(expected, cache_stats.GetRequestLocalStats())
+
+    # Returned stats are a copy.
+    cache_stats.GetRequestLocalStats()['foo']['hits'] = 100
+    self.assertEqual(expected, cache_stats.GetRequestLocalStats())
+
+    cache_stats.ClearRequestLocalStats()
+    self.assertEqual({}, cache_stats.GetRequestLocalStats())
+
+  def testShardedCacheStats(self):
+    sharded_cache.Set('foo', 'bar')
+    self.assertEqual('bar', sharded_cache.Get('foo'))
+    self.assertIsNone(sharded_cache.Get('missing'))
+    expected = {'hits': 1, 'misses': 1, 'evictions': 0, 'bytes': 3}
+    self.assertEqual(
+        expected,
+        cache_stats.GetRequestLocalStats()[sharded_cache.CACHE_STATS_NAME])
+
+if __name__ == '__main__':
+  basetest.main()
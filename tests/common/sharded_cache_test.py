@@ -16,19 +16,33 @@
 """Tests for sharded_cache.py."""
 
 import cPickle as pickle
+import os
+import zlib
+from mox import stubout
 from google.appengine.api import memcache
 from google.appengine.ext import testbed
 from titan.common.lib.google.apputils import basetest
 from titan.common import sharded_cache
 
 MAX_VALUE_SIZE = memcache.MAX_VALUE_SIZE
+SHARD_CONTENT_SIZE = sharded_cache.SHARD_CONTENT_SIZE
 
 # 1KB -- Should be packed with the shard_map entry and use 0 real shards.
 SMALL_CONTENT = 'a' * 1000
 
-# 2MB -- Will be slightly >2MB when pickled, so should be in 3 shards.
+# 1.5MB -- Stored as-is, so should be in 2 shards.
+MEDIUM_CONTENT = 'b' * (MAX_VALUE_SIZE * 3 / 2)
+
+# 2MB -- Slightly more than 2 shards once stamped with generations, so should be
+# in 3 shards.
 LARGE_CONTENT = 'b' * MAX_VALUE_SIZE * 2
-LARGE_CONTENT_PICKLED = pickle.dumps(LARGE_CONTENT)
+
+# Slightly >2MB when pickled, so should be in 3 shards.
+LARGE_OBJECT = [LARGE_CONTENT]
+LARGE_OBJECT_PICKLED = pickle.dumps(LARGE_OBJECT, pickle.HIGHEST_PROTOCOL)
+
+# 4MB which only compresses to about 2MB.
+SEMI_COMPRESSIBLE_CONTENT = os.urandom(MAX_VALUE_SIZE * 2).encode('hex')
 
 # 40MB -- Larger than the 32 MiB set_multi max.
 LARGEST_CONTENT = 'c' * MAX_VALUE_SIZE * 40
@@ -39,8 +53,10 @@ class ShardedCacheTest(basetest.TestCase):
     self.testbed = testbed.Testbed()
     self.testbed.activate()
     self.testbed.init_memcache_stub()
+    self.stubs = stubout.StubOutForTesting()
 
   def tearDown(self):
+    self.stubs.UnsetAll()
     self.testbed.deactivate()
 
   def testGet(self):
@@ -55,6 +71,39 @@ class ShardedCacheTest(basetest.TestCase):
     self.assertEqual(len(LARGE_CONTENT), len(data))
     self.assertEqual(LARGE_CONTENT, data)
 
+    # Non-byte-string values are pickled.
+    sharded_cache.Set('foo', LARGE_OBJECT)
+    self.assertEqual(LARGE_OBJECT, sharded_cache.Get('foo'))
+    sharded_cache.Set('foo', {'a': u'\xe9'})
+    self.assertEqual({'a': u'\xe9'}, sharded_cache.Get('foo'))
+
+    # Compressed values.
+    sharded_cache.Set('foo', LARGE_CONTENT, compress=True)
+    self.assertEqual(LARGE_CONTENT, sharded_cache.Get('foo'))
+    sharded_cache.Set('foo', SEMI_COMPRESSIBLE_CONTENT, compress=True)
+    self.assertEqual(SEMI_COMPRESSIBLE_CONTENT, sharded_cache.Get('foo'))
+
+    # Shard maps from before formats were recorded hold pickled values.
+    memcache.set(sharded_cache.MEMCACHE_PREFIX + 'foo', {
+        'num_shards': 0, 'content': pickle.dumps(SMALL_CONTENT)})
+    self.assertEqual(SMALL_CONTENT, sharded_cache.Get('foo'))
+
+    # Shards from different Set() calls are never stitched together.
+    sharded_cache.Set('foo', LARGE_CONTENT)
+    old_shard = memcache.get(sharded_cache.MEMCACHE_PREFIX + 'foo1')
+    sharded_cache.Set('foo', 'c' * len(LARGE_CONTENT))
+    memcache.set(sharded_cache.MEMCACHE_PREFIX + 'foo1', old_shard)
+    self.assertEqual(None, sharded_cache.Get('foo'))
+    self.assertEqual(None, memcache.get(sharded_cache.MEMCACHE_PREFIX + 'foo'))
+
+    # Shard maps from before generations were added have unstamped shards.
+    memcache.set_multi({
+        'foo': {'num_shards': 2, 'format': sharded_cache.FORMAT_BYTES},
+        'foo0': LARGE_CONTENT[:MAX_VALUE_SIZE],
+        'foo1': LARGE_CONTENT[MAX_VALUE_SIZE:],
+    }, key_prefix=sharded_cache.MEMCACHE_PREFIX)
+    self.assertEqual(LARGE_CONTENT, sharded_cache.Get('foo'))
+
     # Shard map was evicted.
     sharded_cache.Set('foo', LARGE_CONTENT)
     memcache.delete(sharded_cache.MEMCACHE_PREFIX + 'foo')
@@ -77,35 +126,159 @@ class ShardedCacheTest(basetest.TestCase):
     memcache.delete_multi(memcache_keys)
     self.assertEqual(None, sharded_cache.Get('foo'))
 
+  def testGetMulti(self):
+    get_multi_calls = []
+    original_get_multi = memcache.get_multi
+
+    def CountingGetMulti(keys, *args, **kwargs):
+      get_multi_calls.append(keys)
+      return original_get_multi(keys, *args, **kwargs)
+
+    self.stubs.Set(memcache, 'get_multi', CountingGetMulti)
+    sharded_cache.Set('foo', SMALL_CONTENT)
+    sharded_cache.Set('bar', MEDIUM_CONTENT)
+    sharded_cache.Set('baz', LARGE_CONTENT * 2)
+    expected = {
+        'foo': SMALL_CONTENT,
+        'bar': MEDIUM_CONTENT,
+        'baz': LARGE_CONTENT * 2,
+    }
+
+    # Accurate size hints need only one RPC.
+    sizes = dict([(key, len(value)) for key, value in expected.iteritems()])
+    self.assertEqual(expected, sharded_cache.GetMulti(
+        ['foo', 'bar', 'baz', 'fake'], sizes=sizes))
+    self.assertEqual(1, len(get_multi_calls))
+    self.assertEqual(MEDIUM_CONTENT,
+                     sharded_cache.Get('bar', size=sizes['bar']))
+    self.assertEqual(2, len(get_multi_calls))
+
+    # Without hints, values with more than PREFETCH_SHARDS need a second RPC.
+    del get_multi_calls[:]
+    self.assertEqual(MEDIUM_CONTENT, sharded_cache.Get('bar'))
+    self.assertEqual(1, len(get_multi_calls))
+    self.assertEqual(expected, sharded_cache.GetMulti(['foo', 'bar', 'baz']))
+    self.assertEqual(3, len(get_multi_calls))
+    # Wrong hints only cost an extra RPC.
+    self.assertEqual(MEDIUM_CONTENT, sharded_cache.Get('bar', size=0))
+    self.assertEqual(5, len(get_multi_calls))
+
+    # Values with evicted shards are deleted and not returned.
+    memcache.delete(sharded_cache.MEMCACHE_PREFIX + 'bar1')
+    self.assertEqual({'foo': SMALL_CONTENT, 'baz': LARGE_CONTENT * 2},
+                     sharded_cache.GetMulti(['foo', 'bar', 'baz'], sizes=sizes))
+    self.assertIsNone(memcache.get(sharded_cache.MEMCACHE_PREFIX + 'bar'))
+
+  def testAsync(self):
+    get_multi_calls = []
+    original_get_multi_async = memcache.Client.get_multi_async
+
+    def CountingGetMultiAsync(client, keys, *args, **kwargs):
+      get_multi_calls.append(keys)
+      return original_get_multi_async(client, keys, *args, **kwargs)
+
+    self.stubs.Set(memcache.Client, 'get_multi_async', CountingGetMultiAsync)
+    futures = [
+        sharded_cache.SetAsync('foo', SMALL_CONTENT),
+        sharded_cache.SetAsync('bar', MEDIUM_CONTENT),
+        sharded_cache.SetAsync('baz', LARGE_OBJECT),
+    ]
+    self.assertEqual([True, True, True], [f.get_result() for f in futures])
+    self.assertEqual(MEDIUM_CONTENT, sharded_cache.Get('bar'))
+
+    # Lookups started together share RPCs.
+    futures = [
+        sharded_cache.GetAsync('foo'),
+        sharded_cache.GetAsync('bar', size=len(MEDIUM_CONTENT)),
+        sharded_cache.GetMultiAsync(['baz', 'fake']),
+    ]
+    self.assertEqual(SMALL_CONTENT, futures[0].get_result())
+    self.assertEqual(MEDIUM_CONTENT, futures[1].get_result())
+    self.assertEqual({'baz': LARGE_OBJECT}, futures[2].get_result())
+    # One RPC for all predicted shards, and one for the rest of "baz".
+    self.assertEqual(2, len(get_multi_calls))
+
+    # Values with evicted shards are deleted and not returned.
+    memcache.delete(sharded_cache.MEMCACHE_PREFIX + 'bar1')
+    self.assertIsNone(sharded_cache.GetAsync('bar').get_result())
+    self.assertIsNone(memcache.get(sharded_cache.MEMCACHE_PREFIX + 'bar'))
+
+  def testGetMultiWithStaleness(self):
+    self.stubs.Set(sharded_cache, '_Now', lambda: 1000)
+    sharded_cache.Set('foo', SMALL_CONTENT, fresh_time=60)
+    sharded_cache.Set('bar', MEDIUM_CONTENT, fresh_time=120)
+    sharded_cache.Set('baz', SMALL_CONTENT)
+    values, stale_keys = sharded_cache.GetMultiWithStaleness(
+        ['foo', 'bar', 'baz', 'fake'])
+    self.assertEqual(['bar', 'baz', 'foo'], sorted(values))
+    self.assertEqual(set(), stale_keys)
+
+    # Stale values are still returned, and flagged.
+    self.stubs.Set(sharded_cache, '_Now', lambda: 1061)
+    values, stale_keys = sharded_cache.GetMultiWithStaleness(
+        ['foo', 'bar', 'baz', 'fake'])
+    self.assertEqual(SMALL_CONTENT, values['foo'])
+    self.assertEqual(MEDIUM_CONTENT, values['bar'])
+    self.assertEqual(set(['foo']), stale_keys)
+    self.assertEqual(SMALL_CONTENT, sharded_cache.Get('foo'))
+
   def testSet(self):
     # Set object smaller than 1MB.
     sharded_cache.Set('foo', SMALL_CONTENT)
     shard_map = memcache.get(sharded_cache.MEMCACHE_PREFIX + 'foo')
     self.assertEqual(0, shard_map['num_shards'])
-    self.assertEqual(SMALL_CONTENT, pickle.loads(shard_map['content']))
+    self.assertEqual(sharded_cache.FORMAT_BYTES, shard_map['format'])
+    self.assertEqual(SMALL_CONTENT, shard_map['content'])
     first_shard = memcache.get(sharded_cache.MEMCACHE_PREFIX + 'foo0')
     self.assertEqual(None, first_shard)
 
-    # Set object larger than 1MB.
-    sharded_cache.Set('foo', LARGE_CONTENT)
+    # Set byte string larger than 1MB, which is stored as-is.
+    sharded_cache.Set('foo', MEDIUM_CONTENT)
+    shard_map = memcache.get(sharded_cache.MEMCACHE_PREFIX + 'foo')
+    self.assertEqual(2, shard_map['num_shards'])
+    generation = shard_map['generation']
+    self.assertEqual(sharded_cache.GENERATION_SIZE, len(generation))
+    keys = ['%sfoo%d' % (sharded_cache.MEMCACHE_PREFIX, i) for i in xrange(3)]
+    expected_content_shards = {
+        keys[0]: generation + MEDIUM_CONTENT[0:SHARD_CONTENT_SIZE],
+        keys[1]: generation + MEDIUM_CONTENT[SHARD_CONTENT_SIZE:],
+    }
+    self.assertDictEqual(expected_content_shards, memcache.get_multi(keys))
+
+    # Set object larger than 1MB, which is pickled.
+    sharded_cache.Set('foo', LARGE_OBJECT)
     shard_map = memcache.get(sharded_cache.MEMCACHE_PREFIX + 'foo')
     cache_keys = ['foo0', 'foo1', 'foo2']
     memcache_keys = [sharded_cache.MEMCACHE_PREFIX + key for key in cache_keys]
     content = memcache.get_multi(memcache_keys)
     self.assertEqual(3, shard_map['num_shards'])
-    keys = ['%sfoo%d' % (sharded_cache.MEMCACHE_PREFIX, i) for i in xrange(3)]
+    self.assertEqual(sharded_cache.FORMAT_PICKLE, shard_map['format'])
+    generation = shard_map['generation']
     expected_content_shards = {
         # 0 to 1MB.
-        keys[0]: LARGE_CONTENT_PICKLED[0:MAX_VALUE_SIZE],
+        keys[0]: generation + LARGE_OBJECT_PICKLED[0:SHARD_CONTENT_SIZE],
         # 1MB to 2MB.
-        keys[1]: LARGE_CONTENT_PICKLED[MAX_VALUE_SIZE:MAX_VALUE_SIZE * 2],
+        keys[1]: generation + LARGE_OBJECT_PICKLED[
+            SHARD_CONTENT_SIZE:SHARD_CONTENT_SIZE * 2],
         # 2MB to end.
-        keys[2]: LARGE_CONTENT_PICKLED[MAX_VALUE_SIZE * 2:],
+        keys[2]: generation + LARGE_OBJECT_PICKLED[SHARD_CONTENT_SIZE * 2:],
     }
     self.assertDictEqual(expected_content_shards, content)
     next_shard = memcache.get(sharded_cache.MEMCACHE_PREFIX + 'foo3')
     self.assertEqual(None, next_shard)
 
+    # Set compressed content, which fits in the shard map.
+    sharded_cache.Set('foo', LARGE_CONTENT, compress=True)
+    shard_map = memcache.get(sharded_cache.MEMCACHE_PREFIX + 'foo')
+    self.assertEqual(0, shard_map['num_shards'])
+    self.assertEqual('zlib', shard_map['compression'])
+    self.assertEqual(LARGE_CONTENT, zlib.decompress(shard_map['content']))
+
+    # Incompressible content is stored uncompressed.
+    sharded_cache.Set('foo', os.urandom(1000), compress=True)
+    shard_map = memcache.get(sharded_cache.MEMCACHE_PREFIX + 'foo')
+    self.assertNotIn('compression', shard_map)
+
     # Set object larger than 32MB, should die internally and clear cache.
     sharded_cache.Set('foo', LARGEST_CONTENT)
     shard_map = memcache.get(sharded_cache.MEMCACHE_PREFIX + 'foo')
@@ -134,6 +307,16 @@ class ShardedCacheTest(basetest.TestCase):
     self.assertEqual(None, sharded_cache.Get('foo'))
     self.assertDictEqual({}, content)
 
+  def testDeleteMulti(self):
+    sharded_cache.Set('foo', SMALL_CONTENT)
+    sharded_cache.Set('bar', LARGE_CONTENT)
+    sharded_cache.DeleteMulti(['foo', 'bar', 'fake'])
+    cache_keys = ['foo', 'bar', 'bar0', 'bar1', 'bar2']
+    memcache_keys = [sharded_cache.MEMCACHE_PREFIX + key for key in cache_keys]
+    self.assertDictEqual({}, memcache.get_multi(memcache_keys))
+    self.assertEqual(memcache.DELETE_ITEM_MISSING,
+                     sharded_cache.DeleteMulti(['fake']))
+
   def testMaxValueSize(self):
     # If memcache max value size ever changes, I want to know.
     self.assertEqual(1000000, MAX_VALUE_SIZE)
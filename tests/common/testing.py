@@ -26,6 +26,7 @@ import mox
 from mox import stubout
 from google.appengine.datastore import datastore_stub_util
 from google.appengine.ext import deferred
+from google.appengine.ext import ndb
 from google.appengine.ext import testbed
 import gflags as flags
 from titan.common.lib.google.apputils import basetest
@@ -55,6 +56,15 @@ def DisableCaching(func):
     # Stub special packed return from files_cache.GetFiles.
     self.stubs.Set(files_cache, 'GetFiles',
                    lambda *args, **kwargs: (None, False))
+    self.stubs.Set(files_cache, 'GetBlobsWithStaleness',
+                   lambda *args, **kwargs: ({}, set()))
+
+    # Stub asynchronous stores to return futures which are already done.
+    def StoreAsync(*args, **kwargs):
+      future = ndb.Future()
+      future.set_result(None)
+      return future
+    self.stubs.Set(files_cache, 'StoreBlobAsync', StoreAsync)
     func(self, *args, **kwargs)
 
   return Wrapper
@@ -14,7 +14,9 @@
 # limitations under the License.
 
 import cStringIO
+import mimetools
 import urllib2
+import zlib
 import mox
 from titan.common.lib.google.apputils import basetest
 from titan.common import titan_rpc
@@ -60,5 +62,20 @@ class TitanRpcTest(basetest.TestCase):
 
     self.mox.VerifyAll()
 
+  def testContentDecodingHandler(self):
+    handler = titan_rpc.ContentDecodingHandler()
+    request = handler.http_request(urllib2.Request('http://example.com/'))
+    self.assertEqual('gzip, deflate', request.get_header('Accept-encoding'))
+
+    headers = mimetools.Message(cStringIO.StringIO(
+        'Content-Encoding: deflate\r\nContent-Type: text/plain\r\n\r\n'))
+    response = urllib2.addinfourl(
+        cStringIO.StringIO(zlib.compress('foobar')), headers,
+        'http://example.com/', 200)
+    response = handler.http_response(request, response)
+    self.assertEqual('foobar', response.read())
+    self.assertNotIn('content-encoding', response.headers)
+    self.assertEqual(200, response.code)
+
 if __name__ == '__main__':
   basetest.main()
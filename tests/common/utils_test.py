@@ -15,6 +15,7 @@
 
 """Tests for utils.py."""
 
+import zlib
 from titan.common.lib.google.apputils import app
 from titan.common.lib.google.apputils import basetest
 from titan.common import utils
@@ -41,6 +42,37 @@ class UtilsTestCase(basetest.TestCase):
     self.assertEqual(expected, utils.SplitPath('/path/to/some/file.txt'))
     self.assertEqual(expected, utils.SplitPath('/path/to/some/file'))
 
+  def testGetAcceptedEncoding(self):
+    self.assertIsNone(utils.GetAcceptedEncoding(None))
+    self.assertIsNone(utils.GetAcceptedEncoding('identity'))
+    self.assertEqual('gzip', utils.GetAcceptedEncoding('deflate, GZIP'))
+    self.assertEqual('deflate',
+                     utils.GetAcceptedEncoding('gzip;q=0, deflate;q=0.5'))
+    self.assertEqual('gzip', utils.GetAcceptedEncoding('*'))
+    self.assertIsNone(utils.GetAcceptedEncoding('*;q=0'))
+    self.assertEqual('deflate', utils.GetAcceptedEncoding(
+        'gzip, deflate', encodings=('deflate', 'gzip')))
+
+  def testCompressContent(self):
+    content = 'foo' * 100
+    for encoding in utils.RESPONSE_ENCODINGS:
+      compressed = utils.CompressContent(content, encoding)
+      self.assertEqual(content, utils.DecompressContent(compressed, encoding))
+    # Raw deflate streams are also accepted.
+    raw_deflate = zlib.compress(content)[2:-4]
+    self.assertEqual(content, utils.DecompressContent(raw_deflate, 'deflate'))
+    self.assertRaises(ValueError, utils.CompressContent, content, 'br')
+
+    # Rewrapped zlib content is valid gzip.
+    gzip_content = utils.ZlibToGzip(zlib.compress(content))
+    self.assertEqual(content, utils.DecompressContent(gzip_content, 'gzip'))
+
+    self.assertTrue(utils.IsCompressibleMimeType('text/plain'))
+    self.assertTrue(
+        utils.IsCompressibleMimeType('application/json; charset=utf-8'))
+    self.assertFalse(utils.IsCompressibleMimeType('image/png'))
+    self.assertFalse(utils.IsCompressibleMimeType(None))
+
   def testComposeMethodKwargs(self):
 
     class Parent(object):
@@ -76,6 +76,26 @@ class DirManagerTest(testing.BaseTestCase):
     dir_task_consumer.ProcessNextWindow()
     self.assertEqual(dirs.Dirs([]), dirs.Dirs.List('/'))
 
+  def testBatchedDirUpdateTasks(self):
+    files.RegisterFileFactory(lambda *args, **kwargs: DirManagingFile)
+    self.stubs.SmartSet(dirs, 'TASKQUEUE_LEASE_ETA_BUFFER',
+                        -(dirs.TASKQUEUE_LEASE_ETA_BUFFER * 86400))
+
+    # Batch writes and deletes add one task for all paths.
+    titan_files = files.Files.WriteMulti({
+        '/a/b/foo': {'content': ''},
+        '/a/c/foo': {'content': ''},
+    })
+    tasks = self.taskqueue_stub.get_filtered_tasks(
+        queue_names=[dirs.TASKQUEUE_NAME])
+    self.assertEqual(1, len(tasks))
+    dirs.DirTaskConsumer().ProcessNextWindow()
+    self.assertEqual(dirs.Dirs(['/a/b', '/a/c']), dirs.Dirs.List('/a/'))
+
+    files.Files(titan_files.keys()).Delete()
+    dirs.DirTaskConsumer().ProcessNextWindow()
+    self.assertEqual(dirs.Dirs([]), dirs.Dirs.List('/'))
+
   def testComputeAffectedDirs(self):
     dir_service = dirs.DirService()
 
@@ -17,6 +17,7 @@
 
 from tests.common import testing
 
+import os
 from google.appengine.api import memcache
 from titan.common.lib.google.apputils import basetest
 from titan.common import sharded_cache
@@ -28,7 +29,7 @@ class FileCacheTestCase(testing.BaseTestCase):
   def testGetFiles(self):
     # Fake cache eviction:
     files.Write('/foo/bar', 'Bar')
-    memcache.delete(files_cache.FILE_MEMCACHE_PREFIX + '/foo/bar')
+    memcache.delete(files_cache._GetFileCacheKey('/foo/bar'))
 
     # Cache miss: any path doesn't exist in memcache.
     # Single non-cached path.
@@ -61,7 +62,7 @@ class FileCacheTestCase(testing.BaseTestCase):
     file_obj = files.Write('/foo/bar', 'Bar')
     result = files_cache.StoreFiles(file_obj._file)
     self.assertTrue(result)
-    cache_item = memcache.get(files_cache.FILE_MEMCACHE_PREFIX + '/foo/bar')
+    cache_item = memcache.get(files_cache._GetFileCacheKey('/foo/bar'))
     self.assertEntityEqual(file_obj._file, cache_item)
 
     # Store multiple _File entities.
@@ -70,9 +71,9 @@ class FileCacheTestCase(testing.BaseTestCase):
     file_ents = files._File.get_by_key_name(['/foo/bar', '/foo/bar/baz'])
     result = files_cache.StoreFiles(file_ents)
     self.assertEqual([], result)
-    cache_item = memcache.get(files_cache.FILE_MEMCACHE_PREFIX + '/foo/bar')
+    cache_item = memcache.get(files_cache._GetFileCacheKey('/foo/bar'))
     self.assertEntityEqual(file_ents[0], cache_item)
-    cache_item = memcache.get(files_cache.FILE_MEMCACHE_PREFIX + '/foo/bar/baz')
+    cache_item = memcache.get(files_cache._GetFileCacheKey('/foo/bar/baz'))
     self.assertEntityEqual(file_ents[1], cache_item)
 
   def testStoreAll(self):
@@ -84,34 +85,145 @@ class FileCacheTestCase(testing.BaseTestCase):
     }
     result = files_cache.StoreAll(data)
     self.assertEqual([], result)
-    cache_item = memcache.get(files_cache.FILE_MEMCACHE_PREFIX + '/foo')
+    cache_item = memcache.get(files_cache._GetFileCacheKey('/foo'))
     self.assertEqual(files_cache._NO_FILE_FLAG, cache_item)
-    cache_item = memcache.get(files_cache.FILE_MEMCACHE_PREFIX + '/foo/bar')
+    cache_item = memcache.get(files_cache._GetFileCacheKey('/foo/bar'))
     self.assertEntityEqual(file_obj._file, cache_item)
 
   def testSetFileDoesNotExist(self):
     # Set single path.
     files_cache.SetFileDoesNotExist('/foo/bar')
-    cache_item = memcache.get(files_cache.FILE_MEMCACHE_PREFIX + '/foo/bar')
+    cache_item = memcache.get(files_cache._GetFileCacheKey('/foo/bar'))
     self.assertEqual(files_cache._NO_FILE_FLAG, cache_item)
 
     # Set multiple paths.
     paths = ['/foo/bar', '/foo/bar/baz']
-    cache_keys = [files_cache.FILE_MEMCACHE_PREFIX + path for path in paths]
+    cache_keys = [files_cache._GetFileCacheKey(path) for path in paths]
     files_cache.SetFileDoesNotExist(paths)
     cache_items = memcache.get_multi(cache_keys)
     for key in cache_keys:
       self.assertEqual(files_cache._NO_FILE_FLAG, cache_items[key])
 
+  def testFileEntities(self):
+    files.File('/foo').Write('foo')
+    paths = ['/foo', '/fake']
+    file_ents, generations = files_cache.GetFileEntities(paths)
+    self.assertEqual({}, file_ents)
+    self.assertEqual(set(paths), set(generations))
+
+    # Store existing and non-existent files, then get them from memory.
+    foo_ent = files._TitanFile.get_by_id('/foo')
+    files_cache.StoreFileEntities({'/foo': foo_ent, '/fake': None},
+                                  generations)
+    file_ents, _ = files_cache.GetFileEntities(paths)
+    self.assertEqual(foo_ent, file_ents['/foo'])
+    self.assertIsNot(foo_ent, file_ents['/foo'])
+    self.assertIsNone(file_ents['/fake'])
+
+    # Get from memcache.
+    files_cache.ClearFileEntityCache()
+    file_ents, _ = files_cache.GetFileEntities(paths)
+    self.assertEqual(foo_ent, file_ents['/foo'])
+    self.assertIsNone(file_ents['/fake'])
+
+    # Invalidation changes the generation of the files, in memory and memcache.
+    files_cache.InvalidateFileEntities(['/foo'])
+    file_ents, new_generations = files_cache.GetFileEntities(paths)
+    self.assertEqual(['/fake'], file_ents.keys())
+    self.assertEqual(generations['/foo'] + 1, new_generations['/foo'])
+
+    # Evicted generations are never reused.
+    memcache.delete(files_cache.FILE_GENERATION_MEMCACHE_PREFIX + '/fake')
+    file_ents, new_generations = files_cache.GetFileEntities(paths)
+    self.assertEqual({}, file_ents)
+    self.assertGreater(new_generations['/fake'], generations['/fake'])
+
+    # Writes invalidate cached entities.
+    _ = files.File('/foo').content
+    files.File('/foo').Write('bar')
+    self.assertEqual('bar', files.File('/foo').content)
+    files.File('/fake').Write('fake')
+    self.assertTrue(files.File('/fake').exists)
+    files.File('/fake').Delete()
+    self.assertFalse(files.File('/fake').exists)
+
+  def testFileEntityMemoryCache(self):
+    self.stubs.Set(files_cache, 'FILE_ENTITY_CACHE_MAX_SIZE', 2)
+    files_cache.ClearFileEntityCache()
+    paths = ['/foo', '/bar', '/baz']
+    _, generations = files_cache.GetFileEntities(paths)
+
+    # The least recently used entries are evicted past the max size.
+    files_cache.StoreFileEntities({'/foo': None}, generations)
+    files_cache.StoreFileEntities({'/bar': None}, generations)
+    files_cache.GetFileEntities(['/foo'])
+    files_cache.StoreFileEntities({'/baz': None}, generations)
+    self.assertEqual(['/foo', '/baz'], files_cache._file_entity_cache.keys())
+
+    # Expired entries are dropped when read.
+    self.stubs.Set(files_cache, 'FILE_ENTITY_CACHE_SECONDS', -1)
+    files_cache.ClearFileEntityCache()
+    files_cache.StoreFileEntities({'/bar': None}, generations)
+    self.assertEqual(['/bar'], files_cache._file_entity_cache.keys())
+    memcache.delete(
+        files_cache._GetFileEntityKey('/bar', generations['/bar']))
+    file_ents, _ = files_cache.GetFileEntities(['/bar'])
+    self.assertEqual({}, file_ents)
+    self.assertEqual([], files_cache._file_entity_cache.keys())
+
   def testGetBlob(self):
-    sharded_cache.Set(files_cache.BLOB_MEMCACHE_PREFIX + '/foo.html', 'Test')
+    sharded_cache.Set(files_cache._GetBlobCacheKey('/foo.html'), 'Test')
     self.assertEqual('Test', files_cache.GetBlob('/foo.html'))
 
   def testStoreBlob(self):
     result = files_cache.StoreBlob('/foo.html', 'Test')
     self.assertTrue(result)
     self.assertEqual('Test', sharded_cache.Get(
-        files_cache.BLOB_MEMCACHE_PREFIX + '/foo.html'))
+        files_cache._GetBlobCacheKey('/foo.html')))
+
+  def testBlobLease(self):
+    self.stubs.SmartSet(files_cache, 'BLOB_LEASE_WAIT_SECONDS', 0)
+    lease = files_cache.AcquireBlobLease('/foo.html')
+    self.assertTrue(lease)
+    self.assertIsNone(files_cache.AcquireBlobLease('/foo.html'))
+    self.assertTrue(files_cache.AcquireBlobLease('/bar.html'))
+    self.assertIsNone(files_cache.WaitForBlob('/foo.html'))
+
+    # Only the current holder of the lease releases it.
+    files_cache.ReleaseBlobLease('/foo.html', 'expired-lease')
+    self.assertIsNone(files_cache.AcquireBlobLease('/foo.html'))
+    files_cache.StoreBlob('/foo.html', 'Test')
+    files_cache.ReleaseBlobLease('/foo.html', lease)
+    self.assertEqual('Test', files_cache.WaitForBlob('/foo.html'))
+    self.assertTrue(files_cache.AcquireBlobLease('/foo.html'))
+
+  def testAsyncLookups(self):
+    get_multi_calls = []
+    original_get_multi_async = memcache.Client.get_multi_async
+
+    def CountingGetMultiAsync(client, keys, *args, **kwargs):
+      get_multi_calls.append(keys)
+      return original_get_multi_async(client, keys, *args, **kwargs)
+
+    files.Touch(['/foo/bar', '/foo/baz'])
+    files_cache.StoreSubdirs({'/': ['foo']})
+    self.assertTrue(files_cache.StoreBlobAsync('/foo/bar', 'Test').get_result())
+
+    # Lookups started together are merged into one RPC.
+    self.stubs.Set(memcache.Client, 'get_multi_async', CountingGetMultiAsync)
+    file_future = files_cache.GetFilesAsync('/foo/bar')
+    files_future = files_cache.GetFilesAsync(['/foo/bar', '/foo/baz'])
+    missing_future = files_cache.GetFilesAsync(['/foo/bar', '/fake'])
+    subdirs_future = files_cache.GetSubdirsAsync('/')
+    blob_future = files_cache.GetBlobAsync('/foo/bar', size=4)
+    self.assertEqual('/foo/bar', file_future.get_result()[0].path)
+    file_ents, cache_hit = files_future.get_result()
+    self.assertTrue(cache_hit)
+    self.assertEqual(['/foo/bar', '/foo/baz'], [ent.path for ent in file_ents])
+    self.assertEqual((None, False), missing_future.get_result())
+    self.assertEqual(set(['foo']), subdirs_future.get_result())
+    self.assertEqual('Test', blob_future.get_result())
+    self.assertEqual(1, len(get_multi_calls))
 
   def testClearBlobsForFiles(self):
     file_obj = files.Touch('/foo.html')
@@ -130,23 +242,23 @@ class FileCacheTestCase(testing.BaseTestCase):
     self.assertEqual(None, cache_item)
 
   def testStoreSubdirs(self):
-    memcache.set(files_cache.DIR_MEMCACHE_PREFIX + '/', {'old_key': 1})
+    memcache.set(files_cache._GetDirCacheKey('/'), {'old_key': 1})
 
     # Store new subdirs lists.
     files_cache.StoreSubdirs({
         '/': ['foo'],
         '/foo': set([]),
     })
-    cache_item = memcache.get(files_cache.DIR_MEMCACHE_PREFIX + '/')
+    cache_item = memcache.get(files_cache._GetDirCacheKey('/'))
     self.assertEqual(set(['foo']), cache_item['subdirs'])
     # Verify that other cached dir data is not touched.
     self.assertTrue(cache_item['old_key'])
-    cache_item = memcache.get(files_cache.DIR_MEMCACHE_PREFIX + '/foo')
+    cache_item = memcache.get(files_cache._GetDirCacheKey('/foo'))
     self.assertEqual(set([]), cache_item['subdirs'])
 
     # Update subdirs (should overwrite).
     files_cache.StoreSubdirs({'/': ['new_dir']})
-    cache_item = memcache.get(files_cache.DIR_MEMCACHE_PREFIX + '/')
+    cache_item = memcache.get(files_cache._GetDirCacheKey('/'))
     self.assertEqual(set(['new_dir']), cache_item['subdirs'])
 
   def testGetSubdirs(self):
@@ -168,36 +280,154 @@ class FileCacheTestCase(testing.BaseTestCase):
 
     # Cleanup the dir caches for testing.
     preset_data = {'old_key': 1, 'subdirs': set([])}
-    memcache.set(files_cache.DIR_MEMCACHE_PREFIX + '/', preset_data)
-    memcache.set(files_cache.DIR_MEMCACHE_PREFIX + '/foo', preset_data)
+    memcache.set(files_cache._GetDirCacheKey('/'), preset_data)
+    memcache.set(files_cache._GetDirCacheKey('/foo'), preset_data)
 
     # Update single subdir set.
     files_cache.UpdateSubdirsForFiles(file_objs[0]._file)
-    cache_item = memcache.get(files_cache.DIR_MEMCACHE_PREFIX + '/')
+    cache_item = memcache.get(files_cache._GetDirCacheKey('/'))
     self.assertEqual(set(['foo']), cache_item['subdirs'])
     self.assertTrue(cache_item['old_key'])
-    cache_item = memcache.get(files_cache.DIR_MEMCACHE_PREFIX + '/foo')
+    cache_item = memcache.get(files_cache._GetDirCacheKey('/foo'))
     self.assertEqual(set(['bar']), cache_item['subdirs'])
 
     # Update multiple subdir sets.
     file_objs.append(files.Touch('/foo/qux/foo.html'))
     files_cache.UpdateSubdirsForFiles([file_objs[0]._file, file_objs[1]._file])
-    cache_item = memcache.get(files_cache.DIR_MEMCACHE_PREFIX + '/')
+    cache_item = memcache.get(files_cache._GetDirCacheKey('/'))
     self.assertEqual(set(['foo']), cache_item['subdirs'])
     self.assertTrue(cache_item['old_key'])
-    cache_item = memcache.get(files_cache.DIR_MEMCACHE_PREFIX + '/foo')
+    cache_item = memcache.get(files_cache._GetDirCacheKey('/foo'))
     self.assertEqual(set(['bar', 'qux']), cache_item['subdirs'])
 
+  def testDirCacheCompareAndSet(self):
+    cache_key = files_cache._GetDirCacheKey('/')
+    memcache.set(cache_key, {'subdirs': set(['foo'])})
+    seen_subdirs = []
+
+    def UpdateDirCache(unused_cache_key, dir_cache):
+      seen_subdirs.append(set(dir_cache['subdirs']))
+      if len(seen_subdirs) == 1:
+        # Simulate a racing writer between the read and the write.
+        memcache.set(cache_key, {'subdirs': set(['foo', 'bar'])})
+      dir_cache['subdirs'].add('baz')
+      return dir_cache
+
+    self.assertEqual(
+        [], files_cache._UpdateDirCaches([cache_key], UpdateDirCache))
+    self.assertEqual([set(['foo']), set(['foo', 'bar'])], seen_subdirs)
+    self.assertEqual({'subdirs': set(['foo', 'bar', 'baz'])},
+                     memcache.get(cache_key))
+
+    # Entries which keep conflicting are deleted instead of left stale.
+    def ConflictingUpdateDirCache(unused_cache_key, unused_dir_cache):
+      memcache.set(cache_key, {'subdirs': set()})
+      return {'subdirs': set(['qux'])}
+
+    self.assertEqual([cache_key], files_cache._UpdateDirCaches(
+        [cache_key], ConflictingUpdateDirCache))
+    self.assertIsNone(memcache.get(cache_key))
+
   def testClearSubdirsForFiles(self):
     file_objs = files.Touch(['/foo/bar/baz.html', '/foo/qux/foo.html'])
     files.ListDir('/')
-    self.assertTrue(memcache.get(files_cache.DIR_MEMCACHE_PREFIX + '/'))
-    self.assertTrue(memcache.get(files_cache.DIR_MEMCACHE_PREFIX + '/foo'))
+    self.assertTrue(memcache.get(files_cache._GetDirCacheKey('/')))
+    self.assertTrue(memcache.get(files_cache._GetDirCacheKey('/foo')))
     files_cache.ClearSubdirsForFiles([f._file for f in file_objs])
     self.assertDictEqual(
-        {}, memcache.get(files_cache.DIR_MEMCACHE_PREFIX + '/'))
+        {}, memcache.get(files_cache._GetDirCacheKey('/')))
     self.assertDictEqual(
-        {}, memcache.get(files_cache.DIR_MEMCACHE_PREFIX + '/foo'))
+        {}, memcache.get(files_cache._GetDirCacheKey('/foo')))
+
+  def testInvalidateDirs(self):
+    paths = ['/foo/bar/baz.html', '/foo/qux.html', '/other.html']
+    files_cache.SetFileDoesNotExist(paths)
+    files_cache.StoreBlob('/foo/bar/baz.html', 'Test')
+    files_cache.StoreSubdirs({'/': ['foo'], '/foo': ['bar']})
+    self.assertEqual(([None, None, None], True), files_cache.GetFiles(paths))
+
+    # Everything under the dir is invalidated, including its own subdirs.
+    files_cache.InvalidateDirs(['/foo'])
+    self.assertEqual((None, False), files_cache.GetFiles(paths[:1]))
+    self.assertEqual((None, False), files_cache.GetFiles(paths[1:2]))
+    self.assertEqual(([None], True), files_cache.GetFiles(paths[2:]))
+    self.assertIsNone(files_cache.GetBlob('/foo/bar/baz.html'))
+    self.assertIsNone(files_cache.GetSubdirs('/foo'))
+    self.assertEqual(set(['foo']), files_cache.GetSubdirs('/'))
+
+    # New entries are cached under the new generation, in later requests too.
+    files_cache.StoreSubdirs({'/foo': ['bar']})
+    del os.environ[files_cache._ENVIRON_DIR_GENERATIONS_NAME]
+    self.assertEqual(set(['bar']), files_cache.GetSubdirs('/foo'))
+
+    # Invalidations from other requests are seen by later requests.
+    files_cache.InvalidateDirs(['/'])
+    del os.environ[files_cache._ENVIRON_DIR_GENERATIONS_NAME]
+    self.assertIsNone(files_cache.GetSubdirs('/foo'))
+    self.assertEqual((None, False), files_cache.GetFiles(paths[2:]))
+
+    # File entities are invalidated too, including in each instance's memory.
+    _, generations = files_cache.GetFileEntities(paths)
+    files_cache.StoreFileEntities(dict.fromkeys(paths), generations)
+    files_cache.InvalidateDirs(['/foo'])
+    file_ents, _ = files_cache.GetFileEntities(paths)
+    self.assertEqual({'/other.html': None}, file_ents)
+    files_cache.ClearFileEntityCache()
+    file_ents, _ = files_cache.GetFileEntities(paths)
+    self.assertEqual({'/other.html': None}, file_ents)
+
+    # Async lookups fetch dir generations through the ndb context instead.
+    files_cache.SetFileDoesNotExist(paths)
+    del os.environ[files_cache._ENVIRON_DIR_GENERATIONS_NAME]
+    self.stubs.Set(memcache, 'offset_multi', None)
+    files_future = files_cache.GetFilesAsync(paths)
+    subdirs_future = files_cache.GetSubdirsAsync('/foo')
+    self.assertEqual(([None, None, None], True), files_future.get_result())
+    self.assertIsNone(subdirs_future.get_result())
+    self.stubs.UnsetAll()
+
+  def testDeleteInvalidatesDirs(self):
+    files.Files.WriteMulti({
+        '/foo/bar/baz.html': {'content': 'baz'},
+        '/foo/qux.html': {'content': 'qux'},
+        '/other.html': {'content': 'other'},
+    })
+    # Cached entries which are only removed by invalidating their dirs.
+    files_cache.SetFileDoesNotExist(['/foo/fake.html', '/fake.html'])
+
+    # Deleting a whole subtree invalidates everything cached under it.
+    files.Files(['/foo/bar/baz.html', '/foo/qux.html']).Delete()
+    self.assertEqual((None, False), files_cache.GetFiles('/foo/fake.html'))
+    self.assertEqual((None, True), files_cache.GetFiles('/fake.html'))
+
+    # Deleting only some of a dir's files doesn't.
+    files.Files.WriteMulti({
+        '/foo/bar/baz.html': {'content': 'baz'},
+        '/foo/qux.html': {'content': 'qux'},
+    })
+    files_cache.SetFileDoesNotExist('/foo/fake.html')
+    files.Delete(['/foo/bar/baz.html', '/other.html'])
+    self.assertEqual((None, True), files_cache.GetFiles('/foo/fake.html'))
+
+    # Single files are not checked, but deprecated subtree deletes are.
+    files.Delete(['/foo/qux.html'])
+    self.assertEqual((None, True), files_cache.GetFiles('/foo/fake.html'))
+    files.Files.WriteMulti({'/foo/qux.html': {'content': 'qux'},
+                            '/foo/bar/baz.html': {'content': 'baz'}})
+    files.Delete(['/foo/qux.html', '/foo/bar/baz.html'])
+    self.assertEqual((None, False), files_cache.GetFiles('/foo/fake.html'))
+
+    # Files in invalidated subtrees are not also invalidated one by one.
+    invalidated_paths = []
+    self.stubs.Set(files_cache, 'InvalidateFileEntities',
+                   invalidated_paths.extend)
+    files.Files.WriteMulti({'/foo/qux.html': {'content': 'qux'},
+                            '/foo/bar/baz.html': {'content': 'baz'}})
+    del invalidated_paths[:]
+    files.Files(['/foo/qux.html', '/foo/bar/baz.html']).Delete()
+    self.assertEqual([], invalidated_paths)
+    self.assertFalse(files.File('/foo/qux.html').exists)
+    self.stubs.UnsetAll()
 
 if __name__ == '__main__':
   basetest.main()
@@ -19,11 +19,16 @@
 from tests.common import testing
 
 import copy
+import cStringIO
 import datetime
 import hashlib
+import os
+import threading
+import zlib
 from google.appengine.api import files as blobstore_files
 from google.appengine.api import users
 from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
 from titan.common.lib.google.apputils import app
 from titan.common.lib.google.apputils import basetest
 from titan.common import sharded_cache
@@ -34,7 +39,8 @@ from google.appengine.api import memcache
 from titan.files import files_cache
 
 # Content larger than the arbitrary max content size and the 1MB RPC limit.
-LARGE_FILE_CONTENT = 'a' * (1 << 21)  # 2 MiB
+# Random, so that it cannot be compressed to fit in the datastore.
+LARGE_FILE_CONTENT = os.urandom(1 << 21)  # 2 MiB
 
 class FileTestCase(testing.BaseTestCase):
 
@@ -116,6 +122,9 @@ class FileTestCase(testing.BaseTestCase):
     }
     self.assertEqual(expected_data,
                      files.File('/foo/bar/baz').Serialize(full=True))
+    self.assertEqual(
+        {'path': '/foo/bar/baz', 'meta': {'color': 'blue', 'flag': False}},
+        files.File('/foo/bar/baz').Serialize(fields=['path', 'meta', 'fake']))
 
     # Properties: paths, mime_type, created, modified, blob, created_by,
     # modified_by, and size.
@@ -177,6 +186,7 @@ class FileTestCase(testing.BaseTestCase):
         color=u'blue',
         flag=False,
         md5_hash=hashlib.md5('Test').hexdigest(),
+        size=4,
     )
     original_expected_file = copy.deepcopy(expected_file)
     meta = {'color': 'blue', 'flag': False}
@@ -198,6 +208,7 @@ class FileTestCase(testing.BaseTestCase):
     actual_file.Write('New content', meta=new_meta, mime_type='fake/type')
     expected_file.content = 'New content'
     expected_file.md5_hash = hashlib.md5('New content').hexdigest()
+    expected_file.size = 11
     expected_file.flag = True
     expected_file.mime_type = 'fake/type'
     self.assertNdbEntityEqual(expected_file, actual_file._file, ignore=dates)
@@ -228,12 +239,10 @@ class FileTestCase(testing.BaseTestCase):
     self.assertEqual(LARGE_FILE_CONTENT, titan_file.content)
     self.assertIsNone(titan_file._file_ent.content)
     self.assertEqual(LARGE_FILE_CONTENT, files.File('/foo/bar.html').content)
-
-    # TODO(user): When file_service_stub correctly sets md5_hash,
-    # use this code. Until then, check that the AttributeError is raised.
-    # self.assertEqual(hashlib.md5(LARGE_FILE_CONTENT).hexdigest(),
-    #                 titan_file.md5_hash)
-    self.assertRaises(AttributeError, lambda: titan_file.md5_hash)
+    # The size and md5 hash are computed while uploading the blob.
+    self.assertEqual(len(LARGE_FILE_CONTENT), titan_file._file_ent.size)
+    self.assertEqual(hashlib.md5(LARGE_FILE_CONTENT).hexdigest(),
+                     titan_file.md5_hash)
 
     # Make sure the blob is deleted with the file:
     titan_file.Delete()
@@ -256,6 +265,7 @@ class FileTestCase(testing.BaseTestCase):
     # Test the current object and a new instance:
     self.assertEqual(blob_content, files.File('/foo/bar.html').content)
     self.assertEqual(blob_content, titan_file.content)
+    self.assertEqual(len(blob_content), titan_file._file_ent.size)
 
     # TODO(user): When file_service_stub correctly sets md5_hash,
     # use this code. Until then, check that the AttributeError is raised.
@@ -287,6 +297,293 @@ class FileTestCase(testing.BaseTestCase):
     self.assertRaises(files.InvalidMetaError,
                       titan_file.Write, content='', meta=meta)
 
+  def testUnchangedWrite(self):
+    meta = {'color': 'blue'}
+    titan_file = files.File('/foo/bar.html').Write(u'f♥♥', meta=meta)
+    modified = titan_file.modified
+    self.assertEqual(0, files.GetSkippedWriteCount())
+
+    # Writes which don't change anything are skipped.
+    titan_file = files.File('/foo/bar.html')
+    titan_file.Write(u'f♥♥', mime_type='text/html', meta=meta)
+    titan_file.Write(meta={'color': 'blue'})
+    self.assertEqual(2, files.GetSkippedWriteCount())
+    self.assertEqual(modified, files.File('/foo/bar.html').modified)
+    # Same bytes, but a different encoding, is a change.
+    files.File('/foo/bar.html').Write(u'f♥♥'.encode('utf-8'))
+    self.assertEqual(2, files.GetSkippedWriteCount())
+    self.assertNotEqual(modified, files.File('/foo/bar.html').modified)
+    self.assertEqual(u'f♥♥'.encode('utf-8'), files.File('/foo/bar.html').content)
+
+    # Meta-only updates don't reset the encoding.
+    files.File('/foo/bar.html').Write(u'f♥♥')
+    files.File('/foo/bar.html').Write(meta={'color': 'red'})
+    self.assertEqual(u'f♥♥', files.File('/foo/bar.html').content)
+
+    # Unchanged blob content is not uploaded again.
+    titan_file = files.File('/foo/bar.bin').Write(LARGE_FILE_CONTENT)
+    num_blobs = blobstore.BlobInfo.all().count()
+    modified = titan_file.modified
+    files.File('/foo/bar.bin').Write(LARGE_FILE_CONTENT)
+    self.assertEqual(num_blobs, blobstore.BlobInfo.all().count())
+    self.assertEqual(modified, files.File('/foo/bar.bin').modified)
+    self.assertEqual(4, files.GetSkippedWriteCount())
+
+    # Forced writes.
+    files.File('/foo/bar.bin').Write(LARGE_FILE_CONTENT, force=True)
+    self.assertNotEqual(modified, files.File('/foo/bar.bin').modified)
+    self.assertEqual(LARGE_FILE_CONTENT, files.File('/foo/bar.bin').content)
+    self.assertEqual(4, files.GetSkippedWriteCount())
+
+    # Compress arguments are only a change if they change the stored content.
+    files.File('/foo/small.html').Write('<p>Small</p>')
+    files.File('/foo/small.html').Write('<p>Small</p>', compress=True)
+    html_content = '<p>Hello, world!</p>' * 100
+    files.File('/foo/big.html').Write(html_content)
+    files.File('/foo/big.html').Write(html_content, compress=True)
+    self.assertEqual(6, files.GetSkippedWriteCount())
+    files.File('/foo/big.html').Write(html_content, compress=False)
+    self.assertEqual(6, files.GetSkippedWriteCount())
+    self.assertIsNone(files.File('/foo/big.html')._file_ent.compression)
+    self.assertEqual(html_content, files.File('/foo/big.html').content)
+
+  def testCompression(self):
+    # Compressible MIME types are compressed, if large enough.
+    html_content = '<p>Hello, world!</p>' * 100
+    titan_file = files.File('/foo/bar.html').Write(html_content)
+    self.assertEqual('zlib', titan_file._file_ent.compression)
+    self.assertEqual(zlib.compress(html_content), titan_file._file_ent.content)
+    titan_file = files.File('/foo/bar.html')
+    self.assertEqual(html_content, titan_file.content)
+    self.assertEqual(len(html_content), titan_file.size)
+    self.assertEqual(hashlib.md5(html_content).hexdigest(),
+                     titan_file.md5_hash)
+    files.File('/foo/bar.html').Write('<p>Small</p>')
+    self.assertIsNone(files.File('/foo/bar.html')._file_ent.compression)
+    files.File('/foo/bar.html').Write(u'♥' * 1000)
+    self.assertEqual(u'♥' * 1000, files.File('/foo/bar.html').content)
+
+    # Other content is only compressed if it doesn't otherwise fit inline.
+    files.File('/foo/bar.bin').Write('a' * 2000)
+    self.assertIsNone(files.File('/foo/bar.bin')._file_ent.compression)
+    large_content = 'a' * (files.MAX_CONTENT_SIZE * 2)
+    titan_file = files.File('/foo/bar.bin').Write(large_content)
+    self.assertIsNone(titan_file.blob)
+    self.assertEqual('zlib', titan_file._file_ent.compression)
+    self.assertEqual(large_content, files.File('/foo/bar.bin').content)
+    # Incompressible content of other types is not compressed in full.
+    compressed_sizes = []
+    original_compress = zlib.compress
+    def Compress(data):
+      compressed_sizes.append(len(data))
+      return original_compress(data)
+    self.stubs.Set(zlib, 'compress', Compress)
+    titan_file = files.File('/foo/bar.jpg').Write(LARGE_FILE_CONTENT)
+    self.stubs.UnsetAll()
+    self.assertTrue(titan_file.blob)
+    self.assertEqual([files.COMPRESSION_PROBE_SIZE], compressed_sizes)
+    # Only streams which will be compressed are buffered to try to fit them
+    # inline; others go to blobstore as soon as they exceed MAX_CONTENT_SIZE.
+    titan_file = files.File('/foo/stream.txt')
+    titan_file.Write(fp=cStringIO.StringIO(large_content))
+    self.assertIsNone(titan_file.blob)
+    self.assertEqual(large_content, files.File('/foo/stream.txt').content)
+    titan_file = files.File('/foo/stream.bin')
+    titan_file.Write(fp=cStringIO.StringIO(large_content))
+    self.assertTrue(titan_file.blob)
+    self.assertEqual(large_content, files.File('/foo/stream.bin').content)
+    titan_file = files.File('/foo/forced.bin')
+    titan_file.Write(fp=cStringIO.StringIO(large_content), compress=True)
+    self.assertIsNone(titan_file.blob)
+
+    # Content which doesn't shrink is stored as-is.
+    files.File('/foo/bar.html').Write(os.urandom(2000))
+    self.assertIsNone(files.File('/foo/bar.html')._file_ent.compression)
+
+    # Explicitly enabled or disabled compression.
+    files.File('/foo/bar.bin').Write('a' * 2000, compress=True)
+    self.assertEqual('zlib', files.File('/foo/bar.bin')._file_ent.compression)
+    titan_file = files.File('/foo/bar.html').Write(html_content, compress=False)
+    self.assertIsNone(titan_file._file_ent.compression)
+    titan_file = files.File('/foo/bar.bin').Write(large_content, compress=False)
+    self.assertTrue(titan_file.blob)
+    self.assertEqual(large_content, files.File('/foo/bar.bin').content)
+
+    # Compressed content can be copied.
+    files.File('/foo/bar.html').Write(html_content)
+    files.File('/foo/bar.html').CopyTo(files.File('/foo/qux.html'))
+    self.assertEqual(html_content, files.File('/foo/qux.html').content)
+
+  def testBlobDeduplication(self):
+    md5_hash = hashlib.md5(LARGE_FILE_CONTENT).hexdigest()
+    num_blobs = blobstore.BlobInfo.all().count()
+
+    # Writes of the same content share a single blob.
+    foo_file = files.File('/foo.html').Write(LARGE_FILE_CONTENT)
+    bar_file = files.File('/bar.html').Write(LARGE_FILE_CONTENT)
+    blob_key = foo_file._file_ent.blob
+    self.assertEqual(blob_key, bar_file._file_ent.blob)
+    # Duplicate streamed content is uploaded, then immediately deleted.
+    baz_file = files.File('/baz.html').Write(
+        fp=cStringIO.StringIO(LARGE_FILE_CONTENT))
+    self.assertEqual(blob_key, baz_file._file_ent.blob)
+    self.assertEqual(num_blobs + 1, blobstore.BlobInfo.all().count())
+    self.assertEqual(3, files._TitanBlobRef.get_by_id(md5_hash).ref_count)
+
+    # Rewriting the same content doesn't add references.
+    baz_file.Write(LARGE_FILE_CONTENT)
+    baz_file.Write(fp=cStringIO.StringIO(LARGE_FILE_CONTENT))
+    self.assertEqual(3, files._TitanBlobRef.get_by_id(md5_hash).ref_count)
+
+    # Deletes only remove the blob with its last reference.
+    foo_file.Delete()
+    files.Files.Get(['/bar.html']).Delete()
+    self.assertTrue(blobstore.get(blob_key))
+    self.assertEqual(LARGE_FILE_CONTENT, files.File('/baz.html').content)
+    self.assertEqual(1, files._TitanBlobRef.get_by_id(md5_hash).ref_count)
+    baz_file.Write('Small content')
+    self.assertIsNone(blobstore.get(blob_key))
+    self.assertIsNone(files._TitanBlobRef.get_by_id(md5_hash))
+
+  def testBackfillSizeAndHash(self):
+    files.File('/foo/bar.html').Write('Test')
+    files.File('/foo/baz.html').Write(LARGE_FILE_CONTENT)
+    files.File('/foo/qux.html').Write('Done')
+    # Simulate entities written before size was stored.
+    for path in ('/foo/bar.html', '/foo/baz.html'):
+      file_ent = files._TitanFile.get_by_id(path)
+      file_ent.size = None
+      file_ent.md5_hash = None
+      file_ent.put()
+    old_modified = files._TitanFile.get_by_id('/foo/bar.html').modified
+
+    # Without stored values, the properties fall back to computing them.
+    self.assertEqual(4, files.File('/foo/bar.html').size)
+    self.assertEqual(len(LARGE_FILE_CONTENT), files.File('/foo/baz.html').size)
+
+    self.assertEqual(2, files.BackfillSizeAndHash())
+    file_ent = files._TitanFile.get_by_id('/foo/bar.html')
+    self.assertEqual(4, file_ent.size)
+    self.assertEqual(hashlib.md5('Test').hexdigest(), file_ent.md5_hash)
+    self.assertEqual(old_modified, file_ent.modified)
+    file_ent = files._TitanFile.get_by_id('/foo/baz.html')
+    self.assertEqual(len(LARGE_FILE_CONTENT), file_ent.size)
+    self.assertEqual(0, files.BackfillSizeAndHash())
+
+    # Files written while the backfill runs are not reverted.
+    file_ent = files._TitanFile.get_by_id('/foo/bar.html')
+    file_ent.size = None
+    file_ent.put()
+    get_blob_sizes_and_hashes = files._GetBlobSizesAndHashes
+
+    def WriteThenGetBlobSizesAndHashes(blob_keys):
+      files.File('/foo/bar.html').Write('New content')
+      return get_blob_sizes_and_hashes(blob_keys)
+
+    self.stubs.Set(files, '_GetBlobSizesAndHashes',
+                   WriteThenGetBlobSizesAndHashes)
+    self.assertEqual(0, files.BackfillSizeAndHash())
+    self.assertEqual('New content', files.File('/foo/bar.html').content)
+    self.assertEqual(11, files.File('/foo/bar.html').size)
+    self.stubs.UnsetAll()
+
+    # Batches are chained with deferred tasks.
+    self.assertEqual(0, files.BackfillSizeAndHash(batch_size=1))
+    self.assertEqual(1, len(self.taskqueue_stub.get_filtered_tasks()))
+
+  def testWriteStream(self):
+    # Small streams are stored as content.
+    titan_file = files.File('/foo/bar.html')
+    titan_file.Write(fp=cStringIO.StringIO('foo'))
+    self.assertEqual('foo', files.File('/foo/bar.html').content)
+    self.assertIsNone(files.File('/foo/bar.html').blob)
+
+    # Large streams go directly to blobstore, hashed along the way.
+    titan_file.Write(fp=cStringIO.StringIO(LARGE_FILE_CONTENT))
+    titan_file = files.File('/foo/bar.html')
+    self.assertTrue(titan_file.blob)
+    self.assertIsNone(titan_file._file_ent.content)
+    self.assertEqual(LARGE_FILE_CONTENT, titan_file.content)
+    self.assertEqual(hashlib.md5(LARGE_FILE_CONTENT).hexdigest(),
+                     titan_file._file_ent.md5_hash)
+
+    # Iterables of chunks, including chunks larger than the append size.
+    chunks = ['a' * files.BLOBSTORE_APPEND_CHUNK_SIZE, '',
+              'b' * (files.BLOBSTORE_APPEND_CHUNK_SIZE * 2 + 1)]
+    old_blob_key = titan_file.blob.key()
+    titan_file.Write(fp=iter(chunks), meta={'color': 'blue'})
+    titan_file = files.File('/foo/bar.html')
+    self.assertEqual(''.join(chunks), titan_file.content)
+    self.assertEqual('blue', titan_file.meta.color)
+    self.assertIsNone(blobstore.get(old_blob_key))
+
+    # Error handling.
+    self.assertRaises(TypeError, titan_file.Write, content='foo',
+                      fp=cStringIO.StringIO('foo'))
+    self.assertRaises(TypeError, titan_file.Write, fp=[u'foo'])
+
+  def testWriteAsync(self):
+    # Overlap many writes.
+    paths = ['/foo/%d.html' % i for i in range(5)]
+    futures = [files.File(path).WriteAsync('foo') for path in paths]
+    ndb.Future.wait_all(futures)
+    for path, future in zip(paths, futures):
+      self.assertEqual(path, future.get_result().path)
+      self.assertEqual('foo', files.File(path).content)
+
+    # Usable inside of tasklets.
+    @ndb.tasklet
+    def WriteTwiceTasklet(titan_file):
+      yield titan_file.WriteAsync('bar')
+      yield titan_file.WriteAsync(meta={'color': 'blue'})
+      raise ndb.Return(titan_file)
+
+    WriteTwiceTasklet(files.File('/foo/bar.html')).get_result()
+    titan_file = files.File('/foo/bar.html')
+    self.assertEqual('bar', titan_file.content)
+    self.assertEqual('blue', titan_file.meta.color)
+
+    # Large content and blob replacement.
+    titan_file.WriteAsync(LARGE_FILE_CONTENT).get_result()
+    self.assertEqual(LARGE_FILE_CONTENT, files.File('/foo/bar.html').content)
+    old_blob_key = files.File('/foo/bar.html').blob
+    titan_file.WriteAsync('small').get_result()
+    self.assertIsNone(blobstore.get(old_blob_key))
+    self.assertEqual('small', files.File('/foo/bar.html').content)
+
+    # Error handling.
+    self.assertRaises(TypeError, files.File('/foo').WriteAsync)
+    future = files.File('/fake.html').WriteAsync(meta={'color': 'blue'})
+    self.assertRaises(files.BadFileError, future.get_result)
+
+  def testRead(self):
+    titan_file = files.File('/foo.txt').Write(u'f\xf6\xf6 ' * 1000)
+    self.assertEqual('f\xc3\xb6', titan_file.Read(size=3))
+    self.assertEqual('\xb6\xc3\xb6 ', titan_file.Read(offset=2, size=4))
+    self.assertEqual(' ', titan_file.Read(offset=5999))
+    self.assertEqual('', titan_file.Read(offset=6000))
+    self.assertRaises(ValueError, titan_file.Read, offset=-1)
+
+    # Blob content is read in ranges, without caching the whole blob.
+    titan_file = files.File('/foo.html').Write(LARGE_FILE_CONTENT)
+    files_cache.ClearBlobsForFiles(titan_file._file)
+    self.assertEqual(LARGE_FILE_CONTENT[100:200],
+                     titan_file.Read(offset=100, size=100))
+    self.assertEqual(LARGE_FILE_CONTENT[-10:],
+                     titan_file.Read(offset=len(LARGE_FILE_CONTENT) - 10))
+    self.assertIsNone(files_cache.GetBlob('/foo.html'))
+
+    # Seekable readers.
+    fp = titan_file.open()
+    fp.seek(1 << 20)
+    self.assertEqual(LARGE_FILE_CONTENT[1 << 20:(1 << 20) + 5], fp.read(5))
+    self.assertEqual((1 << 20) + 5, fp.tell())
+    fp = files.File('/foo.txt').open()
+    fp.seek(6)
+    self.assertEqual('f', fp.read(1))
+
+    self.assertRaises(files.BadFileError, files.File('/fake').Read)
+
   def testDelete(self):
     # Synchronous delete.
     titan_file = files.File('/foo/bar.html').Write('')
@@ -300,6 +597,20 @@ class FileTestCase(testing.BaseTestCase):
     # Error handling.
     self.assertRaises(files.BadFileError, files.File('/fake.html').Delete)
 
+  def testDeleteAsync(self):
+    files.File('/foo.html').Write('')
+    files.File('/bar.html').Write(LARGE_FILE_CONTENT)
+    blob_key = files.File('/bar.html').blob
+    ndb.Future.wait_all([files.File('/foo.html').DeleteAsync(),
+                         files.File('/bar.html').DeleteAsync()])
+    self.assertFalse(files.File('/foo.html').exists)
+    self.assertFalse(files.File('/bar.html').exists)
+    self.assertIsNone(blobstore.get(blob_key))
+
+    # Error handling.
+    future = files.File('/fake.html').DeleteAsync()
+    self.assertRaises(files.BadFileError, future.get_result)
+
   def testFileMixins(self):
     # Support behavior: subclass File and make Write() also touch a
     # centralized file, while avoiding infinite recursion.
@@ -345,9 +656,93 @@ class FileTestCase(testing.BaseTestCase):
     # Copy should overwrite previous versions and their properties.
     self.assertRaises(AttributeError, lambda: titan_file.meta.color)
 
+    # Blobs are shared by the copy, and deleted with their last reference.
+    files.File('/foo.html').Delete()
+    self.assertEqual(blob_content, files.File('/bar/qux.html').content)
+    files.File('/bar/qux.html').Delete()
+    self.assertIsNone(blobstore.get(self.blob_key))
+
+    # Copying large content doesn't upload another blob.
+    md5_hash = hashlib.md5(LARGE_FILE_CONTENT).hexdigest()
+    foo_file = files.File('/foo.html').Write(LARGE_FILE_CONTENT)
+    num_blobs = blobstore.BlobInfo.all().count()
+    foo_file.CopyTo(files.File('/bar/qux.html'))
+    titan_file = files.File('/bar/qux.html')
+    self.assertEqual(foo_file.blob.key(), titan_file.blob.key())
+    self.assertEqual(num_blobs, blobstore.BlobInfo.all().count())
+    self.assertEqual(2, files._TitanBlobRef.get_by_id(md5_hash).ref_count)
+    self.assertEqual(foo_file.md5_hash, titan_file.md5_hash)
+    self.assertEqual(len(LARGE_FILE_CONTENT), titan_file.size)
+    # Overwriting a copy of the same blob doesn't add a reference.
+    foo_file.CopyTo(files.File('/bar/qux.html'))
+    self.assertEqual(2, files._TitanBlobRef.get_by_id(md5_hash).ref_count)
+    titan_file.Write('Small content')
+    self.assertEqual(LARGE_FILE_CONTENT, files.File('/foo.html').content)
+    self.assertEqual(1, files._TitanBlobRef.get_by_id(md5_hash).ref_count)
+
     # Error handling:
     self.assertRaises(AssertionError, files.File('/foo.html').CopyTo, '/test')
 
+  def testCopyToAsync(self):
+    files.File('/foo.html').Write('Test', meta={'color': 'blue'})
+    files.File('/bar/qux.html').Write('Old', meta={'flag': False})
+    future = files.File('/foo.html').CopyToAsync(files.File('/bar/qux.html'))
+    self.assertEqual('/foo.html', future.get_result().path)
+    titan_file = files.File('/bar/qux.html')
+    self.assertEqual('Test', titan_file.content)
+    self.assertEqual('blue', titan_file.meta.color)
+    self.assertRaises(AttributeError, lambda: titan_file.meta.flag)
+
+    # Error handling.
+    self.assertRaises(AssertionError, files.File('/foo.html').CopyToAsync,
+                      '/test')
+    future = files.File('/fake.html').CopyToAsync(files.File('/bar/qux.html'))
+    self.assertRaises(files.BadFileError, future.get_result)
+
+  @testing.DisableCaching
+  def testCopyToCustomFile(self):
+
+    class CustomFile(files.File):
+
+      def Write(self, *args, **kwargs):
+        return super(CustomFile, self).Write(*args, **kwargs)
+
+    # Copies to files with custom writes share blobs with counted references.
+    md5_hash = hashlib.md5(LARGE_FILE_CONTENT).hexdigest()
+    foo_file = files.File('/foo.html').Write(LARGE_FILE_CONTENT)
+    blob_key = foo_file.blob.key()
+    custom_file = CustomFile('/bar.html').Write('Old content')
+    foo_file.CopyTo(custom_file)
+    self.assertEqual(blob_key, files.File('/bar.html').blob.key())
+    self.assertEqual(2, files._TitanBlobRef.get_by_id(md5_hash).ref_count)
+    foo_file.Delete()
+    self.assertEqual(LARGE_FILE_CONTENT, files.File('/bar.html').content)
+    CustomFile('/bar.html').Delete()
+    self.assertIsNone(blobstore.get(blob_key))
+
+  @testing.DisableCaching
+  def testWriteSharedBlob(self):
+    # Writing a BlobKey directly adds a reference to it.
+    foo_file = files.File('/foo.html').Write(LARGE_FILE_CONTENT)
+    blob_key = foo_file.blob.key()
+    files.File('/bar.html').Write(blob=blob_key)
+    files.Files.WriteMulti({'/baz.html': {'blob': blob_key}})
+    foo_file.Delete()
+    self.assertEqual(LARGE_FILE_CONTENT, files.File('/bar.html').content)
+    files.File('/bar.html').Write('Small content')
+    self.assertEqual(LARGE_FILE_CONTENT, files.File('/baz.html').content)
+    files.File('/baz.html').Delete()
+    self.assertIsNone(blobstore.get(blob_key))
+
+    # So does writing a blob which isn't reference counted yet.
+    blob_content = self.blob_reader.read()
+    files.File('/foo.html').Write(blob=self.blob_key)
+    files.File('/bar.html').Write(blob=self.blob_key)
+    files.File('/foo.html').Delete()
+    self.assertEqual(blob_content, files.File('/bar.html').content)
+    files.File('/bar.html').Delete()
+    self.assertIsNone(blobstore.get(self.blob_key))
+
   def testRegisterFileFactory(self):
 
     class FooFile(files.File):
@@ -469,6 +864,71 @@ class FilesTestCase(testing.BaseTestCase):
     self.assertRaises(ValueError, files.Files.List, '/',
                       recursive=True, depth=0)
 
+  def testLazyBatchLoading(self):
+    paths = ['/foo%d' % i for i in range(25)]
+    for path in paths:
+      files.File(path).Write('')
+    titan_files = files.Files(paths, batch_size=10)
+    self.assertFalse(any([f.is_loaded for f in titan_files.values()]))
+
+    # Touching one file's property loads its whole batch with one RPC.
+    counts_before = files.GetBatchLoadCounts()
+    first_file = titan_files.values()[0]
+    _ = first_file.modified
+    num_loaded = len([f for f in titan_files.values() if f.is_loaded])
+    self.assertEqual(10, num_loaded)
+    counts = files.GetBatchLoadCounts()
+    self.assertEqual(1, counts['batches'] - counts_before['batches'])
+    self.assertEqual(9, counts['rpcs_saved'] - counts_before['rpcs_saved'])
+
+    # Touching every file only makes one RPC per batch.
+    for titan_file in titan_files.values():
+      _ = titan_file.meta
+    counts = files.GetBatchLoadCounts()
+    self.assertEqual(3, counts['batches'] - counts_before['batches'])
+    self.assertEqual(25, counts['files'] - counts_before['files'])
+
+    # batch_size=None loads the whole container at once.
+    titan_files = files.Files(paths + ['/fake'], batch_size=None)
+    _ = titan_files['/foo0'].mime_type
+    self.assertEqual(25, len([f for f in titan_files.values() if f.is_loaded]))
+    self.assertFalse(titan_files['/fake'].exists)
+
+  def testIterList(self):
+    paths = ['/foo/%d' % i for i in range(25)] + ['/foo/bar/baz']
+    for path in paths:
+      files.File(path).Write('')
+
+    # Pages are loaded and cover all files exactly once.
+    pages = list(files.Files.IterList('/foo', recursive=True, batch_size=10))
+    self.assertEqual([10, 10, 6], [len(page) for page, _ in pages])
+    listed_paths = []
+    for titan_files, _ in pages:
+      self.assertTrue(all([f.is_loaded for f in titan_files.values()]))
+      listed_paths.extend(titan_files.keys())
+    self.assertSameElements(paths, listed_paths)
+    # The last page has no cursor.
+    self.assertIsNotNone(pages[0][1])
+    self.assertIsNone(pages[-1][1])
+
+    # Non-recursive.
+    pages = list(files.Files.IterList('/foo/bar', batch_size=10))
+    self.assertEqual(1, len(pages))
+    self.assertEqual(files.Files(['/foo/bar/baz']), pages[0][0])
+
+    # Resume from a urlsafe cursor.
+    cursor = list(files.Files.IterList(
+        '/foo', recursive=True, batch_size=20))[0][1]
+    pages = list(files.Files.IterList(
+        '/foo', recursive=True, batch_size=20, cursor=cursor.urlsafe()))
+    self.assertEqual(1, len(pages))
+    self.assertEqual(6, len(pages[0][0]))
+
+    # Error handling.
+    self.assertRaises(ValueError, list, files.Files.IterList('/', batch_size=0))
+    self.assertRaises(ValueError, list,
+                      files.Files.IterList('/', recursive=True, depth=0))
+
   def testGet(self):
     files.File('/foo').Write('')
     files.File('/bar').Write('')
@@ -480,6 +940,17 @@ class FilesTestCase(testing.BaseTestCase):
     # Error handling.
     self.assertRaises(ValueError, files.Files.Get, '/foo')
 
+  def testGetAsync(self):
+    files.File('/foo').Write('')
+    files.File('/bar').Write('')
+    future = files.Files.GetAsync(['/foo', '/bar', '/fake'])
+    titan_files = future.get_result()
+    self.assertEqual(['/bar', '/foo'], sorted(titan_files))
+    self.assertTrue(titan_files['/foo'].is_loaded)
+
+    # Error handling.
+    self.assertRaises(ValueError, files.Files.GetAsync, '/foo')
+
   def testDelete(self):
     files.File('/foo').Write('')
     files.File('/bar').Write('')
@@ -492,8 +963,154 @@ class FilesTestCase(testing.BaseTestCase):
     files.Files.Get(['/foo']).Delete()
     self.assertEqual(files.Files([]), files.Files.Get(['/foo']))
 
+    # Blobs and blob caches are deleted with the files.
+    titan_file = files.File('/foo').Write(LARGE_FILE_CONTENT)
+    blob_key = titan_file.blob.key()
+    files.Files(['/foo', '/qux']).Delete()
+    self.assertIsNone(blobstore.get(blob_key))
+    self.assertIsNone(files_cache.GetBlob('/foo'))
+    self.assertEqual(files.Files([]), files.Files.Get(['/foo', '/qux']))
+
     # Error handling.
+    files.File('/qux').Write('')
     self.assertRaises(files.BadFileError, files.Files(['/fake', '/qux']).Delete)
+    # Nothing should be deleted if any file doesn't exist.
+    self.assertTrue(files.File('/qux').exists)
+
+  def testWriteMulti(self):
+    files.File('/foo').Write('foo', meta={'color': 'blue'})
+    counts_before = files.GetBatchLoadCounts()
+    titan_files = files.Files.WriteMulti({
+        '/foo': {'meta': {'color': 'red'}},
+        '/bar': {'content': 'bar', 'mime_type': 'text/css'},
+        '/large': {'content': LARGE_FILE_CONTENT},
+    })
+    self.assertEqual(files.Files(['/foo', '/bar', '/large']), titan_files)
+    # Existence of every file was checked with one RPC.
+    counts = files.GetBatchLoadCounts()
+    self.assertEqual(1, counts['batches'] - counts_before['batches'])
+    self.assertEqual(3, counts['files'] - counts_before['files'])
+
+    self.assertEqual('foo', files.File('/foo').content)
+    self.assertEqual('red', files.File('/foo').meta.color)
+    self.assertEqual('bar', files.File('/bar').content)
+    self.assertEqual('text/css', files.File('/bar').mime_type)
+    self.assertEqual(LARGE_FILE_CONTENT, files.File('/large').content)
+    self.assertTrue(files.File('/large').blob)
+    self.assertEqual(LARGE_FILE_CONTENT, files_cache.GetBlob('/large'))
+
+    # Large content is uploaded to blobstore concurrently.
+    files_data = dict(('/large%d' % i, {'content': LARGE_FILE_CONTENT + str(i)})
+                      for i in range(3))
+    num_started = []
+    all_started = threading.Event()
+    original_write_blob = files._WriteBlob
+    def WriteBlob(chunks):
+      num_started.append(1)
+      if len(num_started) == len(files_data):
+        all_started.set()
+      # Each upload waits for the others to start, or gives up on timeout.
+      all_started.wait(5)
+      return original_write_blob(chunks)
+    self.stubs.Set(files, '_WriteBlob', WriteBlob)
+    files.Files.WriteMulti(files_data)
+    self.stubs.UnsetAll()
+    self.assertTrue(all_started.is_set())
+    for path, write_kwargs in files_data.iteritems():
+      self.assertEqual(write_kwargs['content'], files.File(path).content)
+
+    # A single large write uploads its content without a separate thread.
+    self.stubs.Set(files, '_WriteBlobAsync', None)
+    files.Files.WriteMulti({'/single': {'content': LARGE_FILE_CONTENT + 'a'}})
+    files.File('/single').Write(LARGE_FILE_CONTENT + 'b')
+    self.stubs.UnsetAll()
+    self.assertEqual(LARGE_FILE_CONTENT + 'b', files.File('/single').content)
+
+    # Unchanged files are skipped.
+    skipped_before = files.GetSkippedWriteCount()
+    files.Files.WriteMulti({'/foo': {'content': 'foo'}})
+    self.assertEqual(1, files.GetSkippedWriteCount() - skipped_before)
+
+    # Error handling.
+    self.assertRaises(TypeError, files.Files.WriteMulti, {'/foo': {}})
+    self.assertRaises(files.BadFileError, files.Files.WriteMulti, {
+        '/qux': {'content': 'qux'},
+        '/fake': {'meta': {'color': 'blue'}},
+    })
+    # Nothing should be written if any write is invalid.
+    self.assertFalse(files.File('/qux').exists)
+
+  def testLoad(self):
+    files.File('/foo').Write('')
+    files.File('/bar').Write('')
+    titan_files = files.Files(['/foo', '/bar', '/fake'])
+    self.assertFalse(any([f.is_loaded for f in titan_files.values()]))
+    titan_files.Load()
+    self.assertEqual(files.Files(['/foo', '/bar']), titan_files)
+    self.assertTrue(all([f.is_loaded for f in titan_files.values()]))
+
+    # Already-loaded files should be reused, not re-fetched.
+    loaded_file = titan_files['/foo']
+    file_ent = loaded_file._file
+    titan_files.Load()
+    self.assertIs(file_ent, loaded_file._file)
+
+  def testReadContents(self):
+    files.File('/foo').Write('foo')
+    files.File('/bar.txt').Write(u'b\xe4r')
+    files.File('/large').Write(LARGE_FILE_CONTENT)
+    files.File('/large2').Write(LARGE_FILE_CONTENT[::-1])
+    expected_contents = {
+        '/foo': 'foo',
+        '/bar.txt': u'b\xe4r',
+        '/large': LARGE_FILE_CONTENT,
+        '/large2': LARGE_FILE_CONTENT[::-1],
+    }
+    titan_files = files.Files.Get(expected_contents.keys())
+    self.assertEqual(expected_contents, titan_files.ReadContents())
+
+    # Blob content is now cached, and is read from the cache.
+    self.assertEqual(LARGE_FILE_CONTENT, files_cache.GetBlob('/large'))
+    self.mox.StubOutWithMock(files, '_ReadBlobContent')
+    self.mox.ReplayAll()
+    self.assertEqual(expected_contents, titan_files.ReadContents())
+    self.mox.VerifyAll()
+
+  def testFillBlobCache(self):
+    self.stubs.SmartSet(files_cache, 'BLOB_LEASE_WAIT_SECONDS', 0)
+    files.File('/large').Write(LARGE_FILE_CONTENT)
+    files_cache.ClearBlobsForFiles(files.File('/large')._file)
+
+    # While another request holds the lease, content is read without caching.
+    lease = files_cache.AcquireBlobLease('/large')
+    self.assertTrue(lease)
+    self.assertIsNone(files_cache.AcquireBlobLease('/large'))
+    self.assertEqual(LARGE_FILE_CONTENT, files.File('/large').content)
+    self.assertIsNone(files_cache.GetBlob('/large'))
+
+    # Once released, the next read takes the lease and fills the cache.
+    files_cache.ReleaseBlobLease('/large', lease)
+    self.assertEqual(LARGE_FILE_CONTENT, files.File('/large').content)
+    self.assertEqual(LARGE_FILE_CONTENT, files_cache.GetBlob('/large'))
+    self.assertTrue(files_cache.AcquireBlobLease('/large'))
+
+  def testStaleWhileRevalidate(self):
+    self.stubs.SmartSet(files_cache, 'BLOB_FRESH_SECONDS', 60)
+    self.stubs.SmartSet(files_cache, 'BLOB_STALE_SECONDS', 60)
+    files.File('/large').Write(LARGE_FILE_CONTENT)
+    files_cache.StoreBlob('/large', 'stale')
+    self.assertEqual('stale', files.File('/large').content)
+
+    # Once stale, content is served while another request refreshes it.
+    now = sharded_cache._Now()
+    self.stubs.Set(sharded_cache, '_Now', lambda: now + 61)
+    lease = files_cache.AcquireBlobLease('/large')
+    self.assertEqual('stale', files.File('/large').content)
+
+    # Otherwise, the request refreshes it.
+    files_cache.ReleaseBlobLease('/large', lease)
+    self.assertEqual(LARGE_FILE_CONTENT, files.File('/large').content)
+    self.assertEqual(LARGE_FILE_CONTENT, files_cache.GetBlob('/large'))
 
 #-------------------------------------------------------------------------------
 # YARR, THERE BE DEPRECATED CODE BELOW. Will be removed!
@@ -877,6 +1494,31 @@ class DeprecatedFileTestCase(testing.BaseTestCase):
     self.assertRaises(files.BadFileError, files.Delete, '/fake.html')
     self.assertRaises(files.BadFileError, files.Delete, ['/fake.html'])
 
+  @testing.DisableCaching
+  def testDeduplicatedBlobs(self):
+    md5_hash = hashlib.md5(LARGE_FILE_CONTENT).hexdigest()
+    files.File('/foo.html').Write(LARGE_FILE_CONTENT)
+    files.File('/bar.html').Write(LARGE_FILE_CONTENT)
+    files.File('/baz.html').Write(LARGE_FILE_CONTENT)
+    blob_key = files.File('/foo.html')._file.blob
+
+    # Deleting one of the files must not delete the shared blob.
+    files.Delete('/foo.html')
+    self.assertTrue(blobstore.get(blob_key))
+    self.assertEqual(LARGE_FILE_CONTENT, files.File('/bar.html').content)
+    self.assertEqual(2, files._TitanBlobRef.get_by_id(md5_hash).ref_count)
+
+    # Neither may overwriting one of the files.
+    files.Write('/bar.html', content='Small content')
+    self.assertTrue(blobstore.get(blob_key))
+    self.assertEqual(LARGE_FILE_CONTENT, files.File('/baz.html').content)
+    self.assertEqual(1, files._TitanBlobRef.get_by_id(md5_hash).ref_count)
+
+    # The blob is deleted with its last reference.
+    files.Delete(['/bar.html', '/baz.html'])
+    self.assertIsNone(blobstore.get(blob_key))
+    self.assertIsNone(files._TitanBlobRef.get_by_id(md5_hash))
+
   @testing.DisableCaching
   def testTouch(self):
     old_file = files.Write('/foo/bar.html', content='Test')
@@ -907,6 +1549,28 @@ class DeprecatedFileTestCase(testing.BaseTestCase):
     self.assertRaises(ValueError, files.Touch, '')
     self.assertRaises(ValueError, files.Touch, 'root-file')
 
+  def testInvalidateFileEntities(self):
+    invalidated_paths = []
+    self.stubs.Set(files_cache, 'InvalidateFileEntities',
+                   invalidated_paths.extend)
+
+    # Cached entities are invalidated once each datastore RPC is done.
+    rpc = files.Write('/foo.html', content='foo', async=True)
+    rpc.get_result()
+    self.assertEqual(['/foo.html'], invalidated_paths)
+
+    rpc = files.Write('/foo.html', content='bar', async=True)
+    rpc.get_result()
+    self.assertEqual(['/foo.html'] * 2, invalidated_paths)
+
+    rpc = files.Touch(['/foo.html'], async=True)
+    rpc.get_result()
+    self.assertEqual(['/foo.html'] * 3, invalidated_paths)
+
+    rpc = files.Delete('/foo.html', async=True)
+    rpc.get_result()
+    self.assertEqual(['/foo.html'] * 4, invalidated_paths)
+
   @testing.DisableCaching
   def testCopy(self):
     files.Write('/foo.html', 'Test', mime_type='test/mimetype',
@@ -931,6 +1595,19 @@ class DeprecatedFileTestCase(testing.BaseTestCase):
     # Copy should overwrite previous versions and their properties.
     self.assertRaises(AttributeError, lambda: file_obj.color)
 
+    # Copies share the source's blob, which outlives the deleted source.
+    files.File('/foo.html').Write(LARGE_FILE_CONTENT)
+    files.File('/foo.html').CopyTo(files.File('/bar/baz.html'))
+    files.Copy('/foo.html', '/bar/qux.html')
+    blob_key = files.File('/foo.html')._file.blob
+    files.Delete('/foo.html')
+    self.assertEqual(LARGE_FILE_CONTENT, files.Get('/bar/baz.html').content)
+    self.assertEqual(LARGE_FILE_CONTENT, files.Get('/bar/qux.html').content)
+    files.Delete('/bar/baz.html')
+    self.assertEqual(LARGE_FILE_CONTENT, files.Get('/bar/qux.html').content)
+    files.Delete('/bar/qux.html')
+    self.assertIsNone(blobstore.get(blob_key))
+
   @testing.DisableCaching
   def testCopyDir(self):
     files.Touch('/foo/a.html')
@@ -1111,7 +1788,7 @@ class DeprecatedFileTestCase(testing.BaseTestCase):
     memcache.flush_all()
     self.assertIsNone(memcache.get('/foo'))
     file_obj = files.Get('/foo')
-    cache_item = memcache.get(files_cache.FILE_MEMCACHE_PREFIX + '/foo')
+    cache_item = memcache.get(files_cache._GetFileCacheKey('/foo'))
     self.assertEntityEqual(file_obj._file, cache_item)
 
     # Write of new file: should add to memcache.
@@ -1119,14 +1796,14 @@ class DeprecatedFileTestCase(testing.BaseTestCase):
     file_obj = files.DeprecatedFile('/foo/bar')
     self.assertIsNone(memcache.get('/foo/bar'))
     file_obj.Write('Test')
-    cache_item = memcache.get(files_cache.FILE_MEMCACHE_PREFIX + '/foo/bar')
+    cache_item = memcache.get(files_cache._GetFileCacheKey('/foo/bar'))
     self.assertEntityEqual(file_obj._file, cache_item)
 
     # Write with changes: should update memcache.
     file_obj = files.DeprecatedFile('/foo/bar')
     self.assertIsNone(memcache.get('/foo/bar'))
     file_obj.Write('New content')
-    cache_item = memcache.get(files_cache.FILE_MEMCACHE_PREFIX + '/foo/bar')
+    cache_item = memcache.get(files_cache._GetFileCacheKey('/foo/bar'))
     self.assertEntityEqual(file_obj._file, cache_item)
     self.assertEqual('New content', cache_item.content)
 
@@ -1134,17 +1811,17 @@ class DeprecatedFileTestCase(testing.BaseTestCase):
     memcache.flush_all()
     files.Touch(['/foo', '/bar'])
     files.Delete(['/foo', '/bar'])
-    cache_item = memcache.get(files_cache.FILE_MEMCACHE_PREFIX + '/foo')
+    cache_item = memcache.get(files_cache._GetFileCacheKey('/foo'))
     self.assertEqual(files_cache._NO_FILE_FLAG, cache_item)
-    cache_item = memcache.get(files_cache.FILE_MEMCACHE_PREFIX + '/bar')
+    cache_item = memcache.get(files_cache._GetFileCacheKey('/bar'))
     self.assertEqual(files_cache._NO_FILE_FLAG, cache_item)
 
     # Touch: should update file memcache.
     memcache.flush_all()
     files.Touch(['/foo', '/bar'])
-    cache_item = memcache.get(files_cache.FILE_MEMCACHE_PREFIX + '/foo')
+    cache_item = memcache.get(files_cache._GetFileCacheKey('/foo'))
     self.assertEntityEqual(files.DeprecatedFile('/foo')._file, cache_item)
-    cache_item = memcache.get(files_cache.FILE_MEMCACHE_PREFIX + '/bar')
+    cache_item = memcache.get(files_cache._GetFileCacheKey('/bar'))
     self.assertEntityEqual(files.DeprecatedFile('/bar')._file, cache_item)
 
     # ListDir: should set subdir caches for entire subtree.
@@ -1152,20 +1829,20 @@ class DeprecatedFileTestCase(testing.BaseTestCase):
     # After ListDir, subdir caches should be populated.
     files.Touch('/foo/bar/baz.html')
     files.ListDir('/foo')
-    self.assertIsNone(memcache.get(files_cache.DIR_MEMCACHE_PREFIX + '/'))
+    self.assertIsNone(memcache.get(files_cache._GetDirCacheKey('/')))
     self.assertIsNone(
-        memcache.get(files_cache.DIR_MEMCACHE_PREFIX + '/foo/bar'))
-    cache_item = memcache.get(files_cache.DIR_MEMCACHE_PREFIX + '/foo')
+        memcache.get(files_cache._GetDirCacheKey('/foo/bar')))
+    cache_item = memcache.get(files_cache._GetDirCacheKey('/foo'))
     self.assertEqual(set(['bar']), cache_item['subdirs'])
     files.ListDir('/')
-    cache_item = memcache.get(files_cache.DIR_MEMCACHE_PREFIX + '/')
+    cache_item = memcache.get(files_cache._GetDirCacheKey('/'))
     self.assertEqual(set(['foo']), cache_item['subdirs'])
 
     # Write: subdir caches should be updated.
     memcache.flush_all()
     files.Touch('/foo/bar/baz.html')
     files.ListDir('/')
-    cache_item = memcache.get(files_cache.DIR_MEMCACHE_PREFIX + '/foo')
+    cache_item = memcache.get(files_cache._GetDirCacheKey('/foo'))
     self.assertEqual(set(['bar']), cache_item['subdirs'])
 
     # Write blob: should store in sharded cache.
@@ -1186,8 +1863,8 @@ class DeprecatedFileTestCase(testing.BaseTestCase):
     files.Touch('/foo/bar/baz.html')
     files.ListDir('/')
     files.Delete('/foo/bar/baz.html', update_subdir_caches=True)
-    self.assertEqual({}, memcache.get(files_cache.DIR_MEMCACHE_PREFIX + '/foo'))
-    self.assertEqual({}, memcache.get(files_cache.DIR_MEMCACHE_PREFIX + '/'))
+    self.assertEqual({}, memcache.get(files_cache._GetDirCacheKey('/foo')))
+    self.assertEqual({}, memcache.get(files_cache._GetDirCacheKey('/')))
     files.Touch('/foo/bar/baz.html')
     files.Delete([files.DeprecatedFile('/foo/bar/baz.html')],
                  update_subdir_caches=True)
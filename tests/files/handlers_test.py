@@ -17,13 +17,17 @@
 
 from tests.common import testing
 
+import base64
+import cStringIO
 import hashlib
 try:
   import json
 except ImportError:
   import simplejson as json
+import os
 import time
 import urllib
+import zlib
 import webtest
 from google.appengine.api import blobstore
 from titan.common.lib.google.apputils import basetest
@@ -31,8 +35,9 @@ from tests.common import webapp_testing
 from titan.files import files
 from titan.files import handlers
 
-# Content which will be stored in blobstore.
-LARGE_FILE_CONTENT = 'a' * (files.MAX_CONTENT_SIZE + 1)
+# Content which will be stored in blobstore. Random, so that it cannot be
+# compressed to fit in the datastore.
+LARGE_FILE_CONTENT = os.urandom(files.MAX_CONTENT_SIZE + 1)
 
 class HandlersTest(testing.BaseTestCase):
 
@@ -145,6 +150,240 @@ class HandlersTest(testing.BaseTestCase):
                             expect_errors=True)
     self.assertEqual(404, response.status_int)
 
+  def testFileReadHandlerRanges(self):
+    files.File('/foo/bar').Write('foobar')
+    response = self.app.get('/_titan/file/read', {'path': '/foo/bar'},
+                            headers={'Range': 'bytes=1-3'})
+    self.assertEqual(206, response.status_int)
+    self.assertEqual('oob', response.body)
+    self.assertEqual('bytes 1-3/6', response.headers['Content-Range'])
+    self.assertEqual('bytes', response.headers['Accept-Ranges'])
+
+    # Open-ended and suffix ranges.
+    response = self.app.get('/_titan/file/read', {'path': '/foo/bar'},
+                            headers={'Range': 'bytes=4-'})
+    self.assertEqual('ar', response.body)
+    response = self.app.get('/_titan/file/read', {'path': '/foo/bar'},
+                            headers={'Range': 'bytes=-2'})
+    self.assertEqual('ar', response.body)
+    self.assertEqual('bytes 4-5/6', response.headers['Content-Range'])
+
+    # Malformed and multiple ranges are ignored.
+    response = self.app.get('/_titan/file/read', {'path': '/foo/bar'},
+                            headers={'Range': 'bytes=0-1,3-4'})
+    self.assertEqual(200, response.status_int)
+    self.assertEqual('foobar', response.body)
+
+    # Unsatisfiable ranges.
+    response = self.app.get('/_titan/file/read', {'path': '/foo/bar'},
+                            headers={'Range': 'bytes=6-'}, expect_errors=True)
+    self.assertEqual(416, response.status_int)
+    self.assertEqual('bytes */6', response.headers['Content-Range'])
+
+    # Blob ranges are passed on to blobstore.
+    files.File('/foo/bar').Write(LARGE_FILE_CONTENT)
+    response = self.app.get('/_titan/file/read', {'path': '/foo/bar'},
+                            headers={'Range': 'bytes=100-199'})
+    self.assertEqual('bytes=100-199',
+                     response.headers['X-AppEngine-BlobRange'])
+
+  def testResponseCompression(self):
+    content = 'foobar' * 1000
+    files.File('/foo/bar.txt').Write(content)
+    response = self.app.get('/_titan/file/read', {'path': '/foo/bar.txt'})
+    self.assertNotIn('Content-Encoding', response.headers)
+    self.assertEqual(content, response.body)
+
+    # Content stored compressed is served without recompressing it.
+    response = self.app.get('/_titan/file/read', {'path': '/foo/bar.txt'},
+                            headers={'Accept-Encoding': 'gzip, deflate'})
+    self.assertEqual('deflate', response.headers['Content-Encoding'])
+    self.assertEqual('Accept-Encoding', response.headers['Vary'])
+    self.assertTrue(response.headers['ETag'].startswith('W/"'))
+    self.assertEqual(content, zlib.decompress(response.body))
+    response = self.app.get('/_titan/file/read', {'path': '/foo/bar.txt'},
+                            headers={'Accept-Encoding': 'gzip'})
+    self.assertEqual('gzip', response.headers['Content-Encoding'])
+    self.assertEqual(content,
+                     zlib.decompress(response.body, 16 + zlib.MAX_WBITS))
+
+    # Compressed content still matches conditional requests.
+    response = self.app.get(
+        '/_titan/file/read', {'path': '/foo/bar.txt'},
+        headers={'Accept-Encoding': 'gzip',
+                 'If-None-Match': response.headers['ETag']})
+    self.assertEqual(304, response.status_int)
+
+    # Ranges are never compressed.
+    response = self.app.get('/_titan/file/read', {'path': '/foo/bar.txt'},
+                            headers={'Accept-Encoding': 'gzip',
+                                     'Range': 'bytes=0-5'})
+    self.assertNotIn('Content-Encoding', response.headers)
+    self.assertEqual('foobar', response.body)
+
+    # JSON responses, including streamed listings.
+    for i in range(50):
+      files.File('/foo/%d.txt' % i).Write('')
+    response = self.app.get('/_titan/listfiles', {'path': '/foo'},
+                            headers={'Accept-Encoding': 'gzip'})
+    self.assertEqual('gzip', response.headers['Content-Encoding'])
+    file_objs = json.loads(zlib.decompress(response.body, 16 + zlib.MAX_WBITS))
+    self.assertEqual(51, len(file_objs))
+    response = self.app.get('/_titan/files', {'path': '/foo/bar.txt'},
+                            headers={'Accept-Encoding': 'deflate'})
+    self.assertEqual('deflate', response.headers['Content-Encoding'])
+    self.assertIn('/foo/bar.txt', json.loads(zlib.decompress(response.body)))
+
+  def testFilesHandler(self):
+    files.File('/foo').Write('foo')
+    files.File('/bar').Write('bar')
+    response = self.app.get('/_titan/files', [
+        ('path', '/foo'), ('path', '/bar'), ('path', '/fake')])
+    self.assertEqual(200, response.status_int)
+    data = json.loads(response.body)
+    self.assertEqual(set(['/foo', '/bar']), set(data))
+    self.assertEqual(hashlib.md5('foo').hexdigest(), data['/foo']['md5_hash'])
+    response = self.app.get('/_titan/files', [
+        ('path', '/foo'), ('fields', 'path,size,md5_hash')])
+    self.assertEqual({'/foo': {
+        'path': '/foo',
+        'size': 3,
+        'md5_hash': hashlib.md5('foo').hexdigest(),
+    }}, json.loads(response.body))
+
+    # Content is only included for files which are small enough to batch.
+    files.File('/large').Write(LARGE_FILE_CONTENT)
+    response = self.app.get('/_titan/files', [
+        ('path', '/foo'), ('path', '/large'), ('full', '1')])
+    data = json.loads(response.body)
+    self.assertEqual('foo', data['/foo']['content'])
+    self.assertNotIn('content', data['/large'])
+    self.assertEqual(len(LARGE_FILE_CONTENT), data['/large']['size'])
+    response = self.app.get('/_titan/files', [
+        ('path', '/large'), ('fields', 'path,content')])
+    self.assertEqual({'/large': {'path': '/large'}}, json.loads(response.body))
+
+    # Batch writes.
+    params = {'files': json.dumps({
+        '/foo': {'meta': {'color': 'blue'}},
+        '/qux.html': {'content': base64.b64encode('\x00qux'),
+                      'mime_type': 'text/html'},
+    })}
+    response = self.app.post('/_titan/files', params)
+    self.assertEqual(201, response.status_int)
+    self.assertEqual('blue', files.File('/foo').meta.color)
+    self.assertEqual('\x00qux', files.File('/qux.html').content)
+    self.assertEqual('text/html', files.File('/qux.html').mime_type)
+
+    # Error handling.
+    params = {'files': json.dumps({'/fake': {'meta': {'color': 'blue'}}})}
+    response = self.app.post('/_titan/files', params, expect_errors=True)
+    self.assertEqual(404, response.status_int)
+    params = {'files': json.dumps({'/foo': {}})}
+    response = self.app.post('/_titan/files', params, expect_errors=True)
+    self.assertEqual(400, response.status_int)
+    response = self.app.post('/_titan/files', {'files': 'invalid'},
+                             expect_errors=True)
+    self.assertEqual(400, response.status_int)
+    response = self.app.post('/_titan/files', {'files': json.dumps(['/foo'])},
+                             expect_errors=True)
+    self.assertEqual(400, response.status_int)
+    params = {'files': json.dumps({'/foo': 'content'})}
+    response = self.app.post('/_titan/files', params, expect_errors=True)
+    self.assertEqual(400, response.status_int)
+    params = {'files': json.dumps({'/foo': {'content': base64.b64encode('')}}),
+              'file_params': json.dumps({'_foo': 1})}
+    response = self.app.post('/_titan/files', params, expect_errors=True)
+    self.assertEqual(400, response.status_int)
+    response = self.app.get('/_titan/files', {'path': 'invalid'},
+                            expect_errors=True)
+    self.assertEqual(400, response.status_int)
+    params = [('path', '/foo'), ('file_params', json.dumps({'_foo': 1}))]
+    response = self.app.get('/_titan/files', params, expect_errors=True)
+    self.assertEqual(400, response.status_int)
+
+  def testFilesReadHandler(self):
+    files.File('/foo').Write('foo')
+    files.File('/bar.txt').Write(u'b\xe4r')
+    response = self.app.get('/_titan/files/read', [
+        ('path', '/bar.txt'), ('path', '/fake'), ('path', '/foo')])
+    self.assertEqual(200, response.status_int)
+    fp = cStringIO.StringIO(response.body)
+    contents = {}
+    for _ in range(2):
+      header = json.loads(fp.readline())
+      contents[header['path']] = fp.read(header['size'])
+    self.assertEqual('', fp.read())
+    self.assertEqual({'/foo': 'foo', '/bar.txt': 'b\xc3\xa4r'}, contents)
+
+    # Large files are listed without their content.
+    files.File('/large').Write(LARGE_FILE_CONTENT)
+    response = self.app.get('/_titan/files/read', [
+        ('path', '/large'), ('path', '/foo')])
+    fp = cStringIO.StringIO(response.body)
+    self.assertEqual({
+        'path': '/large',
+        'mime_type': 'application/octet-stream',
+        'size': len(LARGE_FILE_CONTENT),
+        'content_omitted': True,
+    }, json.loads(fp.readline()))
+    header = json.loads(fp.readline())
+    self.assertEqual('/foo', header['path'])
+    self.assertEqual('foo', fp.read(header['size']))
+    self.assertEqual('', fp.read())
+
+    # Error handling.
+    params = [('path', '/foo'), ('file_params', json.dumps({'_foo': 1}))]
+    response = self.app.get('/_titan/files/read', params, expect_errors=True)
+    self.assertEqual(400, response.status_int)
+
+  def testConditionalGets(self):
+    files.File('/foo/bar').Write('foobar')
+    etag = '"%s"' % hashlib.md5('foobar').hexdigest()
+    response = self.app.get('/_titan/file/read', {'path': '/foo/bar'})
+    self.assertEqual(etag, response.headers['ETag'])
+    self.assertEqual('no-cache', response.headers['Cache-Control'])
+    last_modified = response.headers['Last-Modified']
+
+    # Matching validators get a 304 without content.
+    response = self.app.get('/_titan/file/read', {'path': '/foo/bar'},
+                            headers={'If-None-Match': 'W/"x", %s' % etag})
+    self.assertEqual(304, response.status_int)
+    self.assertEqual('', response.body)
+    self.assertEqual(etag, response.headers['ETag'])
+    response = self.app.get('/_titan/file/read', {'path': '/foo/bar'},
+                            headers={'If-Modified-Since': last_modified})
+    self.assertEqual(304, response.status_int)
+    # If-None-Match takes precedence over If-Modified-Since.
+    response = self.app.get('/_titan/file/read', {'path': '/foo/bar'},
+                            headers={'If-None-Match': '"stale"',
+                                     'If-Modified-Since': last_modified})
+    self.assertEqual(200, response.status_int)
+    self.assertEqual('foobar', response.body)
+
+    # Per-prefix Cache-Control.
+    self.stubs.Set(handlers, 'CACHE_CONTROL_BY_PATH_PREFIX', {
+        '/': 'private',
+        '/foo/': 'public, max-age=300',
+    })
+    response = self.app.get('/_titan/file/read', {'path': '/foo/bar'})
+    self.assertEqual('public, max-age=300', response.headers['Cache-Control'])
+
+    # Metadata changes change the metadata ETag, but not the content ETag.
+    response = self.app.get('/_titan/file', {'path': '/foo/bar'})
+    metadata_etag = response.headers['ETag']
+    self.assertNotEqual(etag, metadata_etag)
+    response = self.app.get('/_titan/file', {'path': '/foo/bar'},
+                            headers={'If-None-Match': metadata_etag})
+    self.assertEqual(304, response.status_int)
+    files.File('/foo/bar').Write(meta={'color': 'blue'})
+    response = self.app.get('/_titan/file', {'path': '/foo/bar'},
+                            headers={'If-None-Match': metadata_etag})
+    self.assertEqual(200, response.status_int)
+    response = self.app.get('/_titan/file/read', {'path': '/foo/bar'},
+                            headers={'If-None-Match': etag})
+    self.assertEqual(304, response.status_int)
+
   def testWriteBlob(self):
     # Verify getting a new blob upload URL.
     response = self.app.get('/_titan/file/newblob', {'path': '/foo/bar'})
@@ -443,6 +682,22 @@ class DeprecatedHandlersTest(webapp_testing.WebAppTestCase,
     self.assertSameElements(
         expected, [file_obj['path'] for file_obj in file_objs])
 
+    # Verify the fields param limits the serialized properties.
+    response = self.Get(handlers.ListFilesHandler, params={
+        'path': '/',
+        'recursive': 'hellyes',
+        'fields': 'path,mime_type,fake',
+    })
+    file_objs = json.loads(response.out.getvalue())
+    self.assertSameElements(
+        expected, [file_obj['path'] for file_obj in file_objs])
+    for file_obj in file_objs:
+      self.assertEqual(set(['path', 'mime_type']), set(file_obj))
+
+    # Verify empty listings are still valid JSON.
+    response = self.Get(handlers.ListFilesHandler, params={'path': '/fake'})
+    self.assertEqual([], json.loads(response.out.getvalue()))
+
   def testListDir(self):
     # Verify GET requests return 200 with a list of file paths.
     files.Touch('/foo/bar.txt')
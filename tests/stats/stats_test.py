@@ -19,6 +19,7 @@ from tests.common import testing
 
 import datetime
 from titan.common.lib.google.apputils import basetest
+from titan.common import cache_stats
 from titan.stats import stats
 
 class StatsTestCase(testing.BaseTestCase):
@@ -257,5 +258,24 @@ class StatsTestCase(testing.BaseTestCase):
     del aggregate_data['window']
     self.assertEqual(expected, aggregate_data)
 
+  def testCacheCounters(self):
+    counters = stats.MakeCacheCounters(['titan-blob'])
+    self.assertEqual(['cache/titan-blob/hits', 'cache/titan-blob/misses',
+                      'cache/titan-blob/evictions', 'cache/titan-blob/bytes'],
+                     [counter.name for counter in counters])
+
+    cache_stats.Record('titan-blob', hits=2, misses=1, num_bytes=10)
+    cache_stats.Record('titan-blob', hits=1, num_bytes=5)
+    counters = stats.StoreRequestLocalCacheCounters()
+    self.assertEqual(
+        [('cache/titan-blob/hits', 3), ('cache/titan-blob/misses', 1),
+         ('cache/titan-blob/bytes', 15)],
+        [(counter.name, counter.Finalize()) for counter in counters])
+    self.assertEqual(counters, stats.GetRequestLocalCounters())
+
+    # Stats are reset once stored.
+    self.assertEqual({}, cache_stats.GetRequestLocalStats())
+    self.assertEqual([], stats.StoreRequestLocalCacheCounters())
+
 if __name__ == '__main__':
   basetest.main()
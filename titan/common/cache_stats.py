@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Request-local hit, miss, eviction and byte counts for memcache caches.
+
+Usage:
+  # In a cache layer, record stats under the cache's name:
+  cache_stats.Record('titan-blob', hits=1, num_bytes=len(content))
+
+  # Get a summary of the stats recorded during the current request:
+  cache_stats.GetRequestLocalStats()
+  # => {'titan-blob': {'hits': 1, 'misses': 0, 'evictions': 0, 'bytes': 3}}
+
+To graph cache stats over time, see stats.StoreRequestLocalCacheCounters().
+"""
+
+import os
+
+# The stats recorded for each cache.
+STAT_NAMES = ('hits', 'misses', 'evictions', 'bytes')
+
+_ENVIRON_CACHE_STATS_NAME = 'titan-cache-stats'
+
+def Record(cache_name, hits=0, misses=0, evictions=0, num_bytes=0):
+  """Add to the request-local stats of a cache.
+
+  Args:
+    cache_name: The name of the cache, such as a memcache key prefix without
+        its trailing colon.
+    hits: The number of values found in the cache.
+    misses: The number of values not found in the cache.
+    evictions: The number of values dropped because part of them was evicted
+        or was inconsistent.
+    num_bytes: The number of bytes read from the cache.
+  """
+  # os.environ is replaced by the runtime environment with a request-local
+  # object, allowing non-string types to be stored globally in the environment
+  # and automatically cleaned up at the end of each request.
+  all_stats = os.environ.get(_ENVIRON_CACHE_STATS_NAME, {})
+  cache_stats = all_stats.setdefault(cache_name, dict.fromkeys(STAT_NAMES, 0))
+  cache_stats['hits'] += hits
+  cache_stats['misses'] += misses
+  cache_stats['evictions'] += evictions
+  cache_stats['bytes'] += num_bytes
+  os.environ[_ENVIRON_CACHE_STATS_NAME] = all_stats
+
+def GetRequestLocalStats():
+  """Get the stats recorded during the current request.
+
+  Returns:
+    A dictionary mapping cache names to dictionaries of the stats in
+    STAT_NAMES, for each cache which recorded stats.
+  """
+  all_stats = os.environ.get(_ENVIRON_CACHE_STATS_NAME, {})
+  return dict([(cache_name, cache_stats.copy())
+               for cache_name, cache_stats in all_stats.iteritems()])
+
+def ClearRequestLocalStats():
+  """Reset the stats recorded during the current request."""
+  os.environ[_ENVIRON_CACHE_STATS_NAME] = {}
@@ -20,15 +20,35 @@ be read into app memory often, but can't be cached due to size limits.
 
 This module should not be used with very large objects, keeping in mind the
 32 MB limit of memcache.set_multi.
+
+Byte strings are stored as-is, and other values are pickled. Values can
+optionally be zlib-compressed before sharding.
+
+Each Set() stamps its shard map and content shards with a random generation,
+so that shards left behind by a different Set() of the same key (such as by
+concurrent writers) are detected and treated as a cache miss.
+
+Values can optionally be set with a freshness period shorter than their
+expiration. Once stale, they are still returned by GetMultiWithStaleness()
+along with a flag, so that callers can serve them while one caller refreshes
+the value (stale-while-revalidate).
 """
 
 import cPickle as pickle
 import logging
+import os
+import time
+import zlib
 from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from titan.common import cache_stats
 
 # Pseudo namespace for memcache values.
 MEMCACHE_PREFIX = 'sharded:'
 
+# The name under which cache_stats are recorded.
+CACHE_STATS_NAME = 'sharded'
+
 # The default amount of time to cache data.
 # Setting a default expiration on all data will automatically cleanup shards
 # which have been orphaned (such as by eviction of the shard_map, a Set() with
@@ -41,54 +61,277 @@ DEFAULT_EXPIRATION_SECONDS = 24 * 60 * 60  # 1 day
 # max number of bytes of the pickled shard_map dict (without content).
 MIN_SHARDING_SIZE = memcache.MAX_VALUE_SIZE - 1000  # 999 KB
 
-def Get(key):
-  """Get a memcache entry, or None."""
-  key = MEMCACHE_PREFIX + key
-  shard_map = memcache.get(key)
-  if not shard_map:
-    # The shard_map was evicted or never set.
-    return
-
-  # If zero shards, the content was small enough and stored in the shard_map.
-  num_shards = shard_map['num_shards']
-  if num_shards == 0:
-    return pickle.loads(shard_map['content'])
-
-  keys = ['%s%d' % (key, i) for i in range(num_shards)]
-  shards = memcache.get_multi(keys)
-  if len(shards) != num_shards:
-    # One or more content shards were evicted, delete map and content shards.
-    memcache.delete_multi([key] + keys)
-    return
-
-  # All shards present, stitch contents back together and unpickle.
-  shards = tuple([shards[key] for key in keys])
-  value = '%s' * shard_map['num_shards']
-  value = pickle.loads(value % shards)
-  return value
+# The number of random bytes in a generation. Each content shard is prefixed
+# with the generation of the Set() which wrote it.
+GENERATION_SIZE = 8
 
-def Set(key, value, time=DEFAULT_EXPIRATION_SECONDS):
-  """Set a memcache entry."""
-  key = MEMCACHE_PREFIX + key
-  value = pickle.dumps(value)
+# The number of value bytes stored in each content shard.
+SHARD_CONTENT_SIZE = memcache.MAX_VALUE_SIZE - GENERATION_SIZE
 
-  # The original key is used as the shard map.
-  # The content shards are stored as '<key>0', '<key>1', etc.
-  num_shards = (len(value) / memcache.MAX_VALUE_SIZE) + 1
-  content_map = {}
-  content_map[key] = {'num_shards': num_shards}
-  for i in range(num_shards):
-    # [0:1MB] first, [1MB:2MB] second, etc.
-    begin_slice = i * memcache.MAX_VALUE_SIZE
-    end_slice = begin_slice + memcache.MAX_VALUE_SIZE
-    content_map[key + str(i)] = value[begin_slice:end_slice]
+# How values are stored, recorded in the shard map. Byte strings are stored
+# as-is and other values are pickled. Shard maps written before formats were
+# recorded always hold pickled values.
+FORMAT_BYTES = 'bytes'
+FORMAT_PICKLE = 'pickle'
 
-  # Optimization: for small content, store the content in the shard_map
-  # dictionary directly instead of actually sharding.
-  if num_shards == 1 and len(value) < MIN_SHARDING_SIZE:
-    content_map[key]['num_shards'] = num_shards = 0
-    content_map[key]['content'] = value
-    del content_map[key + '0']
+# When the size of a value isn't known, the number of content shards to fetch
+# speculatively along with its shard map. Fetching shards which don't exist is
+# cheap compared to a second round trip.
+PREFETCH_SHARDS = 2
+
+def Get(key, size=None):
+  """Get a memcache entry, or None.
+
+  Args:
+    key: The cache key.
+    size: An optional hint of the stored value's size in bytes, such as the
+        length of a cached byte string. With an accurate hint, the shard map
+        and all content shards are fetched with one RPC.
+  Returns:
+    The cached value, or None.
+  """
+  sizes = {key: size} if size is not None else None
+  return GetMulti([key], sizes=sizes).get(key)
+
+def GetMulti(keys, sizes=None):
+  """Get multiple memcache entries, usually with one batch RPC.
+
+  Stale values are returned like fresh ones; see GetMultiWithStaleness().
+
+  Args:
+    keys: An iterable of cache keys.
+    sizes: An optional dictionary of cache keys to size hints. See Get().
+  Returns:
+    A dictionary of cache keys to values, for each key which was cached.
+  """
+  return GetMultiWithStaleness(keys, sizes=sizes)[0]
+
+def GetMultiWithStaleness(keys, sizes=None):
+  """Get multiple memcache entries and which of them are stale.
+
+  Each shard map is fetched together with the content shards it is predicted
+  to have, from its size hint or PREFETCH_SHARDS. A second RPC is only needed
+  for values which have more shards than predicted.
+
+  Args:
+    keys: An iterable of cache keys.
+    sizes: An optional dictionary of cache keys to size hints. See Get().
+  Returns:
+    A tuple of (<dictionary of cache keys to values, for each key which was
+    cached>, <set of the returned keys whose values are past their
+    freshness period>).
+  """
+  map_keys = dict([(MEMCACHE_PREFIX + key, key) for key in keys])
+  predicted_num_shards = _PredictNumShardsMulti(map_keys, sizes)
+  cached = memcache.get_multi(_GetPredictedKeys(predicted_num_shards))
+  unpredicted_keys = _GetUnpredictedKeys(cached, predicted_num_shards)
+  if unpredicted_keys:
+    cached.update(memcache.get_multi(unpredicted_keys))
+  values, stale_keys, evicted_keys = _DecodeValues(map_keys, cached)
+  if evicted_keys:
+    memcache.delete_multi(evicted_keys)
+  return values, stale_keys
+
+def GetAsync(key, size=None):
+  """Asynchronous version of Get().
+
+  Returns:
+    A future whose result is the cached value, or None.
+  """
+  sizes = {key: size} if size is not None else None
+  future = GetMultiWithStalenessAsync([key], sizes=sizes)
+  return _MapFuture(future, lambda result: result[0].get(key))
+
+def GetMultiAsync(keys, sizes=None):
+  """Asynchronous version of GetMulti().
+
+  Returns:
+    A future whose result is a dictionary of cache keys to values.
+  """
+  future = GetMultiWithStalenessAsync(keys, sizes=sizes)
+  return _MapFuture(future, lambda result: result[0])
+
+@ndb.tasklet
+def GetMultiWithStalenessAsync(keys, sizes=None):
+  """Asynchronous version of GetMultiWithStaleness().
+
+  Memcache calls are made through the ndb context, which merges the calls of
+  all tasklets waiting in the same event loop pass into one batch RPC. Lookups
+  can be started early and many lookups for different keys share RPCs:
+    futures = [sharded_cache.GetAsync(key) for key in keys]
+    values = [future.get_result() for future in futures]
+
+  Returns:
+    A future whose result is the same tuple as GetMultiWithStaleness().
+  """
+  map_keys = dict([(MEMCACHE_PREFIX + key, key) for key in keys])
+  predicted_num_shards = _PredictNumShardsMulti(map_keys, sizes)
+  cached = yield _GetMultiFromContextAsync(
+      _GetPredictedKeys(predicted_num_shards))
+  unpredicted_keys = _GetUnpredictedKeys(cached, predicted_num_shards)
+  if unpredicted_keys:
+    unpredicted = yield _GetMultiFromContextAsync(unpredicted_keys)
+    cached.update(unpredicted)
+  values, stale_keys, evicted_keys = _DecodeValues(map_keys, cached)
+  if evicted_keys:
+    context = ndb.get_context()
+    yield [context.memcache_delete(key) for key in evicted_keys]
+  raise ndb.Return((values, stale_keys))
+
+@ndb.tasklet
+def _GetMultiFromContextAsync(memcache_keys):
+  """Tasklet like memcache.get_multi(), batched by the ndb context."""
+  context = ndb.get_context()
+  values = yield [context.memcache_get(key) for key in memcache_keys]
+  raise ndb.Return(dict([(key, value) for key, value
+                         in zip(memcache_keys, values) if value is not None]))
+
+@ndb.tasklet
+def _MapFuture(future, func):
+  result = yield future
+  raise ndb.Return(func(result))
+
+def _PredictNumShardsMulti(map_keys, sizes):
+  """Returns a dictionary of shard map keys to predicted numbers of shards."""
+  sizes = sizes or {}
+  return dict([(map_key, _PredictNumShards(sizes.get(key)))
+               for map_key, key in map_keys.iteritems()])
+
+def _GetPredictedKeys(predicted_num_shards):
+  """Returns the shard map keys and their predicted content shard keys."""
+  memcache_keys = []
+  for map_key, num_shards in predicted_num_shards.iteritems():
+    memcache_keys.append(map_key)
+    memcache_keys += _GetShardKeys(map_key, num_shards)
+  return memcache_keys
+
+def _GetUnpredictedKeys(cached, predicted_num_shards):
+  """Returns the keys of any content shards beyond the predicted ones."""
+  unpredicted_keys = []
+  for map_key, num_shards in predicted_num_shards.iteritems():
+    shard_map = cached.get(map_key)
+    if shard_map and shard_map['num_shards'] > num_shards:
+      shard_keys = _GetShardKeys(map_key, shard_map['num_shards'])
+      unpredicted_keys += shard_keys[num_shards:]
+  return unpredicted_keys
+
+def _DecodeValues(map_keys, cached):
+  """Reassembles cached values from fetched shard maps and content shards.
+
+  Args:
+    map_keys: A dictionary of shard map keys to the original cache keys.
+    cached: A dictionary of fetched memcache keys to values.
+  Returns:
+    A tuple of (<dictionary of cache keys to values>, <set of stale cache
+    keys>, <list of memcache keys of evicted or torn values to delete>).
+  """
+  values = {}
+  stale_keys = set()
+  evicted_keys = []
+  num_evictions = 0
+  num_bytes = 0
+  now = _Now()
+  for map_key, key in map_keys.iteritems():
+    shard_map = cached.get(map_key)
+    if not shard_map:
+      # The shard_map was evicted or never set.
+      continue
+    if shard_map.get('stale_after', now) < now:
+      stale_keys.add(key)
+
+    # If zero shards, the content was small enough and stored in the shard_map.
+    num_shards = shard_map['num_shards']
+    if num_shards == 0:
+      num_bytes += len(shard_map['content'])
+      values[key] = _DecodeValue(shard_map, [shard_map['content']])
+      continue
+
+    shard_keys = _GetShardKeys(map_key, num_shards)
+    if not all([shard_key in cached for shard_key in shard_keys]):
+      # One or more content shards were evicted, delete map and content shards.
+      evicted_keys += [map_key] + shard_keys
+      num_evictions += 1
+      continue
+
+    # All shards present, stitch contents back together.
+    shards = [cached.pop(shard_key) for shard_key in shard_keys]
+    num_bytes += sum([len(shard) for shard in shards])
+    shards = _UnstampShards(shard_map, shards)
+    if shards is None:
+      # Shards from different Set() calls; delete map and content shards.
+      logging.warning('Sharded cache has mixed generations: %r', key)
+      evicted_keys += [map_key] + shard_keys
+      num_evictions += 1
+      continue
+    values[key] = _DecodeValue(shard_map, shards)
+  cache_stats.Record(CACHE_STATS_NAME, hits=len(values),
+                     misses=len(map_keys) - len(values),
+                     evictions=num_evictions, num_bytes=num_bytes)
+  stale_keys.intersection_update(values)
+  return values, stale_keys, evicted_keys
+
+def _UnstampShards(shard_map, shards):
+  """Strips generations from content shards, or returns None if any differ."""
+  # Shard maps written before generations were added have unstamped shards.
+  generation = shard_map.get('generation', '')
+  shards.reverse()
+  unstamped_shards = []
+  while shards:
+    # Pop each shard so it can be released as soon as it is copied.
+    shard = shards.pop()
+    if not shard.startswith(generation):
+      return None
+    unstamped_shards.append(shard[len(generation):])
+  return unstamped_shards
+
+def _Now():
+  return time.time()
+
+def _PredictNumShards(size):
+  """Predicts how many content shards a value of the given size is stored in."""
+  if size is None:
+    return PREFETCH_SHARDS
+  if size < MIN_SHARDING_SIZE:
+    return 0
+  return (size + SHARD_CONTENT_SIZE - 1) / SHARD_CONTENT_SIZE
+
+def _GetShardKeys(map_key, num_shards):
+  return ['%s%d' % (map_key, i) for i in range(num_shards)]
+
+def _DecodeValue(shard_map, shards):
+  """Reassembles a value from its ordered list of content shards."""
+  if shard_map.get('compression') == 'zlib':
+    # Decompress shard by shard, releasing each compressed shard when done.
+    decompressor = zlib.decompressobj()
+    shards.reverse()
+    content = []
+    while shards:
+      content.append(decompressor.decompress(shards.pop()))
+    content.append(decompressor.flush())
+    shards = content
+  value = shards[0] if len(shards) == 1 else ''.join(shards)
+  del shards[:]
+  if shard_map.get('format', FORMAT_PICKLE) == FORMAT_PICKLE:
+    return pickle.loads(value)
+  return value
+
+def Set(key, value, time=DEFAULT_EXPIRATION_SECONDS, compress=False,
+        fresh_time=None):
+  """Set a memcache entry.
+
+  Args:
+    key: The cache key.
+    value: A byte string, which is stored as-is, or any picklable value.
+    time: The number of seconds to cache the value for.
+    compress: Whether to zlib-compress the value. Values which don't get
+        smaller are stored uncompressed.
+    fresh_time: An optional number of seconds after which the value is
+        reported as stale by GetMultiWithStaleness(). Should be less than time.
+  Returns:
+    True if the value was set, False otherwise.
+  """
+  content_map = _EncodeValue(MEMCACHE_PREFIX + key, value, compress=compress,
+                             fresh_time=fresh_time)
 
   # Set the shard map and all content shards.
   failed_keys = memcache.set_multi(content_map, time=time)
@@ -100,6 +343,72 @@ def Set(key, value, time=DEFAULT_EXPIRATION_SECONDS):
       logging.error('Sharded cache delete_multi failed, Keys: %r', failed_keys)
   return not bool(failed_keys)
 
+@ndb.tasklet
+def SetAsync(key, value, time=DEFAULT_EXPIRATION_SECONDS, compress=False,
+             fresh_time=None):
+  """Asynchronous version of Set().
+
+  Like GetMultiWithStalenessAsync(), memcache calls are batched with those of
+  other tasklets by the ndb context.
+
+  Returns:
+    A future whose result is True if the value was set, False otherwise.
+  """
+  content_map = _EncodeValue(MEMCACHE_PREFIX + key, value, compress=compress,
+                             fresh_time=fresh_time)
+  memcache_keys = content_map.keys()
+  context = ndb.get_context()
+  results = yield [context.memcache_set(memcache_key, content_map[memcache_key],
+                                        time=time)
+                   for memcache_key in memcache_keys]
+  failed_keys = [memcache_key for memcache_key, result
+                 in zip(memcache_keys, results) if not result]
+  if failed_keys:
+    logging.error('Sharded cache set failed. Keys: %r', failed_keys)
+    # Failed. Delete the shard_map and any keys which succeeded.
+    yield [context.memcache_delete(memcache_key)
+           for memcache_key in memcache_keys]
+  raise ndb.Return(not failed_keys)
+
+def _EncodeValue(key, value, compress=False, fresh_time=None):
+  """Returns a dictionary of the memcache keys and values storing a value."""
+  shard_map = {}
+  if fresh_time is not None:
+    shard_map['stale_after'] = _Now() + fresh_time
+  if isinstance(value, str):
+    shard_map['format'] = FORMAT_BYTES
+  else:
+    shard_map['format'] = FORMAT_PICKLE
+    value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+  if compress:
+    compressed_value = zlib.compress(value)
+    if len(compressed_value) < len(value):
+      value = compressed_value
+      shard_map['compression'] = 'zlib'
+
+  # The original key is used as the shard map.
+  # The content shards are stored as '<key>0', '<key>1', etc.
+  num_shards = max(1, (len(value) + SHARD_CONTENT_SIZE - 1) /
+                   SHARD_CONTENT_SIZE)
+  shard_map['num_shards'] = num_shards
+  content_map = {}
+  content_map[key] = shard_map
+
+  # Optimization: for small content, store the content in the shard_map
+  # dictionary directly instead of actually sharding.
+  if num_shards == 1 and len(value) < MIN_SHARDING_SIZE:
+    shard_map['num_shards'] = 0
+    shard_map['content'] = value
+  else:
+    generation = os.urandom(GENERATION_SIZE)
+    shard_map['generation'] = generation
+    for i in range(num_shards):
+      # [0:1MB] first, [1MB:2MB] second, etc., each prefixed by the generation.
+      begin_slice = i * SHARD_CONTENT_SIZE
+      end_slice = begin_slice + SHARD_CONTENT_SIZE
+      content_map[key + str(i)] = generation + value[begin_slice:end_slice]
+  return content_map
+
 def Delete(key, seconds=0):
   """Delete a memcache entry."""
   key = MEMCACHE_PREFIX + key
@@ -109,3 +418,17 @@ def Delete(key, seconds=0):
     return memcache.DELETE_ITEM_MISSING
   keys = [key] + ['%s%d' % (key, i) for i in range(shard_map['num_shards'])]
   return memcache.delete_multi(keys, seconds=seconds)
+
+def DeleteMulti(keys, seconds=0):
+  """Delete multiple memcache entries with one get and one delete RPC."""
+  keys = [MEMCACHE_PREFIX + key for key in keys]
+  shard_maps = memcache.get_multi(keys)
+  if not shard_maps:
+    # All shard_maps were evicted or never set.
+    return memcache.DELETE_ITEM_MISSING
+  keys_to_delete = []
+  for key, shard_map in shard_maps.iteritems():
+    num_shards = shard_map['num_shards']
+    keys_to_delete.append(key)
+    keys_to_delete += ['%s%d' % (key, i) for i in range(num_shards)]
+  return memcache.delete_multi(keys_to_delete, seconds=seconds)
@@ -26,11 +26,13 @@ Sample usage:
   print resp.content
 """
 
+import cStringIO
 import copy
 import getpass
 import sys
 import urllib2
 from google.appengine.tools import appengine_rpc
+from titan.common import utils
 
 USER_AGENT = 'TitanRpcClient/1.0'
 SOURCE = '-'
@@ -44,6 +46,29 @@ class AuthenticationError(Error):
 class RpcError(Error):
   pass
 
+class ContentDecodingHandler(urllib2.BaseHandler):
+  """urllib2 handler which requests and decodes compressed responses."""
+
+  def http_request(self, request):
+    if not request.has_header('Accept-encoding'):
+      request.add_header('Accept-Encoding', ', '.join(utils.RESPONSE_ENCODINGS))
+    return request
+
+  def http_response(self, request, response):
+    encoding = response.headers.get('content-encoding', '').strip().lower()
+    if encoding not in utils.RESPONSE_ENCODINGS:
+      return response
+    content = utils.DecompressContent(response.read(), encoding)
+    del response.headers['content-encoding']
+    decoded_response = urllib2.addinfourl(
+        cStringIO.StringIO(content), response.headers, response.geturl(),
+        response.code)
+    decoded_response.msg = response.msg
+    return decoded_response
+
+  https_request = http_request
+  https_response = http_response
+
 def AuthFunc():
   """Default auth func."""
   email = ''
@@ -153,6 +178,12 @@ class TitanClient(appengine_rpc.HttpRpcServer):
       return True
     return False
 
+  def _GetOpener(self):
+    """Overrides the base method to request and decode compressed responses."""
+    opener = super(TitanClient, self)._GetOpener()
+    opener.add_handler(ContentDecodingHandler())
+    return opener
+
   def _CreateRequest(self, url, data=None):
     """Overrides the base method to allow different HTTP methods to be used."""
     request = super(TitanClient, self)._CreateRequest(url, data=data)
@@ -20,7 +20,30 @@ import inspect
 import json
 import mimetypes
 import os
+import struct
 import time
+import zlib
+
+# Content-Encodings which responses may be compressed with, in order of
+# preference. "deflate" is the zlib format, per RFC 2616.
+RESPONSE_ENCODINGS = ('gzip', 'deflate')
+
+# Content with MIME types starting with these prefixes is worth compressing,
+# both in responses and when stored in the datastore.
+COMPRESSIBLE_MIME_TYPES = (
+    'text/',
+    'application/javascript',
+    'application/json',
+    'application/x-javascript',
+    'application/xml',
+    'image/svg+xml',
+)
+
+# Responses smaller than this aren't worth compressing.
+MIN_RESPONSE_COMPRESSION_SIZE = 1 << 10  # 1 KiB
+
+# The zlib compression level for responses, trading CPU for size.
+RESPONSE_COMPRESSION_LEVEL = 6
 
 def GetCommonDirPath(paths):
   """Given an iterable of file paths, returns the top common prefix."""
@@ -135,20 +158,180 @@ def ComposeMethodKwargs(func):
 
   return Wrapper
 
+def IsCompressibleMimeType(mime_type):
+  """Whether content of the given MIME type is worth compressing."""
+  if not mime_type:
+    return False
+  return mime_type.strip().lower().startswith(COMPRESSIBLE_MIME_TYPES)
+
+def GetAcceptedEncoding(accept_encoding, encodings=RESPONSE_ENCODINGS):
+  """Chooses a content coding from an Accept-Encoding header.
+
+  Args:
+    accept_encoding: The Accept-Encoding header value, or None.
+    encodings: Supported content codings, in order of preference.
+  Returns:
+    The first of the given encodings which the client accepts, or None.
+  """
+  if not accept_encoding:
+    return None
+  qvalues = {}
+  for coding in accept_encoding.split(','):
+    params = coding.split(';')
+    name = params[0].strip().lower()
+    qvalue = 1.0
+    for param in params[1:]:
+      key, _, value = param.partition('=')
+      if key.strip().lower() == 'q':
+        try:
+          qvalue = float(value)
+        except ValueError:
+          qvalue = 0.0
+    if name:
+      qvalues[name] = qvalue
+  for encoding in encodings:
+    if qvalues.get(encoding, qvalues.get('*', 0.0)) > 0:
+      return encoding
+  return None
+
+def NewCompressor(encoding, level=RESPONSE_COMPRESSION_LEVEL):
+  """Returns a zlib compression object for the "gzip" or "deflate" coding."""
+  if encoding == 'gzip':
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  elif encoding == 'deflate':
+    return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+  raise ValueError('Unsupported content encoding: %r' % encoding)
+
+def CompressContent(content, encoding, level=RESPONSE_COMPRESSION_LEVEL):
+  """Compresses a byte string with the "gzip" or "deflate" content coding."""
+  compressor = NewCompressor(encoding, level=level)
+  return compressor.compress(content) + compressor.flush()
+
+def DecompressContent(content, encoding):
+  """Decompresses a byte string of the "gzip" or "deflate" content coding."""
+  if encoding == 'gzip':
+    return zlib.decompress(content, 16 + zlib.MAX_WBITS)
+  elif encoding == 'deflate':
+    try:
+      return zlib.decompress(content)
+    except zlib.error:
+      # Some servers incorrectly send a raw deflate stream without a header.
+      return zlib.decompress(content, -zlib.MAX_WBITS)
+  raise ValueError('Unsupported content encoding: %r' % encoding)
+
+def ZlibToGzip(zlib_content):
+  """Rewraps zlib-compressed content as gzip, without recompressing it.
+
+  Args:
+    zlib_content: A byte string compressed with zlib.compress().
+  Returns:
+    A gzip byte string of the same compressed data.
+  """
+  # The gzip trailer needs the checksum and size of the uncompressed content.
+  # Decompressing is much cheaper than compressing again.
+  content = zlib.decompress(zlib_content)
+  # A gzip header with no filename or modification time, then the raw deflate
+  # stream stripped of its 2 byte zlib header and 4 byte checksum.
+  return ''.join([
+      '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff',
+      zlib_content[2:-4],
+      struct.pack('<II', zlib.crc32(content) & 0xffffffff,
+                  len(content) & 0xffffffff),
+  ])
+
+def GetResponseEncoding(request, response, encodings=RESPONSE_ENCODINGS):
+  """Chooses a Content-Encoding for a webapp response, based on its MIME type.
+
+  This also sets the "Vary" header of compressible responses, since they may
+  differ depending on the request's Accept-Encoding header.
+
+  Args:
+    request: The webapp request.
+    response: The webapp response. Its Content-Type must already be set.
+    encodings: Supported content codings, in order of preference.
+  Returns:
+    The encoding to compress the response body with, or None.
+  """
+  if not IsCompressibleMimeType(response.headers.get('Content-Type')):
+    return None
+  response.headers['Vary'] = 'Accept-Encoding'
+  return GetAcceptedEncoding(request.headers.get('Accept-Encoding'),
+                             encodings=encodings)
+
+def SetContentEncoding(response, encoding):
+  """Sets the Content-Encoding header of a compressed webapp response."""
+  response.headers['Content-Encoding'] = encoding
+  # The compressed body is no longer byte-for-byte identical to the entity the
+  # ETag describes, so make it a weak ETag (which still matches conditional
+  # requests).
+  etag = response.headers.get('ETag')
+  if etag and not etag.startswith('W/'):
+    response.headers['ETag'] = 'W/%s' % etag
+
+def WriteResponse(request, response, content):
+  """Writes a complete webapp response body, compressing it if worthwhile.
+
+  Args:
+    request: The webapp request.
+    response: The webapp response. Its Content-Type must already be set.
+    content: The response body, as a byte string or unicode string.
+  """
+  if isinstance(content, unicode):
+    content = content.encode('utf-8')
+  encoding = GetResponseEncoding(request, response)
+  if encoding and len(content) >= MIN_RESPONSE_COMPRESSION_SIZE:
+    content = CompressContent(content, encoding)
+    SetContentEncoding(response, encoding)
+  response.out.write(content)
+
+class ResponseWriter(object):
+  """File-like object to write a webapp response body in pieces.
+
+  The body is compressed if the client accepts it, so close() must be called
+  after the last write.
+  """
+
+  def __init__(self, request, response):
+    self._out = response.out
+    self._compressor = None
+    encoding = GetResponseEncoding(request, response)
+    if encoding:
+      # The size isn't known up front, so always compress.
+      self._compressor = NewCompressor(encoding)
+      SetContentEncoding(response, encoding)
+
+  def write(self, data):
+    if isinstance(data, unicode):
+      data = data.encode('utf-8')
+    if self._compressor:
+      data = self._compressor.compress(data)
+    if data:
+      self._out.write(data)
+
+  def close(self):
+    if self._compressor:
+      self._out.write(self._compressor.flush())
+      self._compressor = None
+
 class CustomJsonEncoder(json.JSONEncoder):
   """A custom JSON encoder to support objects providing a Serialize() method."""
 
   def __init__(self, *args, **kwargs):
     self.full = kwargs.pop('full', None)
+    # An optional list of property names to project Serialize() results onto.
+    self.fields = kwargs.pop('fields', None)
     super(CustomJsonEncoder, self).__init__(*args, **kwargs)
 
   def default(self, obj):
     """Override of json.JSONEncoder method."""
     # Objects with custom Serialize() function.
     if hasattr(obj, 'Serialize'):
+      serialize_kwargs = {}
       if self.full is not None:
-        return obj.Serialize(full=self.full)
-      return obj.Serialize()
+        serialize_kwargs['full'] = self.full
+      if self.fields is not None:
+        serialize_kwargs['fields'] = self.fields
+      return obj.Serialize(**serialize_kwargs)
 
     # Datetime objects => Unix timestamp.
     if hasattr(obj, 'timetuple'):
@@ -37,6 +37,7 @@ from poster import encode
 from poster import streaminghttp
 from google.appengine.api import urlfetch
 from google.appengine.tools import appengine_rpc
+from titan.common import titan_rpc
 
 class Error(Exception):
   pass
@@ -288,6 +289,12 @@ class TitanClient(appengine_rpc.HttpRpcServer):
     return super(TitanClient, self).Send(url_path, payload=payload,
                                          content_type=content_type)
 
+  def _GetOpener(self):
+    """Overrides the base method to request and decode compressed responses."""
+    opener = super(TitanClient, self)._GetOpener()
+    opener.add_handler(titan_rpc.ContentDecodingHandler())
+    return opener
+
   def _HostIsDevAppServer(self):
     """Make a single GET / request to see if the server is a dev_appserver."""
     # This exists because appserver_rpc doesn't nicely expose auth error paths.
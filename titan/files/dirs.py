@@ -37,35 +37,43 @@ _STATUS_DELETED = 2
 class DirManagerMixin(files.File):
   """Mixin to initiate directory update tasks when files change."""
 
-  def Write(self, *args, **kwargs):
-    result = super(DirManagerMixin, self).Write(*args, **kwargs)
-    self.AddTitanDirUpdateTask(action=_STATUS_AVAILABLE)
-    return result
+  @classmethod
+  def OnFilesWritten(cls, titan_files):
+    super(DirManagerMixin, cls).OnFilesWritten(titan_files)
+    _AddTitanDirUpdateTask([f.path for f in titan_files],
+                           action=_STATUS_AVAILABLE)
 
-  def Delete(self, *args, **kwargs):
-    result = super(DirManagerMixin, self).Delete(*args, **kwargs)
-    self.AddTitanDirUpdateTask(action=_STATUS_DELETED)
-    return result
+  @classmethod
+  def OnFilesDeleted(cls, titan_files):
+    super(DirManagerMixin, cls).OnFilesDeleted(titan_files)
+    _AddTitanDirUpdateTask([f.path for f in titan_files],
+                           action=_STATUS_DELETED)
 
   def AddTitanDirUpdateTask(self, action):
     """Add a task to the pull queue about which path was modified and how."""
-    now = time.time()
-    window = _GetWindow(now)
-    path_data = {
-        'path': self.path,
-        'modified': now,
-        'action': action,
-    }
-    # Important: unlock tasks in the same window at the same time, and
-    # after the window itself has passed.
-    current_task_eta = datetime.datetime.utcfromtimestamp(
-        window + TASKQUEUE_LEASE_ETA_BUFFER)
-    task = taskqueue.Task(
-        method='PULL',
-        payload=json.dumps(path_data),
-        tag=str(window),
-        eta=current_task_eta)
-    task.add(queue_name=TASKQUEUE_NAME)
+    _AddTitanDirUpdateTask([self.path], action=action)
+
+def _AddTitanDirUpdateTask(paths, action):
+  """Add one task to the pull queue about which paths were modified and how."""
+  if not paths:
+    return
+  now = time.time()
+  window = _GetWindow(now)
+  path_data = {
+      'paths': paths,
+      'modified': now,
+      'action': action,
+  }
+  # Important: unlock tasks in the same window at the same time, and
+  # after the window itself has passed.
+  current_task_eta = datetime.datetime.utcfromtimestamp(
+      window + TASKQUEUE_LEASE_ETA_BUFFER)
+  task = taskqueue.Task(
+      method='PULL',
+      payload=json.dumps(path_data),
+      tag=str(window),
+      eta=current_task_eta)
+  task.add(queue_name=TASKQUEUE_NAME)
 
 class DirTaskConsumer(object):
   """Service which consumes and processes path-modification tasks."""
@@ -99,12 +107,16 @@ class DirTaskConsumer(object):
     modified_paths = []
     for task in tasks:
       path_data = json.loads(task.payload)
-      modified_path = ModifiedPath(
-          path=path_data['path'],
-          modified=path_data['modified'],
-          action=path_data['action'],
-      )
-      modified_paths.append(modified_path)
+      # Tasks hold one or more paths; single-path tasks may still be queued
+      # from before batched writes.
+      paths = path_data.get('paths') or [path_data['path']]
+      for path in paths:
+        modified_path = ModifiedPath(
+            path=path,
+            modified=path_data['modified'],
+            action=path_data['action'],
+        )
+        modified_paths.append(modified_path)
 
     # Compute the affected directories and then update them if needed.
     dir_service = DirService()
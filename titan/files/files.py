@@ -49,7 +49,11 @@ if os.environ.get('APPENGINE_RUNTIME') == 'python':
 
 import cStringIO
 import datetime
+import itertools
 import logging
+import sys
+import threading
+import zlib
 
 from google.appengine.api import files as blobstore_files
 from google.appengine.ext import blobstore
@@ -67,8 +71,27 @@ MAX_CONTENT_SIZE = 1 << 19  # 500 KiB
 
 BLOBSTORE_APPEND_CHUNK_SIZE = 1 << 19 # 500 KiB
 
+# Most content uploads to blobstore which Files.WriteMulti() runs at once.
+MAX_CONCURRENT_BLOB_UPLOADS = 8
+# How often tasklets check whether their blobstore uploads have finished.
+BLOB_UPLOAD_POLL_SECONDS = 0.01
+
+# Size of each blobstore fetch made by File.open() and File.Read().
+BLOB_READ_BUFFER_SIZE = 1 << 17  # 128 KiB
+
+# Content smaller than this isn't worth compressing.
+MIN_COMPRESSION_SIZE = 1 << 10  # 1 KiB
+# Larger content is not compressed to try to fit it under MAX_CONTENT_SIZE.
+MAX_COMPRESSIBLE_CONTENT_SIZE = 1 << 22  # 4 MiB
+# Size of the prefix of content of other MIME types which is compressed first,
+# to estimate whether the whole content will compress enough to fit inline.
+COMPRESSION_PROBE_SIZE = 1 << 16  # 64 KiB
+
 DEFAULT_BATCH_SIZE = 100
 
+_ENVIRON_BATCH_LOAD_COUNTS_NAME = 'titan-files-batch-load-counts'
+_ENVIRON_SKIPPED_WRITES_NAME = 'titan-files-skipped-writes'
+
 class Error(Exception):
   pass
 
@@ -145,6 +168,8 @@ class File(object):
     self._name = os.path.basename(self._path)
     self._file_ent = _file_ent
     self._meta = None
+    # A _FileBatch, set when this object is lazily loaded by a Files container.
+    self._file_batch = None
 
   def __eq__(self, other_file):
     return (isinstance(other_file, File)
@@ -159,6 +184,11 @@ class File(object):
     try:
       if self._file_ent:
         return self._file_ent
+      if self._file_batch:
+        # Load this object and its siblings from a Files container in one RPC.
+        self._file_batch.Load()
+        if self._file_ent:
+          return self._file_ent
       # Haven't initialized a File object yet.
       temp_file_obj, _ = _GetTitanFilesOrDie(self.real_path)
       self._file_ent = _GetFileEntities(temp_file_obj)
@@ -215,6 +245,17 @@ class File(object):
   def content(self):
     return _ReadContentOrBlob(self)
 
+  @property
+  def compressed_content(self):
+    """The zlib-compressed content as stored in the datastore, or None.
+
+    None if the content is not stored compressed (including blob content), or
+    if a subclass overrides how content is read.
+    """
+    if _IsOverridden(self, 'content') or self._file.compression != 'zlib':
+      return None
+    return self._file.content
+
   @property
   def blob(self):
     """The BlobInfo of this File, if the file content is stored in blobstore."""
@@ -225,6 +266,14 @@ class File(object):
       return blobstore.BlobInfo.get(self._file.blob)
     return blobstore.get(self._file.blobs[0])
 
+  @property
+  def _blob_key(self):
+    """The BlobKey of this File, without the RPC needed to get the BlobInfo."""
+    # Backwards-compatibility with deprecated "blobs" property.
+    if self._file.blobs and not self._file.blob:
+      return self._file.blobs[0]
+    return self._file.blob
+
   @property
   def exists(self):
     try:
@@ -242,6 +291,9 @@ class File(object):
 
   @property
   def size(self):
+    if self._file.size is not None:
+      return self._file.size
+    # Fallback for entities which have not been backfilled with a size.
     if self.blob:
       return self.blob.size
     content = self.content
@@ -251,7 +303,10 @@ class File(object):
 
   @property
   def md5_hash(self):
-    return self.blob.md5_hash if self.blob else self._file.md5_hash
+    if self._file.md5_hash is not None:
+      return self._file.md5_hash
+    # Fallback for blob entities which have not been backfilled with a hash.
+    return self.blob.md5_hash if self._blob_key else None
 
   @property
   def meta(self):
@@ -270,13 +325,53 @@ class File(object):
   def close(self):
     pass
 
+  def open(self):
+    """Open the file's content for reading.
+
+    Blob content is fetched lazily in BLOB_READ_BUFFER_SIZE chunks, so seeking
+    over content doesn't fetch it and reading a range doesn't fetch the rest.
+
+    Raises:
+      BadFileError: If the file does not exist.
+    Returns:
+      A seekable, read-only file-like object of the file's undecoded content.
+    """
+    blob_key = self._blob_key
+    if blob_key:
+      return blobstore.BlobReader(blob_key, buffer_size=BLOB_READ_BUFFER_SIZE)
+    return cStringIO.StringIO(_GetInlineContent(self._file))
+
+  def Read(self, offset=0, size=None):
+    """Read a range of the file's content.
+
+    Unlike the content property, this only fetches the requested range of blob
+    content, and doesn't store the blob content in the cache.
+
+    Args:
+      offset: The byte offset to start reading at.
+      size: The maximum number of bytes to read, or None to read to the end.
+    Raises:
+      BadFileError: If the file does not exist.
+      ValueError: If given a negative offset or size.
+    Returns:
+      A byte string. Unicode content is not decoded, since a range may split
+      multi-byte characters.
+    """
+    if offset < 0 or (size is not None and size < 0):
+      raise ValueError('"offset" and "size" must not be negative.')
+    fp = self.open()
+    fp.seek(offset)
+    return fp.read(-1 if size is None else size)
+
   # TODO(user): remove _delete_old_blob, refactor into versions subclass.
   def Write(self, content=None, blob=None, mime_type=None, meta=None,
-            _delete_old_blob=True):
+            fp=None, compress=None, force=False, _delete_old_blob=True,
+            **kwargs):
     """Write or update a File.
 
     Updates: if the File already exists, Write will accept any of the given args
     and only perform an update of the given data, without affecting other data.
+    If nothing would change, the write is skipped entirely, unless forced.
 
     Args:
       content: File contents, either as a str or unicode object.
@@ -287,25 +382,112 @@ class File(object):
       blob: If content is not provided, a BlobKey pointing to the file.
       mime_type: Content type of the file; will be guessed if not given.
       meta: A dictionary of properties to be added to the file.
+      fp: If no content and no blob, a file-like object or an iterable of
+          byte-string chunks. The stream is consumed incrementally and, once it
+          exceeds MAX_CONTENT_SIZE, written straight to blobstore without
+          holding the entire content in memory. Streams which will be
+          compressed are buffered up to MAX_COMPRESSIBLE_CONTENT_SIZE instead.
+      compress: Whether or not to zlib-compress content stored in the datastore.
+          If None, content is compressed if its MIME type is compressible or
+          if it would only fit in the datastore when compressed. Content which
+          is still over MAX_CONTENT_SIZE after compression is stored in
+          blobstore, uncompressed.
+      force: Whether or not to write the file even if its content, mime_type,
+          and meta are unchanged, such as to update its modified time.
       _delete_old_blob: Whether or not to delete the old blob if it changed.
+      **kwargs: Extra keyword arguments for subclasses' WriteAsync().
     Raises:
       TypeError: For missing arguments.
       BadFileError: If updating meta information on a non-existent file.
     Returns:
       Self-reference.
     """
+    return self.WriteAsync(
+        content=content, blob=blob, mime_type=mime_type, meta=meta, fp=fp,
+        compress=compress, force=force, _delete_old_blob=_delete_old_blob,
+        **kwargs).get_result()
+
+  def WriteAsync(self, content=None, blob=None, mime_type=None, meta=None,
+                 fp=None, compress=None, force=False, _delete_old_blob=True):
+    """Asynchronous version of Write(). See Write() for arguments.
+
+    This can be used inside of ndb tasklets, or to overlap many writes:
+      futures = [files.File(path).WriteAsync('') for path in paths]
+      ndb.Future.wait_all(futures)
+
+    NOTE: subclasses should customize write behavior by overriding this method
+    instead of Write(), since Write() is a synchronous wrapper around it.
+
+    Raises:
+      TypeError: For missing arguments.
+    Returns:
+      An ndb.Future whose result is a self-reference. The future will raise
+      BadFileError if updating meta information on a non-existent file.
+    """
     logging.info('Writing Titan file: %s', self.real_path)
+    _ValidateWriteArgs(content=content, blob=blob, mime_type=mime_type,
+                       meta=meta, fp=fp)
+    return self._WriteAsync(content=content, blob=blob, mime_type=mime_type,
+                            meta=meta, fp=fp, compress=compress, force=force,
+                            _delete_old_blob=_delete_old_blob)
+
+  @ndb.tasklet
+  def _WriteAsync(self, content, blob, mime_type, meta, fp, compress, force,
+                  _delete_old_blob):
+    """Tasklet containing the core of WriteAsync()."""
+    pending_write = yield self._PrepareWriteAsync(
+        content=content, blob=blob, mime_type=mime_type, meta=meta, fp=fp,
+        compress=compress, force=force, _delete_old_blob=_delete_old_blob)
+    yield _CommitWritesAsync([pending_write])
+    self.OnFilesWritten([self])
+    raise ndb.Return(self)
+
+  @ndb.tasklet
+  def _PrepareWriteAsync(self, content=None, blob=None, mime_type=None,
+                         meta=None, fp=None, compress=None, force=False,
+                         _delete_old_blob=True, exists=None,
+                         upload_semaphore=None):
+    """Tasklet to upload blobs and update the file entity, without storing it.
 
-    # Argument sanity checks.
-    _TitanFile.ValidateMetaProperties(meta)
-    is_content_update = content is not None or blob is not None
-    is_meta_update = mime_type is not None or meta is not None
-    if not is_content_update and not is_meta_update:
-      raise TypeError('Arguments expected, but none given.')
-    if not self.exists and is_meta_update and not is_content_update:
+    Args:
+      exists: Whether the file is known to exist, or None to load the file.
+      upload_semaphore: If given, large content is uploaded to blobstore from
+          a separate thread holding this semaphore, so that the uploads of
+          concurrent writes overlap. Otherwise, it is uploaded synchronously.
+          See Write() for the other arguments.
+    Raises:
+      BadFileError: If updating meta information on a non-existent file.
+    Returns:
+      A future whose result is a _PendingWrite to be passed to
+      _CommitWritesAsync().
+    """
+    is_content_update = (content is not None or blob is not None
+                         or fp is not None)
+    if exists is None:
+      exists = yield self._LoadAsync()
+    if not exists and not is_content_update:
       raise BadFileError('File does not exist: %s' % self.real_path)
-    if content and blob:
-      raise TypeError('Exactly one of "content" or "blob" must be given.')
+
+    if exists:
+      content_mime_type = mime_type or self._file.mime_type
+    else:
+      content_mime_type = mime_type or utils.GuessMimeType(self.real_path)
+
+    # Size and hash of the new blob, if any.
+    blob_size = None
+    blob_md5_hash = None
+    if fp is not None:
+      # Small streams become content, large streams are written to blobstore.
+      # Only streams which will be compressed are buffered past the inline
+      # size, in case they compress enough to be stored inline.
+      max_content_size = MAX_CONTENT_SIZE
+      if compress or (compress is None
+                      and utils.IsCompressibleMimeType(content_mime_type)):
+        max_content_size = MAX_COMPRESSIBLE_CONTENT_SIZE
+      content, blob, blob_size, blob_md5_hash = _ReadStream(
+          fp, max_content_size=max_content_size)
+      if blob:
+        blob = yield _AcquireBlobAsync(blob_md5_hash, new_blob=blob)
 
     # If given unicode, encode it as UTF-8 and flag it for future decoding.
     if isinstance(content, unicode):
@@ -314,161 +496,366 @@ class File(object):
     else:
       encoding = None
 
-    # Should we store content in blobstore? Must come after encoding.
-    if content and len(content) > MAX_CONTENT_SIZE:
-      logging.debug('Content size %s exceeds %s bytes, uploading to blobstore.',
-                    len(content), MAX_CONTENT_SIZE)
-
-      filename = blobstore_files.blobstore.create()
-      content_file = cStringIO.StringIO(content)
-      blobstore_file = blobstore_files.open(filename, 'a')
-      # Blobstore writes cannot exceed the RPC size limit, so chunk the writes.
-      while True:
-        content_chunk = content_file.read(BLOBSTORE_APPEND_CHUNK_SIZE)
-        if not content_chunk:
-          break
-        blobstore_file.write(content_chunk)
-      blobstore_file.close()
-      blobstore_files.finalize(filename)
-      blob = blobstore_files.blobstore.get_blob_key(filename)
-      files_cache.StoreBlob(self.real_path, content)
+    content_md5_hash = None
+    compressed = None
+    if content is not None:
+      content_md5_hash = hashlib.md5(content).hexdigest()
+      # Skip compressing and uploading content which is already stored, unless
+      # a compress argument changes how it would be stored.
+      if (exists and not force and content_md5_hash == self._file.md5_hash
+          and encoding == self._file.encoding):
+        stored_compression = self._file.compression
+        if compress is not None and content:
+          compressed = _CompressContent(
+              content, content_mime_type, compress=compress)
+          # Content stored in blobstore is never compressed.
+          stored_compression = None
+          if len(compressed[0]) <= MAX_CONTENT_SIZE:
+            stored_compression = compressed[1]
+        if stored_compression == self._file.compression:
+          content = None
+
+    # Compress content if worthwhile. Must come after encoding.
+    stored_content, compression = content, None
+    if content:
+      stored_content, compression = compressed or _CompressContent(
+          content, content_mime_type, compress=compress)
+
+    # Should we store content in blobstore? Must come after compression.
+    blob_content = None
+    if stored_content and len(stored_content) > MAX_CONTENT_SIZE:
+      blob_size = len(content)
+      blob_md5_hash = content_md5_hash
+      if exists and self._file.blob and self._file.md5_hash == blob_md5_hash:
+        # The file already references a blob with this content.
+        blob = self._file.blob
+      else:
+        # Reference an existing blob with the same content, or upload one.
+        blob = yield _AcquireBlobAsync(blob_md5_hash)
+        if not blob:
+          logging.debug(
+              'Content size %s exceeds %s bytes, uploading to blobstore.',
+              blob_size, MAX_CONTENT_SIZE)
+          if upload_semaphore:
+            new_blob, _, _ = yield _WriteBlobAsync(content, upload_semaphore)
+          else:
+            new_blob, _, _ = _WriteBlob(_IterChunks(
+                cStringIO.StringIO(content)))
+          blob = yield _AcquireBlobAsync(blob_md5_hash, new_blob=new_blob)
+      # Cache the content after the entity put is started, below.
+      blob_content = content
       content = None
+      stored_content, compression = None, None
+    elif blob is not None and blob_size is None and (
+        not exists or self._file.blob != blob):
+      # A new BlobKey was given directly, so look up its size and hash once
+      # here rather than every time they are read.
+      blob_size, blob_md5_hash = _GetBlobSizesAndHashes([blob])[0]
+      if blob_md5_hash is None:
+        # Use the hash stored by files which already share the blob, since
+        # their reference count is kept under it.
+        sharing_file_ent = yield _TitanFile.query(
+            _TitanFile.blob == blob).get_async()
+        if sharing_file_ent:
+          blob_md5_hash = sharing_file_ent.md5_hash
+      # Count this file's reference, so that deleting or overwriting another
+      # file which shares the blob does not delete it.
+      blob = yield _ShareBlobAsync(blob, blob_md5_hash, min_refs=0)
 
-    if not self.exists:
+    changed = False
+    old_blob = None
+    old_blob_md5_hash = None
+    if not exists:
       # Create new _File entity.
       # Guess the MIME type if not given.
       if not mime_type:
         mime_type = utils.GuessMimeType(self.real_path)
 
       # Create a new _File.
-      paths = utils.SplitPath(self.real_path)
-      self._file_ent = _TitanFile(
-          id=self.real_path,
-          name=os.path.basename(self.real_path),
-          dir_path=paths[-1],
-          paths=paths,
-          # Root files are at depth 0.
-          depth=len(paths) - 1,
+      self._file_ent = _NewTitanFile(
+          self.real_path,
           mime_type=mime_type,
           encoding=encoding,
-          modified=datetime.datetime.now(),
-          content=content,
+          content=stored_content,
+          compression=compression,
           blob=blob,
-          # Backwards-compatibility with deprecated "blobs" property:
-          blobs=[],
-          md5_hash=None if blob else hashlib.md5(content).hexdigest(),
+          size=blob_size if blob else len(content),
+          md5_hash=blob_md5_hash if blob else content_md5_hash,
       )
       # Add meta attributes.
       if meta:
         for key, value in meta.iteritems():
           setattr(self._file, key, value)
-      self._file.put()
     else:
       # Updating an existing _File.
+      old_blob_md5_hash = self._file.md5_hash
       if mime_type and self._file.mime_type != mime_type:
         self._file.mime_type = mime_type
+        changed = True
 
       # Auto-migrate entities from old "blobs" to new "blob" property on write:
       if self._file.blobs:
         self._file.blob = self._file.blobs[0]
         self._file.blobs = []
-
-      if content is not None and self._file.content != content:
-        self._file.content = content
-        self._file.md5_hash = hashlib.md5(content).hexdigest()
+        changed = True
+
+      if content is not None and (self._file.content != stored_content
+                                  or self._file.compression != compression):
+        self._file.content = stored_content
+        self._file.compression = compression
+        self._file.size = len(content)
+        self._file.md5_hash = content_md5_hash
         if self._file.blob and _delete_old_blob:
-          # Delete the actual blobstore data.
-          blobstore.delete(self._file.blob)
-          files_cache.ClearBlobsForFiles(self._file)
+          old_blob = self._file.blob
         # Clear the current blob association for this file.
         self._file.blob = None
+        changed = True
 
       if blob is not None and self._file.blob != blob:
         if self._file.blob and _delete_old_blob:
-          # Delete the actual blobstore data.
-          blobstore.delete(self._file.blob)
-          files_cache.ClearBlobsForFiles(self._file)
+          old_blob = self._file.blob
         # Associate the new blob to this file.
         self._file.blob = blob
-        self._file.md5_hash = None
+        self._file.size = blob_size
+        self._file.md5_hash = blob_md5_hash
         self._file.content = None
-
-      if encoding != self._file.encoding:
+        self._file.compression = None
+        changed = True
+      elif blob is not None and fp is not None:
+        # A stream with the same content as the current blob added an extra
+        # reference to it, which must be released.
+        old_blob = blob
+
+      # Auto-migrate entities written before size was stored:
+      if self._file.size is None and self._file.content is not None:
+        self._file.size = len(self._file.content)
+        changed = True
+
+      # Only content updates can change the encoding.
+      if (content is not None or blob is not None) and (
+          encoding != self._file.encoding):
         self._file.encoding = encoding
+        changed = True
 
       # Update meta attributes.
       if meta is not None:
         for key, value in meta.iteritems():
           if not hasattr(self._file, key) or getattr(self._file, key) != value:
             setattr(self._file, key, value)
-      self._file.put()
-    return self
+            changed = True
 
-  def Delete(self):
+      if not changed and not force:
+        logging.info('Skipping write of unchanged Titan file: %s',
+                     self.real_path)
+        _RecordSkippedWrite()
+
+    raise ndb.Return(_PendingWrite(
+        self, needs_put=not exists or changed or force, old_blob=old_blob,
+        old_blob_md5_hash=old_blob_md5_hash, blob_content=blob_content))
+
+  def Delete(self, **kwargs):
     """Delete file.
 
+    Args:
+      **kwargs: Extra keyword arguments for subclasses' DeleteAsync().
+    Raises:
+      BadFileError: If the file does not exist.
     Returns:
       Self-reference.
     """
-    if self.blob:
-      blobstore.delete(self._file.blob)
+    return self.DeleteAsync(**kwargs).get_result()
+
+  def DeleteAsync(self):
+    """Asynchronous version of Delete().
+
+    NOTE: subclasses should customize delete behavior by overriding this method
+    instead of Delete(), since Delete() is a synchronous wrapper around it.
+
+    Returns:
+      An ndb.Future whose result is a self-reference. The future will raise
+      BadFileError if the file does not exist.
+    """
+    return self._DeleteAsync()
+
+  @ndb.tasklet
+  def _DeleteAsync(self):
+    """Tasklet containing the core of DeleteAsync()."""
+    exists = yield self._LoadAsync()
+    if not exists:
+      raise BadFileError('File does not exist: %s' % self.real_path)
+    futures = [self._file.key.delete_async()]
+    if self._file.blob or self._file.blobs:
+      blob_key = self._file.blob or self._file.blobs[0]
+      futures.append(_ReleaseBlobsAsync([blob_key], [self._file.md5_hash]))
       files_cache.ClearBlobsForFiles(self._file)
-    self._file.key.delete()
+    yield futures
+    files_cache.InvalidateFileEntities([self.real_path])
     self._file_ent = None
     self._meta = None
-    return self
+    self.OnFilesDeleted([self])
+    raise ndb.Return(self)
 
   def CopyTo(self, destination_file):
     """Copy this and all of its properties to a different path.
 
+    Content is not re-read or re-uploaded: the copy is a single entity put,
+    and blob-backed files share the source's blob, which is reference counted
+    and only deleted once no file references it.
+
     Args:
       destination_file: A File object of the destination path.
     Returns:
       Self-reference.
     """
+    return self.CopyToAsync(destination_file).get_result()
+
+  def CopyToAsync(self, destination_file):
+    """Asynchronous version of CopyTo().
+
+    Args:
+      destination_file: A File object of the destination path.
+    Returns:
+      An ndb.Future whose result is a self-reference.
+    """
     assert isinstance(destination_file, File)
     logging.info('Copying Titan file: %s --> %s', self.real_path,
                  destination_file.real_path)
-    if destination_file.exists:
-      # TODO(user): make this DeleteAsync when available.
-      destination_file.Delete()
-    destination_file.Write(
+    return self._CopyToAsync(destination_file)
+
+  @ndb.tasklet
+  def _CopyToAsync(self, destination_file):
+    """Tasklet containing the core of CopyToAsync()."""
+    source_exists, destination_exists = yield (
+        self._LoadAsync(), destination_file._LoadAsync())
+    if not source_exists:
+      raise BadFileError('File does not exist: %s' % self.real_path)
+
+    # Add a reference to the source's blob for the destination file. This is
+    # taken before deleting the destination, which may share the same blob.
+    blob = self._blob_key
+    if blob:
+      blob = yield _ShareBlobAsync(blob, self._file.md5_hash)
+
+    if (_IsOverridden(destination_file, '_file')
+        or _IsOverridden(destination_file, 'Write')
+        or _IsOverridden(destination_file, 'WriteAsync')
+        or _IsOverridden(destination_file, 'Delete')
+        or _IsOverridden(destination_file, 'DeleteAsync')):
+      # Preserve the destination's custom write behavior (such as from mixins).
+      if destination_exists:
+        yield destination_file.DeleteAsync()
+      yield destination_file.WriteAsync(
+          content=None if blob else _GetInlineContent(self._file),
+          blob=blob,
+          mime_type=self.mime_type,
+          meta=self.meta.Serialize())
+      if blob:
+        # WriteAsync() counted the destination's own reference to the blob.
+        yield _ReleaseBlobsAsync([blob], [self._file.md5_hash])
+      raise ndb.Return(self)
+
+    # Replace the destination entity, copying stored content as-is.
+    old_file_ent = destination_file._file if destination_exists else None
+    destination_file._file_ent = _NewTitanFile(
+        destination_file.real_path,
+        mime_type=self._file.mime_type,
+        encoding=self._file.encoding,
         content=self._file.content,
-        blob=self._file.blob,
-        mime_type=self.mime_type,
-        meta=self.meta.Serialize())
-    return self
+        compression=self._file.compression,
+        blob=blob,
+        size=self.size,
+        md5_hash=self._file.md5_hash,
+    )
+    for key in self._file.meta_properties:
+      setattr(destination_file._file, key, getattr(self._file, key))
+    destination_file._meta = None
+    futures = [destination_file._file.put_async()]
+    if old_file_ent and (old_file_ent.blob or old_file_ent.blobs):
+      old_blob = old_file_ent.blob or old_file_ent.blobs[0]
+      futures.append(_ReleaseBlobsAsync([old_blob], [old_file_ent.md5_hash]))
+      if old_blob != blob:
+        files_cache.ClearBlobsForFiles(old_file_ent)
+    yield futures
+    files_cache.InvalidateFileEntities([destination_file.real_path])
+    destination_file.OnFilesWritten([destination_file])
+    raise ndb.Return(self)
+
+  @classmethod
+  def OnFilesWritten(cls, titan_files):
+    """Hook called after files of this class are written.
+
+    Batch operations such as Files.WriteMulti() call this once per File class
+    instead of once per file, so mixins can override it to do combined work,
+    such as adding one task for many paths. Overrides must call super.
 
-  def Serialize(self, full=False):
+    Args:
+      titan_files: A list of File objects which were written.
+    """
+
+  @classmethod
+  def OnFilesDeleted(cls, titan_files):
+    """Hook called after files of this class are deleted.
+
+    Like OnFilesWritten(), this is called once per File class by batch
+    operations such as Files.Delete(). Overrides must call super.
+
+    Args:
+      titan_files: A list of File objects which were deleted.
+    """
+
+  @ndb.tasklet
+  def _LoadAsync(self):
+    """Tasklet to load the file entity, returning whether the file exists."""
+    if self.is_loaded:
+      raise ndb.Return(True)
+    if self._file_batch or _IsOverridden(self, '_file'):
+      # Defer to the batch or to the subclass' custom loading behavior.
+      raise ndb.Return(self.exists)
+    self._file_ent = yield ndb.Key(_TitanFile, self.real_path).get_async()
+    raise ndb.Return(bool(self._file_ent))
+
+  def Serialize(self, full=False, fields=None):
     """Serialize the File object to native Python types.
 
     Args:
       full: Whether or not to include this object's content. Potentially
           expensive if the content is large and particularly if the content is
           stored in blobstore.
+      fields: An optional iterable of property names to include, such as
+          ('path', 'size', 'md5_hash'). Properties which are not requested are
+          never computed, and unknown names are ignored. Overrides "full".
+    Raises:
+      BadFileError: If the file doesn't exist.
     Returns:
       A serializable dictionary of this File object's properties.
     """
-    result = {
-        'name': self.name,
-        'path': self.path,
-        'real_path': self.real_path,
-        'paths': self.paths,
-        'mime_type': self.mime_type,
-        'created': self.created,
-        'blob': str(self.blob) if self.blob else None,
-        'modified': self.modified,
-        'created_by': str(self.created_by) if self.created_by else None,
-        'modified_by': str(self.modified_by) if self.modified_by else None,
-        'meta': {},
-        'size': self.size,
-        'md5_hash': self.md5_hash,
+    # Load the file once up front, even if only cheap fields are requested.
+    file_ent = self._file
+    serializers = {
+        'name': lambda: self.name,
+        'path': lambda: self.path,
+        'real_path': lambda: self.real_path,
+        'paths': lambda: self.paths,
+        'mime_type': lambda: self.mime_type,
+        'created': lambda: self.created,
+        'blob': lambda: str(self._blob_key) if self._blob_key else None,
+        'modified': lambda: self.modified,
+        'created_by': (
+            lambda: str(self.created_by) if self.created_by else None),
+        'modified_by': (
+            lambda: str(self.modified_by) if self.modified_by else None),
+        'meta': lambda: dict([(key, getattr(file_ent, key))
+                              for key in file_ent.meta_properties]),
+        'size': lambda: self.size,
+        'md5_hash': lambda: self.md5_hash,
+        'content': lambda: self.content,
     }
-    if full:
-      result['content'] = self.content
-    for key in self._file_ent.meta_properties:
-      result['meta'][key] = getattr(self._file_ent, key)
-    return result
+    if fields is None:
+      fields = [key for key in serializers if key != 'content']
+      if full:
+        fields.append('content')
+    return dict([(field, serializers[field]()) for field in fields
+                 if field in serializers])
 
   @staticmethod
   def ValidatePath(path):
@@ -513,14 +900,20 @@ def UnregisterFileFactory():
   _global_file_factory.Unregister()
 
 class Files(collections.Mapping):
-  """A mapping of paths to File objects."""
+  """A mapping of paths to File objects.
 
-  def __init__(self, paths=None, files=None):
+  Unloaded File objects in the container are lazily loaded in groups: the first
+  property access on any unloaded file loads its whole batch with one RPC.
+  """
+
+  def __init__(self, paths=None, files=None, batch_size=DEFAULT_BATCH_SIZE):
     """Constructor.
 
     Args:
       paths: An iterable of absolute filenames.
       files: An iteratble of File objects. Required if paths not specified.
+      batch_size: The number of unloaded files to lazily load together, or
+          None to load the whole container at once.
     Raises:
       ValueError: If given invalid paths.
       TypeError: If given both paths and files.
@@ -539,6 +932,15 @@ class Files(collections.Mapping):
       for titan_file in files:
         self._titan_files[titan_file.path] = titan_file
 
+    # Group unloaded files into batches which are loaded on first access.
+    # Files which customize their own loading are left to load individually.
+    unloaded_files = [f for f in self._titan_files.itervalues()
+                      if not f.is_loaded and not _IsOverridden(f, '_file')]
+    if unloaded_files:
+      batch_size = batch_size or len(unloaded_files)
+      for i in range(0, len(unloaded_files), batch_size):
+        _FileBatch(unloaded_files[i:i + batch_size])
+
   def __delitem__(self, path):
     del self._titan_files[path]
 
@@ -576,25 +978,194 @@ class Files(collections.Mapping):
       self[titan_file.path] = titan_file
 
   def Delete(self):
-    """Delete all files in this container."""
-    # TODO(user): implement batch operation. For now, the naive way:
+    """Delete all files in this container.
+
+    Files are loaded with a single batch RPC (if not already loaded), then all
+    entities, blobs, and blob caches are deleted with batch RPCs. Shared blobs
+    are only deleted once they are no longer referenced. Files which
+    override Delete() or DeleteAsync() (such as from mixins) are deleted
+    individually. Other mixins are notified once per File class through the
+    OnFilesDeleted() hook.
+
+    Raises:
+      BadFileError: If any of the files do not exist.
+    Returns:
+      Self-reference.
+    """
+    custom_files = []
+    batch_files = []
     for titan_file in self.itervalues():
+      if (_IsOverridden(titan_file, 'Delete')
+          or _IsOverridden(titan_file, 'DeleteAsync')):
+        custom_files.append(titan_file)
+      else:
+        batch_files.append(titan_file)
+
+    # Verify that all files exist before deleting anything.
+    missing_files = _LoadTitanFiles(batch_files, use_cache=False)
+    if missing_files:
+      raise BadFileError('File does not exist: %s' % missing_files[0].real_path)
+
+    for titan_file in custom_files:
       titan_file.Delete()
+
+    if batch_files:
+      file_ents = _GetFileEntities(batch_files)
+      blob_file_ents = [ent for ent in file_ents if ent.blob or ent.blobs]
+      futures = ndb.delete_multi_async([ent.key for ent in file_ents])
+      if blob_file_ents:
+        futures.append(_ReleaseBlobsAsync(
+            [ent.blob or ent.blobs[0] for ent in blob_file_ents],
+            [ent.md5_hash for ent in blob_file_ents]))
+      ndb.Future.wait_all(futures)
+      for future in futures:
+        future.check_success()
+      paths = [ent.path for ent in file_ents]
+      # Per-file invalidation is only needed if the subtree wasn't invalidated.
+      if not _InvalidateDeletedDirs(paths):
+        if blob_file_ents:
+          files_cache.ClearBlobsForFiles(blob_file_ents)
+        files_cache.InvalidateFileEntities(paths)
+      for titan_file in batch_files:
+        titan_file._file_ent = None
+        titan_file._meta = None
+      _CallFilesHook(batch_files, 'OnFilesDeleted')
+
     # Empty the container:
     self._titan_files = {}
     return self
 
   def Load(self):
-    """If not loaded, load associated paths and removing non-existing ones."""
-    # TODO(user): optimize this. For now, the naive way:
+    """If not loaded, load associated paths and removing non-existing ones.
+
+    All unloaded files are fetched with a single batch RPC; files which are
+    already loaded are reused.
+
+    Returns:
+      Self-reference.
+    """
+    missing_files = _LoadTitanFiles(self.values())
+    missing_file_ids = set([id(f) for f in missing_files])
     paths_to_clear = []
     for path, titan_file in self._titan_files.iteritems():
-      if not titan_file.exists:
+      if id(titan_file) in missing_file_ids:
         paths_to_clear.append(path)
     for path in paths_to_clear:
       del self[path]
     return self
 
+  def ReadContents(self):
+    """Read the content of all files, with batch RPCs for cached blobs.
+
+    Raises:
+      BadFileError: If any of the files don't exist.
+    Returns:
+      A dictionary of paths to content, as given by each File's content
+      property.
+    """
+    # Subclasses which override content must be read individually.
+    custom_paths = set([path for path, titan_file in self.iteritems()
+                        if _IsOverridden(titan_file, 'content')])
+    blob_sizes = {}
+    for path, titan_file in self.iteritems():
+      if path not in custom_paths and titan_file._file.content is None:
+        blob_sizes[path] = titan_file._file.size
+    cached_blobs, stale_paths = files_cache.GetBlobsWithStaleness(
+        blob_sizes, sizes=blob_sizes)
+
+    contents = {}
+    for path, titan_file in self.iteritems():
+      if path in custom_paths:
+        contents[path] = titan_file.content
+        continue
+      file_ent = titan_file._file
+      if file_ent.content is not None:
+        content = _GetInlineContent(file_ent)
+      else:
+        content = cached_blobs.get(path)
+        if content is None or path in stale_paths:
+          content = _FillBlobCache(file_ent, stale_content=content)
+      contents[path] = _DecodeContent(file_ent, content)
+    return contents
+
+  @classmethod
+  def WriteMulti(cls, files_data, **file_kwargs):
+    """Write or update many files at once.
+
+    Existence is checked with a single batch RPC, and all new or changed file
+    entities are stored with a single batch put. Large content is uploaded to
+    blobstore concurrently, though streams given as "fp" are still consumed
+    one at a time. Files which override Write() or WriteAsync() (such as from
+    mixins) are written individually. Other mixins are notified once per File
+    class through the OnFilesWritten() hook.
+
+    Usage:
+      files.Files.WriteMulti({
+          '/foo.html': {'content': '<p>Foo</p>'},
+          '/bar.css': {'content': 'p {}', 'mime_type': 'text/css'},
+      })
+
+    Args:
+      files_data: A dictionary mapping absolute paths to dictionaries of
+          keyword arguments for File.Write(), such as content, mime_type,
+          and meta.
+      **file_kwargs: Extra keyword arguments for instantiating each File,
+          such as for mixins.
+    Raises:
+      ValueError: If given invalid paths.
+      TypeError: For missing or invalid write arguments.
+      BadFileError: If updating meta information on a non-existent file.
+    Returns:
+      A Files mapping of the written files.
+    """
+    Files.ValidatePaths(files_data)
+    titan_files = cls(
+        files=[File(path, **file_kwargs) for path in files_data.iterkeys()])
+    custom_files = []
+    batch_files = []
+    for path, titan_file in titan_files.iteritems():
+      if (_IsOverridden(titan_file, 'Write')
+          or _IsOverridden(titan_file, 'WriteAsync')):
+        custom_files.append(titan_file)
+      else:
+        _ValidateWriteArgs(**files_data[path])
+        batch_files.append(titan_file)
+
+    # Verify that all meta updates are for existing files before writing.
+    missing_files = _LoadTitanFiles(batch_files, use_cache=False)
+    missing_file_ids = set([id(f) for f in missing_files])
+    for titan_file in missing_files:
+      write_kwargs = files_data[titan_file.path]
+      if (write_kwargs.get('content') is None
+          and write_kwargs.get('blob') is None
+          and write_kwargs.get('fp') is None):
+        raise BadFileError('File does not exist: %s' % titan_file.real_path)
+
+    for titan_file in custom_files:
+      titan_file.Write(**files_data[titan_file.path])
+
+    if batch_files:
+      # Upload large content from separate threads only when there are several
+      # uploads to overlap.
+      upload_semaphore = None
+      num_large_files = len([
+          f for f in batch_files
+          if len(files_data[f.path].get('content') or '') > MAX_CONTENT_SIZE])
+      if num_large_files > 1:
+        upload_semaphore = threading.BoundedSemaphore(
+            MAX_CONCURRENT_BLOB_UPLOADS)
+      futures = []
+      for titan_file in batch_files:
+        logging.info('Writing Titan file: %s', titan_file.real_path)
+        futures.append(titan_file._PrepareWriteAsync(
+            exists=id(titan_file) not in missing_file_ids,
+            upload_semaphore=upload_semaphore,
+            **files_data[titan_file.path]))
+      pending_writes = [future.get_result() for future in futures]
+      _CommitWritesAsync(pending_writes).get_result()
+      _CallFilesHook(batch_files, 'OnFilesWritten')
+    return titan_files
+
   @classmethod
   def Merge(cls, first_files, second_files):
     """Return a new Files instance merged from two others."""
@@ -613,12 +1184,19 @@ class Files(collections.Mapping):
     Returns:
       A Files mapping containing existing files.
     """
+    return cls.GetAsync(paths).get_result()
+
+  @classmethod
+  def GetAsync(cls, paths):
+    """Asynchronous version of Get().
+
+    Args:
+      paths: An iterable of absolute paths.
+    Returns:
+      An ndb.Future whose result is a Files mapping containing existing files.
+    """
     Files.ValidatePaths(paths)
-    titan_file_objs, _ = _GetTitanFiles(paths)
-    # Filter out non-existent files:
-    titan_file_objs = [f for f in titan_file_objs if f]
-    titan_files = cls(files=titan_file_objs)
-    return titan_files
+    return _GetFilesAsync(cls, paths)
 
   @classmethod
   def List(cls, dir_path, recursive=False, depth=None, filters=None,
@@ -638,36 +1216,62 @@ class Files(collections.Mapping):
     Returns:
       A populated Files mapping.
     """
-    if depth is not None and depth <= 0:
-      raise ValueError('depth argument must be a positive integer.')
-    if filters is not None and not hasattr(filters, '__iter__'):
-      raise ValueError('"filters" must be an iterable.')
-    utils.ValidateDirPath(dir_path)
-
-    # Strip trailing slash.
-    if dir_path != '/' and dir_path.endswith('/'):
-      dir_path = dir_path[:-1]
-
-    files_query = _TitanFile.query()
-    if recursive:
-      files_query = files_query.filter(_TitanFile.paths == dir_path)
-      if depth is not None:
-        dir_path_depth = 0 if dir_path == '/' else dir_path.count('/')
-        depth_filter = _TitanFile.depth <= dir_path_depth + depth
-        files_query = files_query.filter(depth_filter)
-      files_query = files_query.filter(_TitanFile.paths == dir_path)
-    else:
-      files_query = files_query.filter(_TitanFile.dir_path == dir_path)
-
-    if filters:
-      for ndb_filter in filters:
-        files_query = files_query.filter(ndb_filter)
-
-    # TODO(user): support cursors.
+    files_query = _MakeListQuery(dir_path, recursive=recursive, depth=depth,
+                                 filters=filters)
     file_keys = files_query.fetch(limit=limit, offset=offset, keys_only=True)
     titan_files = cls([key.id() for key in file_keys])
     return titan_files
 
+  @classmethod
+  def IterList(cls, dir_path, recursive=False, depth=None, filters=None,
+               batch_size=DEFAULT_BATCH_SIZE, cursor=None):
+    """Generator which lists files in the given dir, one loaded page at a time.
+
+    Unlike List(), this uses datastore cursors instead of offsets, so it can
+    walk arbitrarily large directories without holding every key in memory.
+    While the caller handles one page, the next page's batch get and the
+    keys-only query of the page after it are already in flight.
+
+    Usage:
+      for titan_files, cursor in files.Files.IterList('/', recursive=True):
+        ...
+        # To resume in a later request, pass cursor.urlsafe() back in.
+
+    Args:
+      dir_path: Absolute directory path.
+      recursive: Whether to list files recursively.
+      depth: If recursive, a positive integer to limit the recursion depth.
+          1 is one folder deep, 2 is two folders deep, etc.
+      filters: An iterable of FileProperty objects.
+      batch_size: The number of files to fetch per page.
+      cursor: An ndb.Cursor or urlsafe cursor string to resume listing from.
+    Raises:
+      ValueError: If given an invalid depth or batch_size argument.
+    Yields:
+      Two-tuples of (<Files mapping of loaded files>, <cursor>), where cursor
+      is an ndb.Cursor pointing after the page, or None on the last page.
+    """
+    if batch_size <= 0:
+      raise ValueError('batch_size argument must be a positive integer.')
+    files_query = _MakeListQuery(dir_path, recursive=recursive, depth=depth,
+                                 filters=filters)
+    if isinstance(cursor, basestring):
+      cursor = ndb.Cursor(urlsafe=cursor)
+
+    page = _StartListPage(files_query, batch_size, cursor)
+    while page:
+      ent_futures, cursor, next_keys_future = page
+      file_ents = [future.get_result() for future in ent_futures]
+      # Start fetching the next page's entities before handing this page to
+      # the caller.
+      page = None
+      if next_keys_future:
+        page = _StartListPage(files_query, batch_size, next_keys_future)
+      # Entities may be missing if deleted since the eventually-consistent
+      # query results were computed.
+      titan_files = [File(ent.path, _file_ent=ent) for ent in file_ents if ent]
+      yield cls(files=titan_files), cursor
+
   @staticmethod
   def ValidatePaths(paths):
     if not hasattr(paths, '__iter__'):
@@ -702,11 +1306,13 @@ class _TitanFile(ndb.Expando):
     created: Created datetime.
     modified: Last-modified datetime.
     content: Byte string of the file's contents.
+    compression: If content is compressed, the compression format: 'zlib'.
     blob: If content is null, a BlobKey pointing to the file.
     blobs: Deprecated; use "blob" instead.
     created_by: A users.User object of who first created the file, or None.
     modified_by: A users.User object of who last modified the file, or None.
     md5_hash: Pre-computed md5 hash of the entity's content or blob.
+    size: Pre-computed size in bytes of the entity's content or blob.
   """
   name = ndb.StringProperty()
   dir_path = ndb.StringProperty()
@@ -717,12 +1323,17 @@ class _TitanFile(ndb.Expando):
   created = ndb.DateTimeProperty(auto_now_add=True)
   modified = ndb.DateTimeProperty(auto_now=True)
   content = ndb.BlobProperty()
+  compression = ndb.StringProperty(indexed=False)
   blob = ndb.BlobKeyProperty()
   # Deprecated; use "blob" instead.
   blobs = ndb.BlobKeyProperty(repeated=True)
   created_by = ndb.UserProperty(auto_current_user_add=True)
   modified_by = ndb.UserProperty(auto_current_user=True)
   md5_hash = ndb.StringProperty(indexed=False)
+  size = ndb.IntegerProperty(indexed=False)
+
+  # Set to True to put the entity without changing its modified properties.
+  _preserve_modified = False
 
   BASE_PROPERTIES = frozenset((
       'name',
@@ -734,11 +1345,13 @@ class _TitanFile(ndb.Expando):
       'created',
       'modified',
       'content',
+      'compression',
       'blob',
       'blobs',
       'created_by',
       'modified_by',
       'md5_hash',
+      'size',
   ))
 
   @classmethod
@@ -762,6 +1375,15 @@ class _TitanFile(ndb.Expando):
       meta_properties.pop(name)
     return meta_properties
 
+  def _prepare_for_put(self):
+    """Override of ndb.Model method to support _preserve_modified."""
+    if not self._preserve_modified:
+      super(_TitanFile, self)._prepare_for_put()
+      return
+    modified, modified_by = self.modified, self.modified_by
+    super(_TitanFile, self)._prepare_for_put()
+    self.modified, self.modified_by = modified, modified_by
+
   @staticmethod
   def ValidateMetaProperties(meta):
     """Verify that meta properties are valid."""
@@ -771,6 +1393,163 @@ class _TitanFile(ndb.Expando):
       if key in _TitanFile.BASE_PROPERTIES:
         raise InvalidMetaError('Invalid name for meta property: "%s"' % key)
 
+class _TitanBlobRef(ndb.Model):
+  """Model for reference counting of content-addressed blobs.
+
+  Blobs written by File.Write() are shared by all files with the same content,
+  and are only deleted when their last reference is removed.
+
+  Blobs of unknown content hash start being reference counted when shared by
+  File.CopyTo(), using an id derived from their BlobKey.
+
+  Attributes:
+    id: The md5 hash of the blob's content, or see _GetBlobKeyRefId().
+    blob: A BlobKey pointing to the content.
+    ref_count: The number of _TitanFile entities which reference the blob.
+  """
+  blob = ndb.BlobKeyProperty(indexed=False)
+  ref_count = ndb.IntegerProperty(indexed=False, default=0)
+
+class _FileBatch(object):
+  """A group of unloaded File objects which are loaded together."""
+
+  def __init__(self, titan_files):
+    self._titan_files = titan_files
+    for titan_file in self._titan_files:
+      titan_file._file_batch = self
+
+  def Load(self):
+    """Load all files in the batch with a single RPC."""
+    titan_files = self._titan_files
+    # Detach first, so each file only ever triggers one batch load.
+    self._titan_files = []
+    for titan_file in titan_files:
+      titan_file._file_batch = None
+    _LoadTitanFiles(titan_files)
+
+class _PendingWrite(object):
+  """A file entity which has been updated in memory, but not yet stored."""
+
+  def __init__(self, titan_file, needs_put, old_blob=None,
+               old_blob_md5_hash=None, blob_content=None):
+    """Constructor.
+
+    Args:
+      titan_file: The File object being written.
+      needs_put: Whether or not the file entity changed and must be stored.
+      old_blob: A BlobKey which the file no longer references, or None.
+      old_blob_md5_hash: The MD5 hash of old_blob's content.
+      blob_content: Content which was uploaded to blobstore, to be cached.
+    """
+    self.titan_file = titan_file
+    self.needs_put = needs_put
+    self.old_blob = old_blob
+    self.old_blob_md5_hash = old_blob_md5_hash
+    self.blob_content = blob_content
+
+def GetBatchLoadCounts():
+  """Get request-local counts of batch loads of File objects.
+
+  Returns:
+    A dictionary containing "batches" (the number of batch RPCs made), "files"
+    (the number of files loaded by them), and "rpcs_saved" (how many fewer RPCs
+    were made than if each file had been loaded individually).
+  """
+  counts = os.environ.get(_ENVIRON_BATCH_LOAD_COUNTS_NAME)
+  if not counts:
+    return {'batches': 0, 'files': 0, 'rpcs_saved': 0}
+  batches, num_files = counts
+  return {
+      'batches': batches,
+      'files': num_files,
+      'rpcs_saved': num_files - batches,
+  }
+
+def _RecordBatchLoad(num_files):
+  # os.environ is replaced by the runtime environment with a request-local
+  # object, allowing non-string types to be stored globally in the environment
+  # and automatically cleaned up at the end of each request.
+  batches, total_files = os.environ.get(_ENVIRON_BATCH_LOAD_COUNTS_NAME, (0, 0))
+  os.environ[_ENVIRON_BATCH_LOAD_COUNTS_NAME] = (
+      batches + 1, total_files + num_files)
+
+def GetSkippedWriteCount():
+  """Get the request-local number of writes skipped because nothing changed."""
+  return os.environ.get(_ENVIRON_SKIPPED_WRITES_NAME, 0)
+
+def _RecordSkippedWrite():
+  os.environ[_ENVIRON_SKIPPED_WRITES_NAME] = GetSkippedWriteCount() + 1
+
+def BackfillSizeAndHash(cursor=None, batch_size=DEFAULT_BATCH_SIZE):
+  """Store size and md5_hash on file entities which were written without them.
+
+  Processes one batch of entities, then defers a task to process the next batch.
+  Entities are updated without changing their modified or modified_by values.
+  Each entity is updated in its own transaction, so that files written while
+  the backfill runs are not reverted.
+
+  Usage:
+    deferred.defer(files.BackfillSizeAndHash)
+
+  Args:
+    cursor: A urlsafe cursor string of where to continue the backfill.
+    batch_size: The number of entities to process in each task.
+  Returns:
+    The number of entities updated in this batch.
+  """
+  if cursor:
+    cursor = ndb.Cursor(urlsafe=cursor)
+  file_ents, next_cursor, more = _TitanFile.query().fetch_page(
+      batch_size, start_cursor=cursor)
+
+  stale_file_ents = [ent for ent in file_ents if ent.size is None and (
+      ent.content is not None or ent.blob or ent.blobs)]
+
+  # Get all BlobInfos with a single RPC.
+  blob_keys = [ent.blob or ent.blobs[0] for ent in stale_file_ents
+               if ent.content is None and (ent.blob or ent.blobs)]
+  blob_sizes_and_hashes = dict(
+      zip(blob_keys, _GetBlobSizesAndHashes(blob_keys)))
+  for blob_key, (size, _) in blob_sizes_and_hashes.iteritems():
+    if size is None:
+      logging.error('Blob does not exist for Titan file: %s', blob_key)
+
+  @ndb.tasklet
+  def Backfill(key):
+    # Re-get the entity, since it may have been written since it was queried.
+    file_ent = yield key.get_async()
+    if not file_ent or file_ent.size is not None:
+      raise ndb.Return(None)
+    if file_ent.content is not None:
+      content = _GetInlineContent(file_ent)
+      size = len(content)
+      md5_hash = file_ent.md5_hash or hashlib.md5(content).hexdigest()
+    elif file_ent.blob or file_ent.blobs:
+      size, md5_hash = blob_sizes_and_hashes.get(
+          file_ent.blob or file_ent.blobs[0], (None, None))
+    else:
+      size = None
+    if size is None:
+      raise ndb.Return(None)
+    file_ent.size = size
+    file_ent.md5_hash = md5_hash
+    file_ent._preserve_modified = True
+    try:
+      yield file_ent.put_async()
+    finally:
+      file_ent._preserve_modified = False
+    raise ndb.Return(file_ent.path)
+
+  futures = [ndb.transaction_async(lambda key=ent.key: Backfill(key))
+             for ent in stale_file_ents]
+  changed_paths = [path for path in (f.get_result() for f in futures) if path]
+  files_cache.InvalidateFileEntities(changed_paths)
+
+  if more and next_cursor:
+    deferred.defer(BackfillSizeAndHash, cursor=next_cursor.urlsafe(),
+                   batch_size=batch_size)
+  return len(changed_paths)
+
 # ------------------------------------------------------------------------------
 
 def _GetTitanFiles(paths):
@@ -785,12 +1564,39 @@ def _GetTitanFiles(paths):
 
   # Wrap all the _TitanFile entities in <File> objects.
   paths = paths if is_multiple else [paths]
-  file_ents = ndb.get_multi([ndb.Key(_TitanFile, path) for path in paths])
+  file_ents = _GetTitanFileEntities(paths)
   titan_files = []
   for f in file_ents:
     titan_files.append(File(f.path, _file_ent=f) if f else None)
   return titan_files if is_multiple else titan_files[0], is_multiple
 
+@ndb.tasklet
+def _GetFilesAsync(files_class, paths):
+  """Tasklet to get a Files object containing only the files which exist."""
+  file_keys = [ndb.Key(_TitanFile, path) for path in paths]
+  file_ents = yield ndb.get_multi_async(file_keys)
+  # Filter out non-existent files:
+  titan_file_objs = [File(f.path, _file_ent=f) for f in file_ents if f]
+  raise ndb.Return(files_class(files=titan_file_objs))
+
+def _GetTitanFileEntities(paths):
+  """Get _TitanFile entities (or Nones), using the file entity caches.
+
+  Args:
+    paths: An already-validated list of absolute filenames.
+  Returns:
+    A list of _TitanFile entities, or None for each non-existent file.
+  """
+  cached_file_ents, generations = files_cache.GetFileEntities(paths)
+  uncached_paths = [path for path in paths if path not in cached_file_ents]
+  if uncached_paths:
+    file_ents = ndb.get_multi(
+        [ndb.Key(_TitanFile, path) for path in uncached_paths])
+    fetched_file_ents = dict(zip(uncached_paths, file_ents))
+    files_cache.StoreFileEntities(fetched_file_ents, generations)
+    cached_file_ents.update(fetched_file_ents)
+  return [cached_file_ents[path] for path in paths]
+
 def _GetTitanFilesOrDie(paths):
   """Same as _GetFiles, but raises BadFileError if a path doesn't exist."""
   file_objs, is_multiple = _GetTitanFiles(paths)
@@ -817,21 +1623,546 @@ def _GetFileEntities(titan_files):
     file_ents.append(titan_file._file if titan_file else None)
   return file_ents
 
+def _MakeListQuery(dir_path, recursive=False, depth=None, filters=None):
+  """Make a _TitanFile query for listing files. See Files.List for args."""
+  if depth is not None and depth <= 0:
+    raise ValueError('depth argument must be a positive integer.')
+  if filters is not None and not hasattr(filters, '__iter__'):
+    raise ValueError('"filters" must be an iterable.')
+  utils.ValidateDirPath(dir_path)
+
+  # Strip trailing slash.
+  if dir_path != '/' and dir_path.endswith('/'):
+    dir_path = dir_path[:-1]
+
+  files_query = _TitanFile.query()
+  if recursive:
+    files_query = files_query.filter(_TitanFile.paths == dir_path)
+    if depth is not None:
+      dir_path_depth = 0 if dir_path == '/' else dir_path.count('/')
+      depth_filter = _TitanFile.depth <= dir_path_depth + depth
+      files_query = files_query.filter(depth_filter)
+    files_query = files_query.filter(_TitanFile.paths == dir_path)
+  else:
+    files_query = files_query.filter(_TitanFile.dir_path == dir_path)
+
+  if filters:
+    for ndb_filter in filters:
+      files_query = files_query.filter(ndb_filter)
+  return files_query
+
+def _InvalidateDeletedDirs(paths):
+  """Invalidates the caches under the dir of deleted files, if now empty.
+
+  When a whole subtree is deleted (such as all files from a recursive List()),
+  this orphans every cache entry under it with one memcache RPC, including the
+  subdir lists of nested dirs which per-file invalidation doesn't reach. If the
+  eventually consistent query still finds deleted files, per-file invalidation
+  must be used instead.
+
+  Args:
+    paths: A list of the absolute paths of deleted files.
+  Returns:
+    Whether the dir was invalidated.
+  """
+  # Single files are not worth the extra query.
+  if len(paths) < 2:
+    return False
+  dir_path = utils.GetCommonDirPath(paths)
+  if _MakeListQuery(dir_path, recursive=True).get(keys_only=True):
+    return False
+  files_cache.InvalidateDirs([dir_path])
+  return True
+
+def _StartListPage(files_query, batch_size, keys_future_or_cursor):
+  """Start the batch get of one page, and the keys-only query of the next.
+
+  Tasklets only make progress while something waits on the event loop, so
+  instead of chaining the query and the get in one tasklet, this waits for the
+  page's keys and sends the get before returning. The get skips memcache,
+  since a memcache miss would also leave the datastore get unsent.
+
+  Args:
+    files_query: A _TitanFile query.
+    batch_size: The page size.
+    keys_future_or_cursor: The future of the page's keys-only fetch_page_async,
+        or an ndb.Cursor (or None) to start that query from.
+  Returns:
+    A three-tuple of (<list of futures of _TitanFile entities or None>,
+    <ndb.Cursor for the next page, or None if there are no more pages>,
+    <future of the next page's keys-only query, or None>).
+  """
+  keys_future = keys_future_or_cursor
+  if not isinstance(keys_future, ndb.Future):
+    keys_future = files_query.fetch_page_async(
+        batch_size, start_cursor=keys_future_or_cursor, keys_only=True)
+  file_keys, next_cursor, more = keys_future.get_result()
+  ent_futures = ndb.get_multi_async(file_keys, use_memcache=False)
+  if not more:
+    next_cursor = None
+  next_keys_future = None
+  if next_cursor:
+    next_keys_future = files_query.fetch_page_async(
+        batch_size, start_cursor=next_cursor, keys_only=True)
+  # Send the batched get now rather than when the caller next waits.
+  ndb.get_context().flush()
+  return ent_futures, next_cursor, next_keys_future
+
+def _LoadTitanFiles(titan_files, use_cache=True):
+  """Load File objects in-place, using one batch RPC for all unloaded files.
+
+  Files which are already loaded are not fetched again. Files whose class
+  overrides the _file property (such as from mixins) are loaded individually
+  to preserve their custom behavior.
+
+  Args:
+    titan_files: An iterable of File objects.
+    use_cache: Whether or not to use the file entity caches. Writes should
+        not use them, so that they always update the latest entities.
+  Returns:
+    A list of the given File objects which do not exist.
+  """
+  missing_files = []
+  unloaded_files = []
+  for titan_file in titan_files:
+    if titan_file.is_loaded:
+      continue
+    if _IsOverridden(titan_file, '_file'):
+      if not titan_file.exists:
+        missing_files.append(titan_file)
+      continue
+    unloaded_files.append(titan_file)
+  if not unloaded_files:
+    return missing_files
+
+  if use_cache:
+    file_ents = _GetTitanFileEntities([f.real_path for f in unloaded_files])
+  else:
+    file_ents = ndb.get_multi(
+        [ndb.Key(_TitanFile, f.real_path) for f in unloaded_files])
+  _RecordBatchLoad(len(unloaded_files))
+  for titan_file, file_ent in zip(unloaded_files, file_ents):
+    if file_ent:
+      titan_file._file_ent = file_ent
+    else:
+      missing_files.append(titan_file)
+  return missing_files
+
+@ndb.tasklet
+def _CommitWritesAsync(pending_writes):
+  """Tasklet to store file entities and clean up after prepared writes.
+
+  All changed entities are stored with one batch put, then old blobs are
+  released and the blob cache is updated while the put is in flight.
+
+  Args:
+    pending_writes: A list of _PendingWrite objects.
+  """
+  file_ents = [w.titan_file._file for w in pending_writes if w.needs_put]
+  futures = ndb.put_multi_async(file_ents)
+  old_blob_writes = [w for w in pending_writes if w.old_blob]
+  if old_blob_writes:
+    # Delete the actual blobstore data, unless it is shared with other files.
+    futures.append(_ReleaseBlobsAsync(
+        [w.old_blob for w in old_blob_writes],
+        [w.old_blob_md5_hash for w in old_blob_writes]))
+    changed_blob_file_ents = [w.titan_file._file for w in old_blob_writes
+                              if w.old_blob != w.titan_file._file.blob]
+    if changed_blob_file_ents:
+      files_cache.ClearBlobsForFiles(changed_blob_file_ents)
+  for pending_write in pending_writes:
+    if pending_write.blob_content is not None:
+      # Batched with the other blobs' memcache sets.
+      futures.append(files_cache.StoreBlobAsync(
+          pending_write.titan_file.real_path, pending_write.blob_content))
+  yield futures
+  files_cache.InvalidateFileEntities([ent.path for ent in file_ents])
+
+def _CallFilesHook(titan_files, hook_name):
+  """Call a File classmethod hook once per File class of the given files."""
+  files_by_class = collections.OrderedDict()
+  for titan_file in titan_files:
+    files_by_class.setdefault(type(titan_file), []).append(titan_file)
+  for file_class, class_files in files_by_class.iteritems():
+    getattr(file_class, hook_name)(class_files)
+
+def _IsOverridden(titan_file, attr_name):
+  """Whether the File object's class overrides the given File attribute."""
+  base_attr = File.__dict__[attr_name]
+  for cls in type(titan_file).__mro__:
+    if attr_name in cls.__dict__:
+      return cls.__dict__[attr_name] is not base_attr
+  return False
+
+def _ValidateWriteArgs(content=None, blob=None, mime_type=None, meta=None,
+                       fp=None, compress=None, force=False,
+                       _delete_old_blob=True):
+  """Sanity-check File.Write() arguments.
+
+  Raises:
+    TypeError: For missing or unexpected arguments.
+    InvalidMetaError: If meta contains invalid properties.
+  """
+  _TitanFile.ValidateMetaProperties(meta)
+  is_content_update = (content is not None or blob is not None
+                       or fp is not None)
+  is_meta_update = mime_type is not None or meta is not None
+  if not is_content_update and not is_meta_update:
+    raise TypeError('Arguments expected, but none given.')
+  if content and blob:
+    raise TypeError('Exactly one of "content" or "blob" must be given.')
+  if fp is not None and (content is not None or blob is not None):
+    raise TypeError('"fp" cannot be given with "content" or "blob".')
+
+def _IterChunks(fp, chunk_size=BLOBSTORE_APPEND_CHUNK_SIZE):
+  """Yields non-empty byte-string chunks from a file-like object or iterable."""
+  if hasattr(fp, 'read'):
+    fp = iter(lambda: fp.read(chunk_size), '')
+  for chunk in fp:
+    if isinstance(chunk, unicode):
+      raise TypeError('Streamed content must be byte strings, not unicode.')
+    if chunk:
+      yield chunk
+
+def _ReadStream(fp, max_content_size=MAX_CONTENT_SIZE):
+  """Consumes a stream into either inline content or a new blob.
+
+  At most max_content_size bytes (plus one chunk) are buffered. Once a stream
+  exceeds that size, the buffered and remaining chunks are written to blobstore.
+
+  Args:
+    fp: A file-like object or an iterable of byte-string chunks.
+    max_content_size: The largest stream to return as content.
+  Returns:
+    A four-tuple of (content, blob, blob_size, blob_md5_hash). Exactly one of
+    content or blob will be set; blob_size and blob_md5_hash are only set for
+    blobs.
+  """
+  chunks = _IterChunks(fp)
+  head_chunks = []
+  head_size = 0
+  for chunk in chunks:
+    head_chunks.append(chunk)
+    head_size += len(chunk)
+    if head_size > max_content_size:
+      logging.debug(
+          'Streamed content exceeds %s bytes, uploading to blobstore.',
+          max_content_size)
+      blob, blob_size, blob_md5_hash = _WriteBlob(
+          itertools.chain(head_chunks, chunks))
+      return None, blob, blob_size, blob_md5_hash
+  return ''.join(head_chunks), None, None, None
+
+def _WriteBlob(chunks):
+  """Writes chunks of bytes to a new blob, hashing the content along the way.
+
+  Args:
+    chunks: An iterable of byte strings.
+  Returns:
+    A three-tuple of (blob_key, size, md5_hash).
+  """
+  md5 = hashlib.md5()
+  size = 0
+  filename = blobstore_files.blobstore.create()
+  blobstore_file = blobstore_files.open(filename, 'a')
+  for chunk in chunks:
+    md5.update(chunk)
+    size += len(chunk)
+    # Blobstore writes cannot exceed the RPC size limit, so chunk the writes.
+    for i in xrange(0, len(chunk), BLOBSTORE_APPEND_CHUNK_SIZE):
+      blobstore_file.write(chunk[i:i + BLOBSTORE_APPEND_CHUNK_SIZE])
+  blobstore_file.close()
+  blobstore_files.finalize(filename)
+  blob_key = blobstore_files.blobstore.get_blob_key(filename)
+  return blob_key, size, md5.hexdigest()
+
+@ndb.tasklet
+def _WriteBlobAsync(content, semaphore):
+  """Tasklet which writes content to a new blob from a separate thread.
+
+  The blobstore files API is synchronous, so the upload runs in a thread while
+  the tasklet polls for it, which lets the uploads of Files.WriteMulti()
+  overlap. Single writes call _WriteBlob() directly instead.
+
+  Args:
+    content: A byte string.
+    semaphore: A semaphore which the thread holds while uploading, to bound
+        the number of concurrent uploads.
+  Returns:
+    A three-tuple of (blob_key, size, md5_hash).
+  """
+  result = {}
+
+  def Upload():
+    with semaphore:
+      try:
+        result['blob'] = _WriteBlob(_IterChunks(cStringIO.StringIO(content)))
+      except Exception:
+        result['exc_info'] = sys.exc_info()
+
+  thread = threading.Thread(target=Upload)
+  thread.start()
+  while thread.is_alive():
+    yield ndb.sleep(BLOB_UPLOAD_POLL_SECONDS)
+  thread.join()
+  if 'exc_info' in result:
+    exc_type, exc_value, exc_traceback = result['exc_info']
+    raise exc_type, exc_value, exc_traceback
+  raise ndb.Return(result['blob'])
+
+@ndb.tasklet
+def _AcquireBlobAsync(md5_hash, new_blob=None):
+  """Tasklet to add a reference to the content-addressed blob for a hash.
+
+  Args:
+    md5_hash: The md5 hash of the content.
+    new_blob: The BlobKey of newly uploaded content with the given hash. If a
+        blob with the same content already exists, new_blob is deleted and the
+        existing blob is referenced instead.
+  Returns:
+    The referenced BlobKey, or None if no blob exists and new_blob wasn't given.
+  """
+  blob = yield ndb.transaction_async(
+      lambda: _IncrementBlobRefAsync(md5_hash, new_blob))
+  if new_blob and blob != new_blob:
+    logging.debug('Deduplicated blob with md5 hash: %s', md5_hash)
+    yield blobstore.delete_async(new_blob)
+  raise ndb.Return(blob)
+
+@ndb.tasklet
+def _IncrementBlobRefAsync(md5_hash, new_blob):
+  """Transactional tasklet for _AcquireBlobAsync."""
+  blob_ref = yield _TitanBlobRef.get_by_id_async(md5_hash)
+  if not blob_ref:
+    if not new_blob:
+      raise ndb.Return(None)
+    blob_ref = _TitanBlobRef(id=md5_hash, blob=new_blob)
+  blob_ref.ref_count += 1
+  yield blob_ref.put_async()
+  raise ndb.Return(blob_ref.blob)
+
+@ndb.tasklet
+def _ShareBlobAsync(blob_key, md5_hash, min_refs=1):
+  """Tasklet to add a reference to an existing blob.
+
+  Unlike _AcquireBlobAsync(), this also starts reference counting for blobs
+  which were not written by File.Write(), such as BlobKeys given to Write()
+  directly. The files which already reference such a blob are counted along
+  with the new reference.
+
+  Args:
+    blob_key: An existing BlobKey.
+    md5_hash: The md5 hash of the blob's content, or None if unknown.
+    min_refs: The number of files known to reference the blob already, in case
+        the query for them is not yet consistent.
+  Returns:
+    The BlobKey to reference. If the given blob is an untracked duplicate of
+    a tracked blob, the tracked blob is returned instead.
+  """
+
+  @ndb.tasklet
+  def Transaction(ref_id, ref_count):
+    blob_ref = yield _TitanBlobRef.get_by_id_async(ref_id)
+    if not blob_ref:
+      if ref_count is None:
+        raise ndb.Return(None)
+      blob_ref = _TitanBlobRef(id=ref_id, blob=blob_key, ref_count=ref_count)
+    blob_ref.ref_count += 1
+    yield blob_ref.put_async()
+    raise ndb.Return(blob_ref.blob)
+
+  # Look up references in the same order as _DecrementBlobRefAsync().
+  ref_ids = [md5_hash] if md5_hash else []
+  ref_ids.append(_GetBlobKeyRefId(blob_key))
+  for ref_id in ref_ids:
+    blob = yield ndb.transaction_async(
+        lambda ref_id=ref_id: Transaction(ref_id, None))
+    if blob is not None:
+      raise ndb.Return(blob)
+
+  # Queries can't run in the transaction, so count untracked references
+  # outside of it and only when the blob isn't reference counted yet.
+  query = _TitanFile.query(_TitanFile.blob == blob_key)
+  ref_count = yield query.count_async()
+  blob = yield ndb.transaction_async(
+      lambda: Transaction(ref_ids[0], max(ref_count, min_refs)))
+  raise ndb.Return(blob)
+
+@ndb.tasklet
+def _ReleaseBlobsAsync(blob_keys, md5_hashes):
+  """Tasklet to remove references to blobs, deleting unreferenced blobs.
+
+  Args:
+    blob_keys: A list of BlobKeys.
+    md5_hashes: A list of the md5 hashes of each blob's content, or None for
+        blobs which were not written by File.Write().
+  """
+  is_unreferenced = yield [_DecrementBlobRefAsync(blob_key, md5_hash)
+                           for blob_key, md5_hash in zip(blob_keys, md5_hashes)]
+  unreferenced_blob_keys = [blob_key for blob_key, is_deletable
+                            in zip(blob_keys, is_unreferenced) if is_deletable]
+  if unreferenced_blob_keys:
+    yield blobstore.delete_async(unreferenced_blob_keys)
+
+@ndb.tasklet
+def _DecrementBlobRefAsync(blob_key, md5_hash):
+  """Tasklet returning whether a blob has no references left after this one."""
+
+  @ndb.tasklet
+  def Transaction(ref_id):
+    blob_ref = yield _TitanBlobRef.get_by_id_async(ref_id)
+    if not blob_ref or blob_ref.blob != blob_key:
+      raise ndb.Return(None)
+    blob_ref.ref_count -= 1
+    if blob_ref.ref_count > 0:
+      yield blob_ref.put_async()
+      raise ndb.Return(False)
+    yield blob_ref.key.delete_async()
+    raise ndb.Return(True)
+
+  # Blobs shared by CopyTo() before their hash was known are tracked by
+  # BlobKey, even if the file's hash has since been backfilled.
+  ref_ids = [md5_hash] if md5_hash else []
+  ref_ids.append(_GetBlobKeyRefId(blob_key))
+  for ref_id in ref_ids:
+    result = yield ndb.transaction_async(
+        lambda ref_id=ref_id: Transaction(ref_id))
+    if result is not None:
+      raise ndb.Return(result)
+  # The blob is not reference counted, so only one file references it.
+  raise ndb.Return(True)
+
+def _GetBlobKeyRefId(blob_key):
+  """Returns the _TitanBlobRef id for a blob whose content hash is unknown."""
+  return 'blob-key:%s' % blob_key
+
+def _GetBlobSizesAndHashes(blob_keys):
+  """Returns a list of (size, md5_hash) tuples, or (None, None) if missing."""
+  if not blob_keys:
+    return []
+  results = []
+  for blob_info in blobstore.BlobInfo.get(blob_keys):
+    if not blob_info:
+      results.append((None, None))
+      continue
+    # md5_hash is not populated by all blobstore implementations.
+    results.append((blob_info.size, getattr(blob_info, 'md5_hash', None)))
+  return results
+
+def _CompressContent(content, mime_type, compress=None):
+  """Compresses content for storage in the datastore, if worthwhile.
+
+  Content of compressible MIME types is compressed if large enough. Content of
+  other MIME types, which is often already compressed (such as images), is
+  only compressed to try to avoid storing it in blobstore, and only if a prefix
+  of it compresses enough for the whole content to fit inline.
+
+  Args:
+    content: A non-empty byte string.
+    mime_type: The MIME type of the content.
+    compress: True or False to force or disable compression, or None to decide
+        by MIME type and content size.
+  Returns:
+    A two-tuple of (stored_content, compression). If the content was not
+    compressed, this is (content, None).
+  """
+  if compress is None:
+    if (len(content) < MIN_COMPRESSION_SIZE
+        or len(content) > MAX_COMPRESSIBLE_CONTENT_SIZE):
+      compress = False
+    elif utils.IsCompressibleMimeType(mime_type):
+      compress = True
+    elif len(content) > MAX_CONTENT_SIZE:
+      probe = content[:COMPRESSION_PROBE_SIZE]
+      compress = (len(zlib.compress(probe)) * len(content)
+                  <= len(probe) * MAX_CONTENT_SIZE)
+    else:
+      compress = False
+  if not compress:
+    return content, None
+  compressed_content = zlib.compress(content)
+  if len(compressed_content) >= len(content):
+    return content, None
+  return compressed_content, 'zlib'
+
+def _NewTitanFile(path, **kwargs):
+  """Returns a new _TitanFile entity for a path, with the given properties."""
+  paths = utils.SplitPath(path)
+  return _TitanFile(
+      id=path,
+      name=os.path.basename(path),
+      dir_path=paths[-1],
+      paths=paths,
+      # Root files are at depth 0.
+      depth=len(paths) - 1,
+      modified=datetime.datetime.now(),
+      # Backwards-compatibility with deprecated "blobs" property:
+      blobs=[],
+      **kwargs)
+
+def _GetInlineContent(file_ent):
+  """Returns the uncompressed content byte string of a file entity, or None."""
+  content = file_ent.content
+  # Use getattr, since deprecated _File entities may not have this property.
+  if content is not None and getattr(file_ent, 'compression', None) == 'zlib':
+    content = zlib.decompress(content)
+  return content
+
 def _ReadContentOrBlob(titan_file):
   file_ent = _GetFileEntities(titan_file)
   if file_ent.content is not None:
-    content = file_ent.content
+    content = _GetInlineContent(file_ent)
   else:
-    content = files_cache.GetBlob(file_ent.path)
-    if content is None:
-      blob = file_ent.blob
-      if not file_ent.blob:
-        # Backwards-compatibility with deprecated "blobs" property:
-        blob = blobstore.BlobInfo.get(file_ent.blobs[0])
-      if not isinstance(blob, blobstore.BlobInfo):
-        blob = blobstore.BlobInfo(blob)
-      content = blob.open().read()
-      files_cache.StoreBlob(file_ent.path, content)
+    # Use getattr, since deprecated _File entities don't have a size.
+    sizes = {file_ent.path: getattr(file_ent, 'size', None)}
+    contents, stale_paths = files_cache.GetBlobsWithStaleness(
+        sizes, sizes=sizes)
+    content = contents.get(file_ent.path)
+    if content is None or file_ent.path in stale_paths:
+      content = _FillBlobCache(file_ent, stale_content=content)
+  return _DecodeContent(file_ent, content)
+
+def _FillBlobCache(file_ent, stale_content=None):
+  """Reads a file entity's blob content, letting one request fill the cache.
+
+  Only the request which acquires the blob's lease reads it from blobstore and
+  caches it. Other requests are given the stale content if there is any, or
+  wait briefly for the fill and otherwise read from blobstore without caching.
+
+  Args:
+    file_ent: The _File entity.
+    stale_content: Stale cached content of the blob, if any.
+  Returns:
+    The blob's content byte string.
+  """
+  lease = files_cache.AcquireBlobLease(file_ent.path)
+  if lease:
+    try:
+      return _ReadBlobContent(file_ent)
+    finally:
+      files_cache.ReleaseBlobLease(file_ent.path, lease)
+  if stale_content is not None:
+    return stale_content
+  content = files_cache.WaitForBlob(file_ent.path,
+                                    size=getattr(file_ent, 'size', None))
+  if content is None:
+    content = _ReadBlobContent(file_ent, store=False)
+  return content
+
+def _ReadBlobContent(file_ent, store=True):
+  """Reads a file entity's blob content from blobstore, and maybe caches it."""
+  blob = file_ent.blob
+  if not file_ent.blob:
+    # Backwards-compatibility with deprecated "blobs" property:
+    blob = blobstore.BlobInfo.get(file_ent.blobs[0])
+  if not isinstance(blob, blobstore.BlobInfo):
+    blob = blobstore.BlobInfo(blob)
+  content = blob.open().read()
+  if store:
+    files_cache.StoreBlob(file_ent.path, content)
+  return content
+
+def _DecodeContent(file_ent, content):
   if file_ent.encoding == 'utf-8':
     return content.decode('utf-8')
   return content
@@ -1022,33 +2353,42 @@ class DeprecatedFile(object):
     self._exists = True
     return Touch(self._path, async=async)
 
-  def Serialize(self, full=False):
+  def Serialize(self, full=False, fields=None):
     """Serialize the File object to native Python types.
 
     Args:
       full: Whether or not to include this object's content. Potentially
           expensive if the content is large and particularly if the content is
           stored in blobstore.
+      fields: An optional iterable of property names to include. Properties
+          which are not requested are never computed. Overrides "full".
     Returns:
       A serializable dictionary of this File object's properties.
     """
-    result = {
-        'name': self.name,
-        'path': self._path,
-        'paths': self.paths,
-        'mime_type': self.mime_type,
-        'created': self.created,
-        'blob': str(self.blob.key()) if self.blob else None,
-        'modified': self.modified,
-        'exists': self.exists,
-        'created_by': str(self.created_by) if self.created_by else None,
-        'modified_by': str(self.modified_by) if self.modified_by else None,
+    serializers = {
+        'name': lambda: self.name,
+        'path': lambda: self._path,
+        'paths': lambda: self.paths,
+        'mime_type': lambda: self.mime_type,
+        'created': lambda: self.created,
+        'blob': lambda: str(self.blob.key()) if self.blob else None,
+        'modified': lambda: self.modified,
+        'exists': lambda: self.exists,
+        'created_by': (
+            lambda: str(self.created_by) if self.created_by else None),
+        'modified_by': (
+            lambda: str(self.modified_by) if self.modified_by else None),
+        'content': lambda: self.content,
     }
-    if full:
-      result['content'] = self.content
-    for key in self._file_ent.dynamic_properties():
-      result[key] = getattr(self._file_ent, key)
-    return result
+    # Load the entity, if not already loaded, to find its dynamic properties.
+    for key in self._file.dynamic_properties():
+      serializers[key] = lambda key=key: getattr(self._file, key)
+    if fields is None:
+      fields = [key for key in serializers if key != 'content']
+      if full:
+        fields.append('content')
+    return dict([(field, serializers[field]()) for field in fields
+                 if field in serializers])
 
 class _File(db.Expando):
   """DEPRECATED. DO NOT USE."""
@@ -1245,7 +2585,7 @@ def Write(path, content=None, blob=None, mime_type=None, meta=None,
     if meta:
       for key, value in meta.iteritems():
         setattr(file_ent, key, value)
-    rpc = db.put_async(file_ent)
+    rpc = db.put_async(file_ent, config=_InvalidateFileEntitiesConfig([path]))
 
     # Cache the entity.
     files_cache.StoreFiles(file_ent)
@@ -1266,19 +2606,21 @@ def Write(path, content=None, blob=None, mime_type=None, meta=None,
     if content is not None and file_ent.content != content:
       file_ent.content = content
       if file_ent.blob and _delete_old_blob:
-        # Delete the actual blobstore data.
-        file_ent.blob.delete()
+        # Delete the actual blobstore data, unless other files reference it.
+        _ReleaseLegacyBlobs([file_ent])
       # Clear the current blob association for this file.
       file_ent.blob = None
+      _ClearContentProperties(file_ent)
       changed = True
 
     if blob is not None and file_ent.blob != blob:
       if file_ent.blob and _delete_old_blob:
-        # Delete the actual blobstore data.
-        file_ent.blob.delete()
+        # Delete the actual blobstore data, unless other files reference it.
+        _ReleaseLegacyBlobs([file_ent])
       # Associate the new blob to this file.
       file_ent.blob = blob
       file_ent.content = None
+      _ClearContentProperties(file_ent)
       changed = True
 
     if encoding != file_ent.encoding:
@@ -1295,7 +2637,8 @@ def Write(path, content=None, blob=None, mime_type=None, meta=None,
     # Preserve the old modified time if nothing has changed.
     if changed:
       file_ent.modified = datetime.datetime.now()
-      rpc = db.put_async(file_ent)
+      rpc = db.put_async(
+          file_ent, config=_InvalidateFileEntitiesConfig([path]))
       # Update the cache.
       files_cache.StoreFiles(file_ent)
     else:
@@ -1307,6 +2650,50 @@ def Write(path, content=None, blob=None, mime_type=None, meta=None,
     result = DeprecatedFile(path, _file_ent=file_ent)
   return result
 
+def _InvalidateFileEntitiesConfig(paths):
+  """Returns a datastore config which invalidates cached entities when done.
+
+  Cached file entities must only be invalidated once the datastore RPC has
+  completed, or else a concurrent read could cache the old entity again under
+  the new generation. The invalidation happens when the RPC is waited on.
+
+  Args:
+    paths: A list of absolute file paths.
+  Returns:
+    A datastore_rpc.Configuration for db.put_async() or db.delete_async().
+  """
+  return db.create_config(
+      on_completion=lambda rpc: files_cache.InvalidateFileEntities(paths))
+
+def _ReleaseLegacyBlobs(file_ents):
+  """Remove references to the blobs of _File entities, deleting unused blobs.
+
+  Blobs may be shared with other files by deduplication or CopyTo(), so they
+  must only be deleted through the _TitanBlobRef reference counts.
+
+  Args:
+    file_ents: A list of _File entities, some of which may have blobs.
+  """
+  blob_keys = []
+  md5_hashes = []
+  for file_ent in file_ents:
+    # Backwards-compatibility with deprecated "blobs" property.
+    if file_ent.blob:
+      blob_keys.append(file_ent.blob.key())
+    elif file_ent.blobs:
+      blob_keys.append(file_ent.blobs[0])
+    else:
+      continue
+    md5_hashes.append(getattr(file_ent, 'md5_hash', None))
+  if blob_keys:
+    _ReleaseBlobsAsync(blob_keys, md5_hashes).get_result()
+
+def _ClearContentProperties(file_ent):
+  """Remove content-dependent properties maintained by the new File API."""
+  for name in ('compression', 'md5_hash', 'size'):
+    if hasattr(file_ent, name):
+      delattr(file_ent, name)
+
 @hooks.ProvideHook('file-delete')
 def Delete(paths, async=False, update_subdir_caches=False,
            _delete_old_blobs=True):
@@ -1327,31 +2714,29 @@ def Delete(paths, async=False, update_subdir_caches=False,
     Datastore RPC object: if async is True.
   """
   _LogDeprecationNotice()
-  # With one RPC, delete any associated blobstore files for all paths.
   file_objs, is_multiple = _GetFilesOrDie(paths)
   # Only use paths which are already validated by _GetFilesOrDie.
   paths = [f.path for f in file_objs] if is_multiple else file_objs.path
-  blob_keys = []
-  files_list = file_objs if is_multiple else [file_objs]
-  for file_obj in files_list:
-    if file_obj.blob:
-      blob_keys.append(file_obj.blob.key())
-  if blob_keys and _delete_old_blobs:
-    blobstore.delete(blob_keys)
+  file_ents = _GetFileEntities(file_objs)
+  # Delete any associated blobstore files which no other file references.
+  if _delete_old_blobs:
+    _ReleaseLegacyBlobs(file_ents if is_multiple else [file_ents])
 
   # Flag these files in cache as non-existent, cleanup subdir and blob caches.
-  file_ents = _GetFileEntities(file_objs)
   files_cache.SetFileDoesNotExist(paths)
   files_cache.ClearSubdirsForFiles(file_ents)
   if _delete_old_blobs:
     files_cache.ClearBlobsForFiles(file_ents)
 
+  paths = paths if is_multiple else [paths]
   if update_subdir_caches:
-    paths = paths if is_multiple else [paths]
     deferred.defer(ListDir, utils.GetCommonDirPath(paths))
 
-  rpc = db.delete_async(file_ents)
-  return rpc if async else rpc.get_result()
+  rpc = db.delete_async(file_ents, config=_InvalidateFileEntitiesConfig(paths))
+  if async:
+    return rpc
+  rpc.get_result()
+  _InvalidateDeletedDirs(paths)
 
 @hooks.ProvideHook('file-touch')
 def Touch(paths, meta=None, async=False):
@@ -1398,8 +2783,10 @@ def Touch(paths, meta=None, async=False):
         file_ents = file_ent
     file_ent.modified = now
 
-  # Start the put, then update the file cache and subdir caches.
-  rpc = db.put_async(file_ents)
+  # Start the put, then update the file cache and subdir caches. Cached
+  # entities are invalidated once the put is done.
+  rpc = db.put_async(
+      file_ents, config=_InvalidateFileEntitiesConfig(paths_list))
   files_cache.StoreFiles(file_ents)
   files_cache.UpdateSubdirsForFiles(file_ents)
 
@@ -1439,6 +2826,14 @@ def Copy(source_path, destination_path, async=False):
                        % source_path)
   logging.info('Copying Titan file: %s --> %s', source_path, destination_path)
 
+  # Use file_obj here, to correct handle old "blobs" property.
+  blob = source_file_obj.blob
+  if blob:
+    # Add a reference to the source's blob for the destination file before
+    # deleting the destination, which may already share the same blob.
+    md5_hash = getattr(source_file_ent, 'md5_hash', None)
+    blob = _ShareBlobAsync(blob.key(), md5_hash).get_result()
+
   # Delete the file if it currently exists so old properties don't persist.
   try:
     delete_rpc = Delete(destination_path, async=True, disabled_services=True)
@@ -1446,13 +2841,18 @@ def Copy(source_path, destination_path, async=False):
     delete_rpc = None
 
   # Copy all source file properties.
-  content = source_file_ent.content
-  # Use file_obj here, to correct handle old "blobs" property.
-  blob = source_file_obj.blob
+  content = _GetInlineContent(source_file_ent)
   mime_type = source_file_ent.mime_type
   meta = {}
   for key in source_file_ent.dynamic_properties():
-    meta[key] = getattr(source_file_ent, key)
+    # Skip properties which are not meta data in the new File API.
+    if key not in _TitanFile.BASE_PROPERTIES:
+      meta[key] = getattr(source_file_ent, key)
+  if blob:
+    # The content hash identifies the reference count of the shared blob.
+    for key in ('md5_hash', 'size'):
+      if hasattr(source_file_ent, key):
+        meta[key] = getattr(source_file_ent, key)
 
   if delete_rpc:
     delete_rpc.wait()
@@ -1504,6 +2904,9 @@ def CopyDir(source_dir_path, destination_dir_path, dry_run=False):
   if dry_run:
     return new_paths
   file_keys = [rpc.get_result() for rpc in async_results]
+  # Invalidate everything cached under the destination with one RPC, rather
+  # than leaving stale subdir lists and entries from before the copy.
+  files_cache.InvalidateDirs([destination_dir_path])
   return [DeprecatedFile(key.name()) for key in file_keys]
 
 @hooks.ProvideHook('list-files')
@@ -13,22 +13,100 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""A convenience wrapper for internal Titan memcache operations."""
+"""A convenience wrapper for internal Titan memcache operations.
+
+Lookups also have asynchronous versions, which return futures. Their memcache
+calls are made through the ndb context, which merges the calls of all tasklets
+waiting in the same event loop pass into one batch RPC:
+  file_futures = [files_cache.GetFilesAsync(path) for path in paths]
+  blob_future = files_cache.GetBlobAsync(blob_path)
+  # ...other work...
+  cached_files = [future.get_result() for future in file_futures]
+
+File, file entity, blob and dir cache keys are namespaced by the generations
+of every directory above (and for dirs, including) their path. InvalidateDirs()
+bumps a directory's generation, which orphans every cached entry in its subtree
+with one memcache RPC. The orphaned entries are never read again and expire.
+"""
 
 import collections
+import cPickle as pickle
+import hashlib
 import logging
 import os
+import threading
+import time
 from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from titan.common import cache_stats
 from titan.common import sharded_cache
 
 # Pseudo namespaces for memcache values.
 FILE_MEMCACHE_PREFIX = 'titan-file:'
 BLOB_MEMCACHE_PREFIX = 'titan-blob:'
+BLOB_LEASE_MEMCACHE_PREFIX = 'titan-blob-lease:'
 DIR_MEMCACHE_PREFIX = 'titan-dir:'
+FILE_ENTITY_MEMCACHE_PREFIX = 'titan-file-entity:'
+FILE_GENERATION_MEMCACHE_PREFIX = 'titan-file-generation:'
+DIR_GENERATION_MEMCACHE_PREFIX = 'titan-dir-generation:'
+
+_ENVIRON_DIR_GENERATIONS_NAME = 'titan-dir-generations'
+
+# Names under which cache_stats are recorded for each cache, and for the
+# per-instance memory cache of file entities.
+FILE_CACHE_STATS_NAME = 'titan-file'
+BLOB_CACHE_STATS_NAME = 'titan-blob'
+DIR_CACHE_STATS_NAME = 'titan-dir'
+FILE_ENTITY_CACHE_STATS_NAME = 'titan-file-entity'
+FILE_ENTITY_MEMORY_CACHE_STATS_NAME = 'titan-file-entity-memory'
+CACHE_STATS_NAMES = (
+    FILE_CACHE_STATS_NAME,
+    BLOB_CACHE_STATS_NAME,
+    DIR_CACHE_STATS_NAME,
+    FILE_ENTITY_CACHE_STATS_NAME,
+    FILE_ENTITY_MEMORY_CACHE_STATS_NAME,
+    sharded_cache.CACHE_STATS_NAME,
+)
 
 # The flag to store in memcache signifying that a file doesn't exist.
 _NO_FILE_FLAG = False
 
+# The max number of file entities kept in each instance's memory (L1) cache.
+FILE_ENTITY_CACHE_MAX_SIZE = 1000
+# How long an instance keeps a file entity in memory before re-fetching it
+# from memcache (L2). Entities are only used while their generation is current,
+# which is checked in memcache on every lookup.
+FILE_ENTITY_CACHE_SECONDS = 60
+# How long file entities are kept in memcache (L2).
+FILE_ENTITY_MEMCACHE_SECONDS = 60 * 60  # 1 hour
+
+# How long blobs are fresh in the cache. If BLOB_STALE_SECONDS is non-zero,
+# blobs stay cached for that much longer after becoming stale, and while one
+# request refreshes a stale blob, other requests are served the stale content
+# (stale-while-revalidate). Since the cache entry of a blob is replaced when its
+# file's content changes, stale content is only older, not outdated.
+BLOB_FRESH_SECONDS = sharded_cache.DEFAULT_EXPIRATION_SECONDS
+BLOB_STALE_SECONDS = 0
+
+# How long a request may hold the lease to fill a blob's cache entry, after
+# which another request may take over (such as if the holder failed).
+BLOB_LEASE_SECONDS = 30
+# How long requests which miss a blob being filled by another request wait for
+# the fill, and how often they check for it, before reading from blobstore.
+BLOB_LEASE_WAIT_SECONDS = 0.5
+BLOB_LEASE_POLL_SECONDS = 0.1
+
+# The max number of compare-and-set attempts for each batch of dir cache
+# updates. Entries which still conflict after this are deleted.
+DIR_CACHE_CAS_RETRIES = 3
+
+# Per-instance memory (L1) cache of paths to tuples of
+# (<memcache key>, <expiration timestamp>, <pickled entity or _NO_FILE_FLAG>),
+# ordered from least to most recently used. The memcache key is stamped with
+# the file and dir generations under which the entity was cached.
+_file_entity_cache = collections.OrderedDict()
+_file_entity_cache_lock = threading.Lock()
+
 def GetFiles(paths):
   """Given paths, get _File entities (or Nones) if each file state is cached.
 
@@ -38,38 +116,39 @@ def GetFiles(paths):
     On cache hit: A tuple of (<Entity or list of entities>, True).
     On cache miss: (None, False)
   """
+  return GetFilesAsync(paths).get_result()
+
+@ndb.tasklet
+def GetFilesAsync(paths):
+  """Asynchronous version of GetFiles().
+
+  Returns:
+    A future whose result is the same tuple as GetFiles().
+  """
   is_multiple = hasattr(paths, '__iter__')
-  if is_multiple:
-    cache_keys = [FILE_MEMCACHE_PREFIX + path for path in paths]
-
-    try:
-      file_ents = memcache.get_multi(cache_keys)
-    except AttributeError:
-      memcache.delete_multi(cache_keys)
-      logging.exception('Possibly corrupt memcache values (%r).', cache_keys)
-      return None, False
-
-    # Cache miss: if less keys are returned than were sent.
-    if len(file_ents) != len(paths):
-      return None, False
-    # Turn memcache dictionary back into correctly-ordered list,
-    # and replace files flagged as non-existent with None.
-    file_ents = [file_ents[key] or None for key in cache_keys]
-  else:
-    cache_key = FILE_MEMCACHE_PREFIX + paths
-    try:
-      file_ents = memcache.get(cache_key)
-    except AttributeError:
-      memcache.delete(cache_key)
-      logging.exception('Possibly corrupt memcache value (%r).', cache_key)
-      return None, False
-
-    # Cache miss:
-    if file_ents is None:
-      return None, False
+  paths_list = paths if is_multiple else [paths]
+  path_keys = yield _GetCacheKeysAsync(FILE_MEMCACHE_PREFIX, paths_list)
+  cache_keys = [path_keys[path] for path in paths_list]
+  context = ndb.get_context()
+  try:
+    file_ents = yield [context.memcache_get(key) for key in cache_keys]
+  except AttributeError:
+    yield [context.memcache_delete(key) for key in cache_keys]
+    logging.exception('Possibly corrupt memcache values (%r).', cache_keys)
+    raise ndb.Return((None, False))
+
+  # Cache miss: if any key wasn't returned.
+  num_hits = len([ent for ent in file_ents if ent is not None])
+  cache_stats.Record(FILE_CACHE_STATS_NAME, hits=num_hits,
+                     misses=len(cache_keys) - num_hits)
+  if num_hits != len(cache_keys):
+    raise ndb.Return((None, False))
   # We can reliably return NoneType when a file is flagged in cache as
   # non-existent. Return a var to distinguish this from a cache miss.
-  return file_ents, True
+  if is_multiple:
+    # Replace files flagged as non-existent with None.
+    raise ndb.Return(([file_ent or None for file_ent in file_ents], True))
+  raise ndb.Return((file_ents[0], True))
 
 def StoreFiles(file_ents):
   """Store the given _File entities in memcache."""
@@ -78,13 +157,14 @@ def StoreFiles(file_ents):
   if not is_multiple and not file_ents or is_multiple and not all(file_ents):
     raise ValueError('Attempting to set invalid entities. Got: %s' % file_ents)
   if is_multiple:
+    path_keys = _GetCacheKeys(FILE_MEMCACHE_PREFIX,
+                              [file_ent.path for file_ent in file_ents])
     data = {}
     for file_ent in file_ents:
-      cache_key = FILE_MEMCACHE_PREFIX + file_ent.path
-      data[cache_key] = file_ent
+      data[path_keys[file_ent.path]] = file_ent
     return memcache.set_multi(data)
   else:
-    cache_key = FILE_MEMCACHE_PREFIX + file_ents.path
+    cache_key = _GetFileCacheKey(file_ents.path)
     return memcache.set(cache_key, file_ents)
 
 def StoreAll(data):
@@ -96,39 +176,342 @@ def StoreAll(data):
   Returns:
     The result of memcache.set_multi().
   """
+  path_keys = _GetCacheKeys(FILE_MEMCACHE_PREFIX, data)
   values = {}
   for key, value in data.iteritems():
-    cache_key = FILE_MEMCACHE_PREFIX + key
-    values[cache_key] = value if value else _NO_FILE_FLAG
+    values[path_keys[key]] = value if value else _NO_FILE_FLAG
   return memcache.set_multi(values)
 
 def SetFileDoesNotExist(paths):
   """Set a flag signifying that the given _File entities do not exist."""
   is_multiple = hasattr(paths, '__iter__')
   if is_multiple:
-    data = [(FILE_MEMCACHE_PREFIX + path, _NO_FILE_FLAG) for path in paths]
-    data = dict(data)
+    path_keys = _GetCacheKeys(FILE_MEMCACHE_PREFIX, paths)
+    data = dict([(key, _NO_FILE_FLAG) for key in path_keys.itervalues()])
     return memcache.set_multi(data)
   else:
-    cache_key = FILE_MEMCACHE_PREFIX + paths
+    cache_key = _GetFileCacheKey(paths)
     return memcache.set(cache_key, _NO_FILE_FLAG)
 
-def GetBlob(path):
-  """Get a blob's content from the sharded cache."""
-  cache_key = BLOB_MEMCACHE_PREFIX + path
-  return sharded_cache.Get(cache_key)
+def GetFileEntities(paths):
+  """Get _TitanFile entities from the memory and memcache entity caches.
+
+  Every cached entity is stamped with its path's current generation, which is
+  changed by InvalidateFileEntities() whenever the file changes, and with the
+  generations of its dirs, which are changed by InvalidateDirs(). Cached
+  entities from older generations are ignored, so invalidation costs one
+  memcache RPC no matter how many instances have cached the file.
+
+  The current file generations are always fetched first, with one memcache
+  RPC, so that entities changed by other instances are never served. Hits in
+  the memory (L1) cache therefore don't save an RPC: they save the memcache
+  get of the pickled entities, which are much larger than their generations.
+
+  Args:
+    paths: A list of absolute filenames.
+  Returns:
+    A two-tuple of (<dict of cached paths to _TitanFile entities, or None for
+    files cached as non-existent>, <dict of paths to current generations, to
+    be passed to StoreFileEntities() after fetching the uncached paths>).
+  """
+  generations = _GetFileGenerations(paths)
+  # Without a known generation, cached entities can't be verified.
+  cache_keys = _GetFileEntityKeys(generations)
+  now = time.time()
+  file_ents = {}
+  memcache_keys = {}
+  for path, cache_key in cache_keys.iteritems():
+    cached_value = _GetMemoryCachedFileEntity(path, cache_key, now)
+    if cached_value is not None:
+      file_ents[path] = _LoadFileEntity(cached_value)
+    else:
+      memcache_keys[cache_key] = path
+  cache_stats.Record(FILE_ENTITY_MEMORY_CACHE_STATS_NAME, hits=len(file_ents),
+                     misses=len(memcache_keys))
+
+  if memcache_keys:
+    values = memcache.get_multi(memcache_keys.keys())
+    num_bytes = 0
+    for key, value in values.iteritems():
+      path = memcache_keys[key]
+      _SetMemoryCachedFileEntity(path, key, now, value)
+      file_ents[path] = _LoadFileEntity(value)
+      num_bytes += len(value) if value else 0
+    cache_stats.Record(FILE_ENTITY_CACHE_STATS_NAME, hits=len(values),
+                       misses=len(memcache_keys) - len(values),
+                       num_bytes=num_bytes)
+  return file_ents, generations
+
+def StoreFileEntities(file_ents, generations):
+  """Store _TitanFile entities in the memory and memcache entity caches.
+
+  Args:
+    file_ents: A dictionary mapping absolute paths to _TitanFile entities, or
+        to None for files which don't exist.
+    generations: The generations returned by GetFileEntities() before the
+        entities were fetched. Paths without a generation are not cached.
+  """
+  cache_keys = _GetFileEntityKeys(dict(
+      [(path, generations[path]) for path in file_ents if path in generations]))
+  now = time.time()
+  data = {}
+  for path, cache_key in cache_keys.iteritems():
+    file_ent = file_ents[path]
+    if file_ent:
+      value = pickle.dumps(file_ent, pickle.HIGHEST_PROTOCOL)
+    else:
+      value = _NO_FILE_FLAG
+    _SetMemoryCachedFileEntity(path, cache_key, now, value)
+    data[cache_key] = value
+  if data:
+    memcache.set_multi(data, time=FILE_ENTITY_MEMCACHE_SECONDS)
+
+def InvalidateFileEntities(paths):
+  """Invalidate cached _TitanFile entities on every instance.
+
+  This must be called after the file entities are stored or deleted, so that
+  entities fetched concurrently are cached under the old generation.
+
+  Args:
+    paths: A list of absolute filenames.
+  """
+  if not paths:
+    return
+  with _file_entity_cache_lock:
+    for path in paths:
+      _file_entity_cache.pop(path, None)
+  generation_keys = [FILE_GENERATION_MEMCACHE_PREFIX + path for path in paths]
+  memcache.offset_multi(dict([(key, 1) for key in generation_keys]),
+                        initial_value=_NewFileGeneration())
+
+def ClearFileEntityCache():
+  """Clear this instance's memory cache of file entities."""
+  with _file_entity_cache_lock:
+    _file_entity_cache.clear()
+
+def _GetMemoryCachedFileEntity(path, cache_key, now):
+  """Returns a pickled entity from the memory cache, or None if not current.
+
+  Entries which have expired or are from older generations (with a different
+  memcache key) are dropped, and current entries are moved to the most
+  recently used end of the cache.
+  """
+  with _file_entity_cache_lock:
+    cached = _file_entity_cache.pop(path, None)
+    if not cached or cached[0] != cache_key or cached[1] <= now:
+      return None
+    _file_entity_cache[path] = cached
+  return cached[2]
+
+def _SetMemoryCachedFileEntity(path, cache_key, now, value):
+  """Stores a pickled entity in the memory cache, evicting the LRU entries."""
+  num_evictions = 0
+  with _file_entity_cache_lock:
+    _file_entity_cache.pop(path, None)
+    _file_entity_cache[path] = (
+        cache_key, now + FILE_ENTITY_CACHE_SECONDS, value)
+    while len(_file_entity_cache) > FILE_ENTITY_CACHE_MAX_SIZE:
+      _file_entity_cache.popitem(last=False)
+      num_evictions += 1
+  if num_evictions:
+    cache_stats.Record(FILE_ENTITY_MEMORY_CACHE_STATS_NAME,
+                       evictions=num_evictions)
+
+def _GetFileGenerations(paths):
+  """Returns a dict of paths to generations, initializing missing ones."""
+  generation_keys = [FILE_GENERATION_MEMCACHE_PREFIX + path for path in paths]
+  # Offsetting by zero returns the current values, and atomically sets missing
+  # (or evicted) generations to a new value which was never used before.
+  results = memcache.offset_multi(dict([(key, 0) for key in generation_keys]),
+                                  initial_value=_NewFileGeneration())
+  generations = {}
+  for path, key in zip(paths, generation_keys):
+    if results.get(key) is not None:
+      generations[path] = results[key]
+  return generations
+
+def _NewFileGeneration():
+  # Microseconds are always ahead of any generation previously incremented
+  # from an older starting time, so evicted generations are never reused.
+  return int(time.time() * 1000000)
+
+def _GetFileEntityKeys(generations):
+  """Returns a dict of paths to entity cache keys for the given generations.
+
+  Args:
+    generations: A dictionary mapping absolute filenames to file generations.
+  Returns:
+    A dictionary of the given paths to cache keys, which are also namespaced
+    by the generations of their dirs.
+  """
+  prefix_length = len(FILE_ENTITY_MEMCACHE_PREFIX)
+  cache_keys = _GetCacheKeys(FILE_ENTITY_MEMCACHE_PREFIX, generations)
+  return dict([(path, '%s%d:%s' % (FILE_ENTITY_MEMCACHE_PREFIX, generation,
+                                   cache_keys[path][prefix_length:]))
+               for path, generation in generations.iteritems()])
+
+def _GetFileEntityKey(path, generation):
+  return _GetFileEntityKeys({path: generation})[path]
+
+def _LoadFileEntity(value):
+  # Each caller gets its own copy of the entity, since File objects modify
+  # their entities in-place.
+  return pickle.loads(value) if value else None
+
+def GetBlob(path, size=None):
+  """Get a blob's content from the sharded cache.
+
+  Args:
+    path: The file path.
+    size: An optional size of the blob's content, used to fetch all content
+        shards with one RPC.
+  Returns:
+    The blob's content, or None.
+  """
+  return GetBlobs([path], sizes={path: size}).get(path)
+
+@ndb.tasklet
+def GetBlobAsync(path, size=None):
+  """Asynchronous version of GetBlob().
+
+  Returns:
+    A future whose result is the blob's content, or None.
+  """
+  contents, _ = yield GetBlobsWithStalenessAsync([path], sizes={path: size})
+  raise ndb.Return(contents.get(path))
+
+def GetBlobs(paths, sizes=None):
+  """Get the content of multiple blobs from the sharded cache.
+
+  Args:
+    paths: An iterable of file paths.
+    sizes: An optional dictionary of paths to sizes of the blobs' content.
+  Returns:
+    A dictionary of paths to content, for each blob which was cached.
+  """
+  return GetBlobsWithStaleness(paths, sizes=sizes)[0]
+
+def GetBlobsWithStaleness(paths, sizes=None):
+  """Get the content of multiple blobs, and which of them are stale.
+
+  Args:
+    paths: An iterable of file paths.
+    sizes: An optional dictionary of paths to sizes of the blobs' content.
+  Returns:
+    A tuple of (<dictionary of paths to content, for each blob which was
+    cached>, <set of the returned paths whose content is stale>). Content is
+    only ever stale if BLOB_STALE_SECONDS is set.
+  """
+  cache_keys, size_hints = _GetBlobCacheKeys(paths, sizes)
+  contents, stale_keys = sharded_cache.GetMultiWithStaleness(
+      cache_keys, sizes=size_hints)
+  return _MapBlobContents(cache_keys, contents, stale_keys)
+
+@ndb.tasklet
+def GetBlobsWithStalenessAsync(paths, sizes=None):
+  """Asynchronous version of GetBlobsWithStaleness().
+
+  Returns:
+    A future whose result is the same tuple as GetBlobsWithStaleness().
+  """
+  path_keys = yield _GetCacheKeysAsync(BLOB_MEMCACHE_PREFIX, paths)
+  cache_keys, size_hints = _MapBlobCacheKeys(path_keys, sizes)
+  contents, stale_keys = yield sharded_cache.GetMultiWithStalenessAsync(
+      cache_keys, sizes=size_hints)
+  raise ndb.Return(_MapBlobContents(cache_keys, contents, stale_keys))
+
+def _GetBlobCacheKeys(paths, sizes):
+  """Returns a dict of blob cache keys to paths, and one of keys to sizes."""
+  return _MapBlobCacheKeys(_GetCacheKeys(BLOB_MEMCACHE_PREFIX, paths), sizes)
+
+def _MapBlobCacheKeys(path_keys, sizes):
+  """Maps paths to blob cache keys, like _GetBlobCacheKeys()."""
+  size_hints = {}
+  for path, size in (sizes or {}).iteritems():
+    if path in path_keys:
+      size_hints[path_keys[path]] = size
+  cache_keys = dict([(key, path) for path, key in path_keys.iteritems()])
+  return cache_keys, size_hints
+
+def _MapBlobContents(cache_keys, contents, stale_keys):
+  """Maps blob contents and stale keys from sharded cache keys to paths."""
+  cache_stats.Record(
+      BLOB_CACHE_STATS_NAME, hits=len(contents),
+      misses=len(cache_keys) - len(contents),
+      num_bytes=sum([len(content) for content in contents.itervalues()]))
+  contents = dict([(cache_keys[cache_key], content)
+                   for cache_key, content in contents.iteritems()])
+  return contents, set([cache_keys[cache_key] for cache_key in stale_keys])
 
 def StoreBlob(path, content):
   """Set a blob's content in the sharded cache."""
-  cache_key = BLOB_MEMCACHE_PREFIX + path
-  return sharded_cache.Set(cache_key, content)
+  return sharded_cache.Set(_GetBlobCacheKey(path), content,
+                           **_GetBlobCacheTimes())
+
+@ndb.tasklet
+def StoreBlobAsync(path, content):
+  """Asynchronous version of StoreBlob(), batched with other memcache sets.
+
+  Returns:
+    A future whose result is True if the content was set, False otherwise.
+  """
+  path_keys = yield _GetCacheKeysAsync(BLOB_MEMCACHE_PREFIX, [path])
+  result = yield sharded_cache.SetAsync(path_keys[path], content,
+                                        **_GetBlobCacheTimes())
+  raise ndb.Return(result)
+
+def _GetBlobCacheTimes():
+  """Returns the expiration arguments for setting blobs in the sharded cache."""
+  if BLOB_STALE_SECONDS:
+    return {
+        'time': BLOB_FRESH_SECONDS + BLOB_STALE_SECONDS,
+        'fresh_time': BLOB_FRESH_SECONDS,
+    }
+  return {'time': BLOB_FRESH_SECONDS}
+
+def AcquireBlobLease(path):
+  """Try to become the only request filling a blob's cache entry.
+
+  Args:
+    path: The file path.
+  Returns:
+    A lease token to pass to ReleaseBlobLease(), or None if another request
+    holds the lease.
+  """
+  token = os.urandom(8).encode('hex')
+  if memcache.add(BLOB_LEASE_MEMCACHE_PREFIX + path, token,
+                  time=BLOB_LEASE_SECONDS):
+    return token
+  return None
+
+def ReleaseBlobLease(path, token):
+  """Release a blob's lease, unless it expired and was taken by another."""
+  cache_key = BLOB_LEASE_MEMCACHE_PREFIX + path
+  if memcache.get(cache_key) == token:
+    memcache.delete(cache_key)
+
+def WaitForBlob(path, size=None):
+  """Wait for the request holding a blob's lease to fill its cache entry.
+
+  Args:
+    path: The file path.
+    size: An optional size of the blob's content. See GetBlob().
+  Returns:
+    The blob's content, or None if it wasn't cached once the lease was released
+    or within BLOB_LEASE_WAIT_SECONDS.
+  """
+  cache_key = BLOB_LEASE_MEMCACHE_PREFIX + path
+  deadline = time.time() + BLOB_LEASE_WAIT_SECONDS
+  while memcache.get(cache_key) is not None and time.time() < deadline:
+    time.sleep(BLOB_LEASE_POLL_SECONDS)
+  return GetBlob(path, size=size)
 
 def ClearBlobsForFiles(file_ents):
   """Delete blobs from the sharded cache."""
   files_list = file_ents if hasattr(file_ents, '__iter__') else [file_ents]
-  for file_ent in files_list:
-    cache_key = BLOB_MEMCACHE_PREFIX + file_ent.path
-    sharded_cache.Delete(cache_key)
+  path_keys = _GetCacheKeys(BLOB_MEMCACHE_PREFIX,
+                            [file_ent.path for file_ent in files_list])
+  return sharded_cache.DeleteMulti(path_keys.values())
 
 def StoreSubdirs(data):
   """Store the full list of subdirectories for given directories.
@@ -137,23 +520,39 @@ def StoreSubdirs(data):
     data: A mapping of absolute directory paths to complete lists of subdirs.
         The subdir list should be strings of relative subdirectory names.
   Returns:
-    The result of memcache.set_multi().
+    A list of cache keys which could not be updated, like memcache.set_multi().
   """
-  dir_cache_keys = [DIR_MEMCACHE_PREFIX + dir_path for dir_path in data]
-  dir_caches = memcache.get_multi(dir_cache_keys)
-  for key, value in data.iteritems():
-    cache_key = DIR_MEMCACHE_PREFIX + key
-    if cache_key not in dir_caches:
-      dir_caches[cache_key] = {}
-    dir_caches[cache_key]['subdirs'] = set(value)
-  return memcache.set_multi(dir_caches)
+  path_keys = _GetCacheKeys(DIR_MEMCACHE_PREFIX, data, is_dir=True)
+  subdirs = dict([(path_keys[dir_path], set(value))
+                  for dir_path, value in data.iteritems()])
+
+  def UpdateDirCache(cache_key, dir_cache):
+    dir_cache = dir_cache or {}
+    dir_cache['subdirs'] = subdirs[cache_key]
+    return dir_cache
+
+  return _UpdateDirCaches(subdirs.keys(), UpdateDirCache)
 
 def GetSubdirs(dir_path):
   """Get a set of subdirs in a directory."""
-  dir_cache = memcache.get(DIR_MEMCACHE_PREFIX + dir_path)
+  return GetSubdirsAsync(dir_path).get_result()
+
+@ndb.tasklet
+def GetSubdirsAsync(dir_path):
+  """Asynchronous version of GetSubdirs().
+
+  Returns:
+    A future whose result is the set of subdirs, or None if not cached.
+  """
+  path_keys = yield _GetCacheKeysAsync(
+      DIR_MEMCACHE_PREFIX, [dir_path], is_dir=True)
+  context = ndb.get_context()
+  dir_cache = yield context.memcache_get(path_keys[dir_path])
   if dir_cache is None or 'subdirs' not in dir_cache:
-    return
-  return dir_cache['subdirs']
+    cache_stats.Record(DIR_CACHE_STATS_NAME, misses=1)
+    raise ndb.Return(None)
+  cache_stats.Record(DIR_CACHE_STATS_NAME, hits=1)
+  raise ndb.Return(dir_cache['subdirs'])
 
 def UpdateSubdirsForFiles(file_ents):
   """For file entities, update appropriate subdir cache lists."""
@@ -162,36 +561,229 @@ def UpdateSubdirsForFiles(file_ents):
   #   ['/', '/foo', '/foo/bar']. For the cache entry "dir:/", we need make sure
   #   "foo" is in its value set, and same for "bar" in the "dir:/foo" cache.
   #
-  # Get the dir caches, update their subdir lists, and multi set them back in.
+  # Get the dir caches, update their subdir lists, and compare-and-set them.
   dir_cache_changes = _GetDirCacheChangesForFiles(file_ents)
-  dir_caches = memcache.get_multi(dir_cache_changes.keys())
-  for dir_cache_key, values_to_change in dir_cache_changes.iteritems():
+
+  def UpdateDirCache(cache_key, dir_cache):
     # Because we only have a subdir delta, only update subdir lists that are
     # currently cached. Otherwise, sibling subdirs will be lost.
-    if dir_cache_key in dir_caches and 'subdirs' in dir_caches[dir_cache_key]:
-      dir_caches[dir_cache_key]['subdirs'].update(values_to_change)
-  if dir_caches:
-    return memcache.set_multi(dir_caches)
+    if dir_cache is None or 'subdirs' not in dir_cache:
+      return
+    if dir_cache['subdirs'].issuperset(dir_cache_changes[cache_key]):
+      return
+    dir_cache['subdirs'].update(dir_cache_changes[cache_key])
+    return dir_cache
+
+  return _UpdateDirCaches(dir_cache_changes.keys(), UpdateDirCache)
 
 def ClearSubdirsForFiles(file_ents):
   """Clears the affected subdir caches after file deletion."""
   dir_cache_changes = _GetDirCacheChangesForFiles(file_ents)
-  dir_caches = memcache.get_multi(dir_cache_changes.keys())
-  for dir_cache_key in dir_caches:
-    try:
-      del dir_caches[dir_cache_key]['subdirs']
-    except KeyError:
-      pass
-  return memcache.set_multi(dir_caches)
+
+  def UpdateDirCache(unused_cache_key, dir_cache):
+    if dir_cache is None or 'subdirs' not in dir_cache:
+      return
+    del dir_cache['subdirs']
+    return dir_cache
+
+  return _UpdateDirCaches(dir_cache_changes.keys(), UpdateDirCache)
+
+def _UpdateDirCaches(cache_keys, update_func):
+  """Updates dir cache entries with memcache compare-and-set.
+
+  Writers racing to update the same entries retry instead of overwriting each
+  other's changes.
+
+  Args:
+    cache_keys: A list of dir cache keys to update.
+    update_func: A function which is given a cache key and its current dir
+        cache dictionary (or None), and returns the dictionary to store, or
+        None to leave the entry unchanged. It may be called more than once for
+        a key if the entry changes concurrently.
+  Returns:
+    A list of cache keys which could not be updated. These entries are deleted
+    rather than left stale.
+  """
+  client = memcache.Client()
+  for _ in range(DIR_CACHE_CAS_RETRIES):
+    if not cache_keys:
+      return []
+    dir_caches = client.get_multi(cache_keys, for_cas=True)
+    cas_mapping = {}
+    add_mapping = {}
+    for cache_key in cache_keys:
+      dir_cache = update_func(cache_key, dir_caches.get(cache_key))
+      if dir_cache is None:
+        continue
+      if cache_key in dir_caches:
+        cas_mapping[cache_key] = dir_cache
+      else:
+        add_mapping[cache_key] = dir_cache
+    cache_keys = []
+    if cas_mapping:
+      cache_keys += client.cas_multi(cas_mapping)
+    if add_mapping:
+      cache_keys += client.add_multi(add_mapping)
+  if cache_keys:
+    # Still conflicting: invalidate only these entries, so that they are
+    # rebuilt from the datastore instead of being wrong.
+    logging.warning('Dir cache updates conflicted, deleting: %r', cache_keys)
+    memcache.delete_multi(cache_keys)
+  return cache_keys
 
 def _GetDirCacheChangesForFiles(file_ents):
   """Makes a dictionary of dir cache keys to list of changed subdirs."""
-  dir_cache_changes = collections.defaultdict(set)
+  dir_changes = collections.defaultdict(set)
   files_list = file_ents if hasattr(file_ents, '__iter__') else [file_ents]
   for file_ent in files_list:
     last_index = len(file_ent.paths) - 1
     for i, dir_path in enumerate(file_ent.paths):
       if i != last_index:
         subdir_name = os.path.split(file_ent.paths[i + 1])[1]
-        dir_cache_changes[DIR_MEMCACHE_PREFIX + dir_path].add(subdir_name)
-  return dir_cache_changes
+        dir_changes[dir_path].add(subdir_name)
+  path_keys = _GetCacheKeys(DIR_MEMCACHE_PREFIX, dir_changes, is_dir=True)
+  return dict([(path_keys[dir_path], subdirs)
+               for dir_path, subdirs in dir_changes.iteritems()])
+
+def InvalidateDirs(dir_paths):
+  """Invalidate every cached file, blob and subdir list under directories.
+
+  This costs one memcache RPC no matter how many entries are cached under the
+  directories, so it should be used after operations on whole subtrees. This
+  includes each instance's memory cache of file entities, whose entries are
+  stamped with their dir generations.
+
+  Args:
+    dir_paths: A list of absolute directory paths.
+  """
+  if not dir_paths:
+    return
+  generation_keys = [DIR_GENERATION_MEMCACHE_PREFIX + dir_path
+                     for dir_path in dir_paths]
+  results = memcache.offset_multi(dict([(key, 1) for key in generation_keys]),
+                                  initial_value=_NewFileGeneration())
+  generations = os.environ.get(_ENVIRON_DIR_GENERATIONS_NAME, {})
+  for dir_path, key in zip(dir_paths, generation_keys):
+    generations[dir_path] = results.get(key)
+  os.environ[_ENVIRON_DIR_GENERATIONS_NAME] = generations
+
+def _GetDirGenerations(dir_paths):
+  """Returns a dict of dir paths to generations, initializing missing ones."""
+  generations = _GetRequestDirGenerations()
+  uncached_paths = [dir_path for dir_path in set(dir_paths)
+                    if generations.get(dir_path) is None]
+  if uncached_paths:
+    generation_keys = [DIR_GENERATION_MEMCACHE_PREFIX + dir_path
+                       for dir_path in uncached_paths]
+    # Like _GetFileGenerations(), evicted generations are replaced with a value
+    # which was never used before.
+    results = memcache.offset_multi(
+        dict([(key, 0) for key in generation_keys]),
+        initial_value=_NewFileGeneration())
+    for dir_path, key in zip(uncached_paths, generation_keys):
+      generations[dir_path] = results.get(key)
+    os.environ[_ENVIRON_DIR_GENERATIONS_NAME] = generations
+  return dict([(dir_path, generations[dir_path]) for dir_path in dir_paths])
+
+@ndb.tasklet
+def _GetDirGenerationsAsync(dir_paths):
+  """Asynchronous version of _GetDirGenerations().
+
+  The memcache offsets are made through the ndb context, so they are batched
+  with the other memcache calls of concurrent tasklets.
+
+  Returns:
+    A future whose result is a dict of dir paths to generations.
+  """
+  generations = _GetRequestDirGenerations()
+  uncached_paths = [dir_path for dir_path in set(dir_paths)
+                    if generations.get(dir_path) is None]
+  if uncached_paths:
+    context = ndb.get_context()
+    initial_value = _NewFileGeneration()
+    results = yield [
+        context.memcache_incr(DIR_GENERATION_MEMCACHE_PREFIX + dir_path,
+                              delta=0, initial_value=initial_value)
+        for dir_path in uncached_paths]
+    # Re-read the memo, since other tasklets may have changed it meanwhile.
+    generations = _GetRequestDirGenerations()
+    for dir_path, generation in zip(uncached_paths, results):
+      if generations.get(dir_path) is None:
+        generations[dir_path] = generation
+    os.environ[_ENVIRON_DIR_GENERATIONS_NAME] = generations
+  raise ndb.Return(
+      dict([(dir_path, generations[dir_path]) for dir_path in dir_paths]))
+
+def _GetRequestDirGenerations():
+  """Returns the dict of dir generations already fetched by this request."""
+  # os.environ is replaced by the runtime environment with a request-local
+  # object, allowing non-string types to be stored globally in the environment
+  # and automatically cleaned up at the end of each request. Generations are
+  # only fetched once per request.
+  return os.environ.get(_ENVIRON_DIR_GENERATIONS_NAME, {})
+
+def _GetCacheKeys(prefix, paths, is_dir=False):
+  """Makes a dictionary of paths to cache keys in their dirs' namespaces.
+
+  Args:
+    prefix: The memcache prefix, such as FILE_MEMCACHE_PREFIX.
+    paths: An iterable of absolute file paths, or of dir paths if is_dir.
+    is_dir: Whether the paths are dirs, which are in their own namespaces.
+  Returns:
+    A dictionary of the given paths to cache keys.
+  """
+  namespace_dirs = _GetNamespaceDirs(paths, is_dir)
+  generations = _GetDirGenerations(
+      set([d for dir_paths in namespace_dirs.itervalues() for d in dir_paths]))
+  return _MakeCacheKeys(prefix, namespace_dirs, generations)
+
+@ndb.tasklet
+def _GetCacheKeysAsync(prefix, paths, is_dir=False):
+  """Asynchronous version of _GetCacheKeys().
+
+  Returns:
+    A future whose result is a dictionary of the given paths to cache keys.
+  """
+  namespace_dirs = _GetNamespaceDirs(paths, is_dir)
+  generations = yield _GetDirGenerationsAsync(
+      set([d for dir_paths in namespace_dirs.itervalues() for d in dir_paths]))
+  raise ndb.Return(_MakeCacheKeys(prefix, namespace_dirs, generations))
+
+def _GetNamespaceDirs(paths, is_dir):
+  """Returns a dict of paths to the dirs whose generations namespace them."""
+  namespace_dirs = {}
+  for path in paths:
+    namespace_dirs[path] = _GetParentDirs(path)
+    if is_dir and path != '/':
+      namespace_dirs[path].append(path)
+  return namespace_dirs
+
+def _MakeCacheKeys(prefix, namespace_dirs, generations):
+  """Returns a dict of paths to cache keys, given their dirs' generations."""
+  path_keys = {}
+  for path, dir_paths in namespace_dirs.iteritems():
+    dir_generations = [generations[dir_path] for dir_path in dir_paths]
+    if None in dir_generations:
+      # Without known generations, use a key which is never read back.
+      namespace = os.urandom(8).encode('hex')
+    else:
+      namespace = hashlib.md5(
+          ','.join([str(g) for g in dir_generations])).hexdigest()
+    path_keys[path] = '%s%s:%s' % (prefix, namespace, path)
+  return path_keys
+
+def _GetParentDirs(path):
+  """Returns the dirs containing a path, from the root down."""
+  # Example: "/foo/bar/baz.html" is in ['/', '/foo', '/foo/bar'].
+  dir_names = path.split('/')[1:-1]
+  return ['/'] + ['/' + '/'.join(dir_names[:i + 1])
+                  for i in range(len(dir_names))]
+
+def _GetFileCacheKey(path):
+  return _GetCacheKeys(FILE_MEMCACHE_PREFIX, [path])[path]
+
+def _GetBlobCacheKey(path):
+  return _GetCacheKeys(BLOB_MEMCACHE_PREFIX, [path])[path]
+
+def _GetDirCacheKey(dir_path):
+  return _GetCacheKeys(DIR_MEMCACHE_PREFIX, [dir_path], is_dir=True)[dir_path]
@@ -15,7 +15,9 @@
 
 """App Engine RPC client for Titan Files."""
 
+import base64
 import collections
+import cStringIO
 import datetime
 import json
 import urllib
@@ -30,6 +32,13 @@ FILE_API_PATH_BASE = '/_titan/file'
 FILE_READ_API = '/read'
 FILE_NEWBLOB_API = '/newblob'
 FILE_FINALIZEBLOB_API = '/finalizeblob'
+FILES_API_PATH_BASE = '/_titan/files'
+
+# The max number of paths to get in each batch request, to limit URL length.
+MAX_PATHS_PER_REQUEST = 50
+# The max bytes of content to write in each batch request, before base64
+# encoding, to stay well under the App Engine request size limit.
+MAX_CONTENT_SIZE_PER_REQUEST = 1 << 23  # 8 MiB
 
 class Error(Exception):
   pass
@@ -229,6 +238,7 @@ class RemoteFiles(collections.Mapping):
 
   def __init__(self, paths=None, files=None, **kwargs):
     self._titan_client = kwargs.pop('_titan_client')
+    self._file_kwargs = kwargs.copy()
     if paths is not None and files is not None:
       raise TypeError('Exactly one of "paths" or "files" args must be given.')
     self._titan_files = {}
@@ -238,8 +248,7 @@ class RemoteFiles(collections.Mapping):
       raise ValueError('"files" must be an iterable.')
     if paths is not None:
       for path in paths:
-        self._titan_files[path] = RemoteFile(path=path,
-                                             _titan_client=self._titan_client)
+        self._titan_files[path] = self._MakeRemoteFile(path)
     else:
       for titan_file in files:
         self._titan_files[titan_file.path] = titan_file
@@ -276,3 +285,130 @@ class RemoteFiles(collections.Mapping):
   def __repr__(self):
     return '<RemoteFiles %r>' % self.keys()
 
+  def Load(self):
+    """Load all files with batch requests, removing non-existing ones.
+
+    Returns:
+      Self-reference.
+    """
+    paths = self._titan_files.keys()
+    file_data = {}
+    for i in range(0, len(paths), MAX_PATHS_PER_REQUEST):
+      url = '%s?%s' % (FILES_API_PATH_BASE, urllib.urlencode(
+          self._GetPathParams(paths[i:i + MAX_PATHS_PER_REQUEST])))
+      response = self._titan_client.UrlFetch(url)
+      self._VerifyResponse(response)
+      file_data.update(json.loads(response.content))
+    for path in paths:
+      if path in file_data:
+        self._titan_files[path]._file_data = file_data[path]
+      else:
+        del self._titan_files[path]
+    return self
+
+  def ReadMulti(self):
+    """Read the content of all files with batch requests.
+
+    The server leaves the content of large files out of batch responses, so
+    those files are read individually.
+
+    Returns:
+      A dictionary mapping the paths of existing files to their content.
+    """
+    paths = self._titan_files.keys()
+    contents = {}
+    omitted_paths = []
+    for i in range(0, len(paths), MAX_PATHS_PER_REQUEST):
+      url = '%s%s?%s' % (FILES_API_PATH_BASE, FILE_READ_API, urllib.urlencode(
+          self._GetPathParams(paths[i:i + MAX_PATHS_PER_REQUEST])))
+      response = self._titan_client.UrlFetch(url)
+      self._VerifyResponse(response)
+      # Each file is a line of JSON, followed by "size" bytes of content.
+      fp = cStringIO.StringIO(response.content)
+      while True:
+        header = fp.readline()
+        if not header:
+          break
+        header = json.loads(header)
+        if header.get('content_omitted'):
+          omitted_paths.append(header['path'])
+        else:
+          contents[header['path']] = fp.read(header['size'])
+    for path in omitted_paths:
+      contents[path] = self._titan_files[path].content
+    return contents
+
+  def WriteMulti(self, files_data):
+    """Write or update many files with batch requests.
+
+    Each request writes at most MAX_PATHS_PER_REQUEST files and (unless one
+    file is larger) MAX_CONTENT_SIZE_PER_REQUEST bytes of content. This is
+    meant for small files; large files should be written individually with
+    RemoteFile.Write(fp=...), which uploads directly to blobstore.
+
+    Args:
+      files_data: A dictionary mapping absolute paths to dictionaries with any
+          of the keys "content" (a byte string), "mime_type" and "meta". The
+          written files are added to this mapping.
+    Raises:
+      BadRemoteFileError: If updating meta information on a non-existent file.
+      titan_rpc.RpcError: If a request fails.
+    Returns:
+      Self-reference.
+    """
+    batch = {}
+    batch_size = 0
+    for path, file_data in files_data.iteritems():
+      content_size = len(file_data.get('content') or '')
+      is_full = (len(batch) >= MAX_PATHS_PER_REQUEST
+                 or batch_size + content_size > MAX_CONTENT_SIZE_PER_REQUEST)
+      if batch and is_full:
+        self._WriteBatch(batch)
+        batch = {}
+        batch_size = 0
+      batch[path] = file_data
+      batch_size += content_size
+    if batch:
+      self._WriteBatch(batch)
+    for path in files_data:
+      self._titan_files[path] = self._MakeRemoteFile(path)
+    return self
+
+  def _WriteBatch(self, files_data):
+    """Writes files with a single POST request."""
+    request_data = {}
+    for path, file_data in files_data.iteritems():
+      request_data[path] = {}
+      content = file_data.get('content')
+      if content is not None:
+        if isinstance(content, unicode):
+          content = content.encode('utf-8')
+        request_data[path]['content'] = base64.b64encode(content)
+      for key in ('mime_type', 'meta'):
+        if file_data.get(key) is not None:
+          request_data[path][key] = file_data[key]
+    params = {'files': json.dumps(request_data)}
+    if self._file_kwargs:
+      params['file_params'] = json.dumps(self._file_kwargs)
+    response = self._titan_client.UrlFetch(
+        FILES_API_PATH_BASE, method='POST', payload=urllib.urlencode(params))
+    if response.status_code == 404:
+      raise BadRemoteFileError(
+          'One or more files do not exist: %s' % ', '.join(sorted(files_data)))
+    self._VerifyResponse(response)
+
+  def _GetPathParams(self, paths):
+    """Returns request params for batch requests of the given paths."""
+    params = [('path', path) for path in paths]
+    if self._file_kwargs:
+      params.append(('file_params', json.dumps(self._file_kwargs)))
+    return params
+
+  def _MakeRemoteFile(self, path):
+    return RemoteFile(path=path, _titan_client=self._titan_client,
+                      **self._file_kwargs)
+
+  def _VerifyResponse(self, response):
+    if not 200 <= response.status_code <= 299:
+      raise titan_rpc.RpcError(response.content)
+
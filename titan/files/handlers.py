@@ -24,6 +24,10 @@ try:
   import json
 except ImportError:
   import simplejson as json
+import base64
+import calendar
+import email.utils
+import hashlib
 import logging
 import time
 import urllib
@@ -35,6 +39,19 @@ from titan.common import hooks
 from titan.common import utils
 from titan.files import files
 
+# Cache-Control header values for file responses, keyed by path prefix. The
+# longest matching prefix is used. Apps can customize this after import:
+#   handlers.CACHE_CONTROL_BY_PATH_PREFIX['/static/'] = 'public, max-age=300'
+CACHE_CONTROL_BY_PATH_PREFIX = {}
+
+# Cache-Control header value for paths without a matching prefix. Responses
+# may be cached, but must be revalidated with a conditional request.
+DEFAULT_CACHE_CONTROL = 'no-cache'
+
+# Content of larger files, or files stored in blobstore, is left out of batch
+# responses. Those files must be read individually.
+MAX_BATCH_CONTENT_SIZE = files.MAX_CONTENT_SIZE
+
 class BaseHandler(webapp.RequestHandler):
   """Base handler for Titan API handlers."""
 
@@ -42,7 +59,35 @@ class BaseHandler(webapp.RequestHandler):
     """Data to serialize. Accepts keyword args to pass to the serializer."""
     self.response.headers['Content-Type'] = 'application/json'
     json_data = json.dumps(data, cls=utils.CustomJsonEncoder, **kwargs)
-    self.response.out.write(json_data)
+    utils.WriteResponse(self.request, self.response, json_data)
+
+  def WriteJsonListResponse(self, items, **kwargs):
+    """Write a JSON list, encoding and writing one element at a time.
+
+    Unlike WriteJsonResponse, the full list of serialized elements is never
+    held in memory, so "items" can be a generator which loads objects lazily.
+
+    Args:
+      items: An iterable of objects to serialize.
+      **kwargs: Keyword args to pass to the serializer.
+    """
+    self.response.headers['Content-Type'] = 'application/json'
+    encoder = utils.CustomJsonEncoder(**kwargs)
+    out = utils.ResponseWriter(self.request, self.response)
+    out.write('[')
+    for i, item in enumerate(items):
+      if i:
+        out.write(', ')
+      out.write(encoder.encode(item))
+    out.write(']')
+    out.close()
+
+  def GetFieldsParam(self):
+    """Get the list of properties requested by the "fields" param, or None."""
+    fields = self.request.get('fields')
+    if not fields:
+      return None
+    return [field.strip() for field in fields.split(',') if field.strip()]
 
 class ExistsHandler(BaseHandler):
   """Handler to check whether a file exists."""
@@ -74,6 +119,12 @@ class ReadHandler(blobstore_handlers.BlobstoreDownloadHandler):
     if not file_obj:
       self.error(404)
       return
+    # Files written by the new API have a content hash.
+    md5_hash = getattr(file_obj, 'md5_hash', None)
+    etag = '"%s"' % md5_hash if md5_hash else None
+    if _RespondIfNotModified(self, path, etag=etag,
+                             modified=file_obj.modified):
+      return
     self.response.headers['Content-Type'] = str(file_obj.mime_type)
     self.response.headers['Content-Disposition'] = (
         'inline; filename=%s' % file_obj.name.encode('ascii', 'replace'))
@@ -82,7 +133,7 @@ class ReadHandler(blobstore_handlers.BlobstoreDownloadHandler):
       blob_key = file_obj.blob
       self.send_blob(blob_key, content_type=str(file_obj.mime_type))
     else:
-      self.response.out.write(file_obj.content)
+      utils.WriteResponse(self.request, self.response, file_obj.content)
 
 class WriteHandler(BaseHandler):
   """Handler to write to a file."""
@@ -189,7 +240,9 @@ class ListFilesHandler(BaseHandler):
     valid_params = hooks.GetValidParams(
         hook_name='http-list-files', request_params=self.request.params)
     file_objs = files.ListFiles(path, recursive=recursive, **valid_params)
-    return self.WriteJsonResponse(file_objs)
+    # Load and serialize the listing in batches rather than all at once.
+    return self.WriteJsonListResponse(
+        files.SmartFileList(file_objs), fields=self.GetFieldsParam())
 
 class ListDirHandler(BaseHandler):
   """Handler to list directories and files in a directory."""
@@ -230,6 +283,12 @@ class FileHandler(BaseHandler):
     if not titan_file.exists:
       self.error(404)
       return
+    # The metadata changes with the content hash or the modified time.
+    etag = '"%s"' % hashlib.md5('%s:%s:%s' % (
+        titan_file.md5_hash, titan_file.modified.isoformat(), full)).hexdigest()
+    if _RespondIfNotModified(self, path, etag=etag,
+                             modified=titan_file.modified):
+      return
     # TODO(user): when full=True, this may fail for files with byte-string
     # content.
     self.WriteJsonResponse(titan_file, full=full)
@@ -284,6 +343,118 @@ class FileHandler(BaseHandler):
     except files.BadFileError:
       self.error(404)
 
+class FilesHandler(BaseHandler):
+  """Batch handler for getting or writing many files in one request."""
+
+  def get(self):
+    """GET handler.
+
+    Responds with a JSON object mapping paths to serialized files, for each
+    given "path" param which exists. All files are loaded with one batch RPC.
+    An optional comma-separated "fields" param limits the serialized properties.
+    Content is left out for files which are not small enough to batch.
+    """
+    paths = self.request.get_all('path')
+    full = bool(self.request.get('full'))
+    fields = self.GetFieldsParam()
+    try:
+      file_kwargs, _ = _GetExtraParams(self.request.GET)
+      titan_files = _GetFiles(paths, file_kwargs)
+    except ValueError:
+      self.error(400)
+      return
+    file_data = {}
+    for path, titan_file in titan_files.iteritems():
+      wants_content = full if fields is None else 'content' in fields
+      if wants_content and not _IsBatchReadable(titan_file):
+        # Only the metadata is returned; the content must be read individually.
+        file_data[path] = titan_file.Serialize(
+            fields=fields and [field for field in fields if field != 'content'])
+      else:
+        file_data[path] = titan_file.Serialize(full=full, fields=fields)
+    # TODO(user): when full=True, this may fail for files with byte-string
+    # content.
+    self.WriteJsonResponse(file_data)
+
+  def post(self):
+    """POST handler.
+
+    The "files" param is a JSON object mapping paths to objects with any of
+    these keys: "content" (base64-encoded), "mime_type", and "meta". All files
+    are written with Files.WriteMulti(), which uses batch RPCs.
+    """
+    try:
+      file_kwargs, _ = _GetExtraParams(self.request.POST)
+      files_data = json.loads(self.request.get('files'))
+      if not isinstance(files_data, dict):
+        raise ValueError('"files" must be a JSON object.')
+      write_data = {}
+      for path, file_data in files_data.iteritems():
+        if not isinstance(file_data, dict):
+          raise ValueError('File data must be a JSON object: %s' % path)
+        write_kwargs = {}
+        if file_data.get('content') is not None:
+          write_kwargs['content'] = base64.b64decode(file_data['content'])
+        if file_data.get('mime_type') is not None:
+          write_kwargs['mime_type'] = file_data['mime_type']
+        if file_data.get('meta') is not None:
+          write_kwargs['meta'] = file_data['meta']
+        write_data[path] = write_kwargs
+      files.Files.WriteMulti(write_data, **file_kwargs)
+      self.response.set_status(201)
+    except files.BadFileError:
+      self.error(404)
+    except (TypeError, ValueError, files.InvalidMetaError):
+      self.error(400)
+      logging.exception('Bad request:')
+
+class FilesReadHandler(BaseHandler):
+  """Handler to return the contents of many files in one framed response.
+
+  For each given "path" param which exists, in order, the response contains a
+  line of JSON ({"path": ..., "mime_type": ..., "size": ...}) followed by
+  exactly "size" bytes of content. This is meant for reading many small files:
+  files stored in blobstore or larger than MAX_BATCH_CONTENT_SIZE are listed
+  with "content_omitted": true and no content, and must be read individually.
+  """
+
+  def get(self):
+    """GET handler."""
+    paths = self.request.get_all('path')
+    try:
+      file_kwargs, _ = _GetExtraParams(self.request.GET)
+      titan_files = _GetFiles(paths, file_kwargs)
+    except ValueError:
+      self.error(400)
+      return
+    self.response.headers['Content-Type'] = 'application/octet-stream'
+    readable_files = files.Files(files=[
+        f for f in titan_files.itervalues() if _IsBatchReadable(f)])
+    contents = readable_files.ReadContents()
+    for path in paths:
+      if path not in titan_files:
+        continue
+      titan_file = titan_files[path]
+      if path not in contents:
+        header = json.dumps({
+            'path': path,
+            'mime_type': titan_file.mime_type,
+            'size': titan_file.size,
+            'content_omitted': True,
+        })
+        self.response.out.write('%s\n' % header)
+        continue
+      content = contents[path]
+      if isinstance(content, unicode):
+        content = content.encode('utf-8')
+      header = json.dumps({
+          'path': path,
+          'mime_type': titan_file.mime_type,
+          'size': len(content),
+      })
+      self.response.out.write('%s\n' % header)
+      self.response.out.write(content)
+
 class FileReadHandler(blobstore_handlers.BlobstoreDownloadHandler):
   """Handler to return contents of a file."""
 
@@ -299,15 +470,176 @@ class FileReadHandler(blobstore_handlers.BlobstoreDownloadHandler):
     if not titan_file.exists:
       self.error(404)
       return
+    md5_hash = titan_file.md5_hash
+    etag = '"%s"' % md5_hash if md5_hash else None
+    if _RespondIfNotModified(self, path, etag=etag,
+                             modified=titan_file.modified):
+      return
     self.response.headers['Content-Type'] = str(titan_file.mime_type)
     self.response.headers['Content-Disposition'] = (
         'inline; filename=%s' % titan_file.name.encode('ascii', 'replace'))
+    self.response.headers['Accept-Ranges'] = 'bytes'
 
     if titan_file.blob:
+      # Blobstore serves Range requests itself.
       blob_key = titan_file.blob
-      self.send_blob(blob_key, content_type=str(titan_file.mime_type))
+      self.send_blob(blob_key, content_type=str(titan_file.mime_type),
+                     use_range=True)
+      return
+
+    range_header = self.request.headers.get('Range')
+    byte_range = None
+    if range_header:
+      try:
+        byte_range = _ParseRangeHeader(range_header, titan_file.size)
+      except ValueError:
+        self.response.headers['Content-Range'] = 'bytes */%d' % (
+            titan_file.size)
+        self.error(416)
+        return
+    if not byte_range:
+      _WriteFileContent(self, titan_file)
+      return
+    start, end = byte_range
+    self.response.set_status(206)
+    self.response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+        start, end, titan_file.size)
+    self.response.out.write(titan_file.Read(offset=start, size=end - start + 1))
+
+def _WriteFileContent(handler, titan_file):
+  """Writes a file's inline content, compressing it if the client accepts it.
+
+  Content which is stored compressed is served as-is (or rewrapped as gzip)
+  rather than being decompressed and recompressed.
+
+  Args:
+    handler: The webapp.RequestHandler handling the GET request.
+    titan_file: The File to write. Its content must not be stored in blobstore.
+  """
+  compressed_content = titan_file.compressed_content
+  if compressed_content is not None:
+    # Stored content is in the zlib format, which is the "deflate" coding.
+    handler.response.headers['Vary'] = 'Accept-Encoding'
+    encoding = utils.GetAcceptedEncoding(
+        handler.request.headers.get('Accept-Encoding'),
+        encodings=('deflate', 'gzip'))
+    if encoding == 'gzip':
+      compressed_content = utils.ZlibToGzip(compressed_content)
+    if encoding:
+      utils.SetContentEncoding(handler.response, encoding)
+      handler.response.out.write(compressed_content)
+      return
+  utils.WriteResponse(handler.request, handler.response, titan_file.content)
+
+def _RespondIfNotModified(handler, path, etag=None, modified=None):
+  """Sets caching headers, and responds with a 304 if the client is current.
+
+  This must be called before reading any content, so that unchanged files
+  cost no more than loading their metadata.
+
+  Args:
+    handler: The webapp.RequestHandler handling the GET request.
+    path: The requested path, used to choose the Cache-Control header.
+    etag: A quoted, strong ETag of the response, or None.
+    modified: A datetime of when the response last changed, or None.
+  Returns:
+    True if a 304 Not Modified response was set and the handler should return.
+  """
+  headers = handler.response.headers
+  headers['Cache-Control'] = _GetCacheControl(path)
+  if etag:
+    # Headers must be byte-strings, not unicode strings.
+    headers['ETag'] = str(etag)
+  last_modified = None
+  if modified:
+    last_modified = calendar.timegm(modified.utctimetuple())
+    headers['Last-Modified'] = email.utils.formatdate(last_modified,
+                                                      usegmt=True)
+
+  not_modified = False
+  if_none_match = handler.request.headers.get('If-None-Match')
+  if_modified_since = handler.request.headers.get('If-Modified-Since')
+  if if_none_match:
+    # If-None-Match takes precedence over If-Modified-Since, and uses the weak
+    # comparison function for GET requests.
+    client_etags = [tag.strip() for tag in if_none_match.split(',')]
+    client_etags = [tag[2:] if tag.startswith('W/') else tag
+                    for tag in client_etags]
+    not_modified = bool(etag) and ('*' in client_etags or etag in client_etags)
+  elif if_modified_since and last_modified is not None:
+    if_modified_since = email.utils.parsedate_tz(if_modified_since)
+    not_modified = bool(if_modified_since) and (
+        last_modified <= email.utils.mktime_tz(if_modified_since))
+
+  if not_modified:
+    handler.response.set_status(304)
+  return not_modified
+
+def _GetCacheControl(path):
+  """Returns the Cache-Control header value for the longest matching prefix."""
+  matching_prefixes = [prefix for prefix in CACHE_CONTROL_BY_PATH_PREFIX
+                       if path.startswith(prefix)]
+  if not matching_prefixes:
+    return DEFAULT_CACHE_CONTROL
+  return CACHE_CONTROL_BY_PATH_PREFIX[max(matching_prefixes, key=len)]
+
+def _ParseRangeHeader(range_header, size):
+  """Parses an HTTP Range header containing a single byte range.
+
+  Args:
+    range_header: The Range header value, such as "bytes=0-499".
+    size: The size of the content in bytes.
+  Raises:
+    ValueError: If the range cannot be satisfied.
+  Returns:
+    A two-tuple of inclusive (start, end) byte offsets, or None if the header
+    should be ignored, such as if it is malformed or has multiple ranges.
+  """
+  units, _, byte_range = range_header.partition('=')
+  if units.strip() != 'bytes' or ',' in byte_range:
+    return None
+  start, separator, end = byte_range.strip().partition('-')
+  if not separator:
+    return None
+  try:
+    if start:
+      start = int(start)
+      end = int(end) if end else size - 1
+      if end < start:
+        return None
     else:
-      self.response.out.write(titan_file.content)
+      # Suffix range of the last N bytes, such as "bytes=-500".
+      suffix_length = int(end)
+      if suffix_length < 0:
+        return None
+      start, end = max(size - suffix_length, 0), size - 1
+  except ValueError:
+    return None
+  if start >= size:
+    raise ValueError('Unsatisfiable range: %s' % range_header)
+  return start, min(end, size - 1)
+
+def _GetFiles(paths, file_kwargs):
+  """Returns a loaded Files mapping containing the given files which exist.
+
+  Args:
+    paths: A list of absolute filenames.
+    file_kwargs: Extra keyword arguments for instantiating each File.
+  Raises:
+    ValueError: If given invalid paths.
+  Returns:
+    A Files mapping, with all files loaded in one batch RPC.
+  """
+  titan_files = [files.File(path, **file_kwargs) for path in paths]
+  return files.Files(files=titan_files).Load()
+
+def _IsBatchReadable(titan_file):
+  """Whether a file's content is small enough for batch responses."""
+  if titan_file.size > MAX_BATCH_CONTENT_SIZE:
+    return False
+  # Content this small is only in blobstore if a BlobKey was written directly,
+  # so the "blob" property rarely needs an RPC here.
+  return not titan_file.blob
 
 def _GetExtraParams(request_params):
   """Returns a two-tuple of (file_kwargs, method_kwargs)."""
@@ -330,6 +662,8 @@ URL_MAP = (
     ('/_titan/file/read', FileReadHandler),
     ('/_titan/file/newblob', NewBlobHandler),
     ('/_titan/file/finalizeblob', FinalizeBlobHandler),
+    ('/_titan/files', FilesHandler),
+    ('/_titan/files/read', FilesReadHandler),
 
     # Deprecated API:
     ('/_titan/exists', ExistsHandler),
@@ -126,8 +126,8 @@ class FileVersioningMixin(files.File):
     return self.real_path
 
   @utils.ComposeMethodKwargs
-  def Write(self, **kwargs):
-    """Write method. See superclass docstring."""
+  def WriteAsync(self, **kwargs):
+    """WriteAsync method. See superclass docstring."""
     if not self.changeset:
       raise InvalidChangesetError(
           'File modification requires an associated changeset.')
@@ -154,10 +154,10 @@ class FileVersioningMixin(files.File):
       kwargs['meta']['status'] = FILE_EDITED
       kwargs['_delete_old_blob'] = False
 
-    return super(FileVersioningMixin, self).Write(**kwargs)
+    return super(FileVersioningMixin, self).WriteAsync(**kwargs)
 
   @utils.ComposeMethodKwargs
-  def Delete(self, **kwargs):
+  def DeleteAsync(self, **kwargs):
     if not self.changeset:
       raise InvalidChangesetError(
           'File modification requires an associated changeset.')
@@ -166,7 +166,7 @@ class FileVersioningMixin(files.File):
     # The file should be removed entirely from the staging changeset.
     _VerifyIsNewChangeset(self.changeset)
     self.changeset.DisassociateFile(self)
-    return super(FileVersioningMixin, self).Delete(**kwargs)
+    return super(FileVersioningMixin, self).DeleteAsync(**kwargs)
 
 # ------------------------------------------------------------------------------
 
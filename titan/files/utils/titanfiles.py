@@ -227,19 +227,30 @@ class UploadCommand(BaseCommandWithVersions):
     start = time.time()
     self.remote_file_factory.ValidateClientAuth()
     future_results = []
+    small_filenames_to_paths = []
     with self.ThreadPoolExecutor() as executor:
       for filename, target_path in filename_to_paths.iteritems():
+        if os.path.getsize(filename) > DIRECT_TO_BLOBSTORE_SIZE:
+          future = executor.submit(
+              self._UploadFile, filename, target_path, file_kwargs=file_kwargs)
+          future_results.append(future)
+        else:
+          small_filenames_to_paths.append((filename, target_path))
+      # Small files are uploaded together, with batch requests.
+      batch_size = files_client.MAX_PATHS_PER_REQUEST
+      for i in range(0, len(small_filenames_to_paths), batch_size):
         future = executor.submit(
-            self._UploadFile, filename, target_path, file_kwargs=file_kwargs)
+            self._UploadFiles, dict(small_filenames_to_paths[i:i + batch_size]),
+            file_kwargs=file_kwargs)
         future_results.append(future)
 
     failed = False
     total_bytes = 0
     for future in futures.as_completed(future_results):
       try:
-        remote_file = future.result()
-        print 'Uploaded %s' % remote_file.real_path
-        total_bytes += remote_file.size
+        for remote_file in future.result():
+          print 'Uploaded %s' % remote_file.real_path
+          total_bytes += remote_file.size
       except UploadFileError as e:
         self.PrintError('Error uploading %s. Error was: %s %s'
                         % (e.target_path, e.__class__.__name__, str(e)))
@@ -264,7 +275,7 @@ class UploadCommand(BaseCommandWithVersions):
 
   def _UploadFile(self, filename, target_path,
                   file_kwargs=None, method_kwargs=None):
-    """Uploads a document."""
+    """Uploads a document, returning a list of the uploaded RemoteFile."""
     try:
       file_kwargs = file_kwargs or {}
       remote_file = self.remote_file_factory.MakeRemoteFile(target_path,
@@ -277,11 +288,38 @@ class UploadCommand(BaseCommandWithVersions):
           remote_file.Write(content=fp.read(), **method_kwargs)
       # Load the RemoteFile to avoid synchronous fetches in the main thread.
       _ = remote_file.real_path
-      return remote_file
+      return [remote_file]
     except Exception as e:
       logging.exception('Traceback:')
       raise UploadFileError(e, target_path=target_path)
 
+  def _UploadFiles(self, filename_to_paths, file_kwargs=None):
+    """Uploads small documents with batch requests.
+
+    Args:
+      filename_to_paths: A dictionary mapping local filenames to remote paths.
+      file_kwargs: Extra keyword arguments for the remote files.
+    Raises:
+      UploadFileError: If any of the documents could not be uploaded.
+    Returns:
+      A list of the uploaded RemoteFiles.
+    """
+    try:
+      files_data = {}
+      for filename, target_path in filename_to_paths.iteritems():
+        with open(filename) as fp:
+          files_data[target_path] = {'content': fp.read()}
+      remote_files = self.remote_file_factory.MakeRemoteFiles(
+          paths=[], **(file_kwargs or {}))
+      remote_files.WriteMulti(files_data)
+      # Load the RemoteFiles to avoid synchronous fetches in the main thread.
+      remote_files.Load()
+      return remote_files.values()
+    except Exception as e:
+      logging.exception('Traceback:')
+      raise UploadFileError(
+          e, target_path=', '.join(sorted(filename_to_paths.values())))
+
 class CommitCommand(BaseCommandWithVersions):
   """Commit a versions Changeset.
 
@@ -33,6 +33,7 @@ if not 'DJANGO_SETTINGS_MODULE' in os.environ:
 from django import template
 
 import webapp2
+from titan.common import utils
 from titan.stats import stats
 
 TEMPLATES_PATH = os.path.join(os.path.dirname(__file__), 'templates')
@@ -58,7 +59,7 @@ class CounterDataHandler(webapp2.RequestHandler):
         start_date=params['start_date'],
         end_date=params['end_date'])
     self.response.headers['Content-Type'] = 'application/json'
-    self.response.out.write(aggregate_data)
+    utils.WriteResponse(self.request, self.response, aggregate_data)
 
 class GraphHandler(webapp2.RequestHandler):
   """Handler for graphing counter data."""
@@ -87,7 +88,8 @@ class GraphHandler(webapp2.RequestHandler):
         'aggregate_data': aggregate_data,
     }
     context = template.Context(data)
-    self.response.out.write(tpl.render(context))
+    self.response.headers['Content-Type'] = 'text/html; charset=utf-8'
+    utils.WriteResponse(self.request, self.response, tpl.render(context))
 
 def _ParseRequestParams(request):
   counter_names = request.get_all('counter_name')
@@ -29,11 +29,15 @@ Usage:
   # Store the counters in the local request environment.
   stats.StoreRequestLocalCounters([latency_counter, page_view_counter])
 
+  # Store counters for the request's cache hits, misses, evictions and bytes.
+  stats.StoreRequestLocalCacheCounters()
+
   # Save the counter (this should happen at the absolute end of a request).
   stats.SaveRequestLocalCounters()
 
   # In a cron job run every minute:
   all_counters = [stats.Counter('page/view')]
+  all_counters += stats.MakeCacheCounters(files_cache.CACHE_STATS_NAMES)
   aggregator = stats.Aggregator(all_counters)
   aggregator.ProcessWindowsWithBackoff(total_runtime_minutes=1)
 
@@ -62,6 +66,7 @@ import logging
 import os
 import time
 from google.appengine.api import taskqueue
+from titan.common import cache_stats
 from titan.files import files
 
 # The bucket size for an aggregation window, in number of seconds.
@@ -203,6 +208,43 @@ def GetRequestLocalCounters():
   """Get all environment counters."""
   return os.environ.get('counters', [])
 
+def MakeCacheCounters(cache_names):
+  """Make counters for each of the cache_stats of the given caches.
+
+  Args:
+    cache_names: An iterable of cache names, such as
+        files_cache.CACHE_STATS_NAMES.
+  Returns:
+    A list of Counter objects named "cache/<cache name>/<stat name>".
+  """
+  counters = []
+  for cache_name in cache_names:
+    for stat_name in cache_stats.STAT_NAMES:
+      counters.append(Counter(_MakeCacheCounterName(cache_name, stat_name)))
+  return counters
+
+def StoreRequestLocalCacheCounters():
+  """Store counters for the cache stats recorded during the current request.
+
+  Stats are reset after being stored, so calling this more than once in a
+  request does not count the same stats twice.
+
+  Returns:
+    The list of stored counters; stats with a value of zero are omitted.
+  """
+  counters = []
+  request_stats = cache_stats.GetRequestLocalStats()
+  for cache_name, values in sorted(request_stats.iteritems()):
+    for stat_name in cache_stats.STAT_NAMES:
+      if not values[stat_name]:
+        continue
+      counter = Counter(_MakeCacheCounterName(cache_name, stat_name))
+      counter.Offset(values[stat_name])
+      counters.append(counter)
+  cache_stats.ClearRequestLocalStats()
+  StoreRequestLocalCounters(counters)
+  return counters
+
 def SaveRequestLocalCounters():
   """Save all environment counters for future aggregation."""
   return SaveCounters(GetRequestLocalCounters())
@@ -469,6 +511,9 @@ def _GetWindow(timestamp=None, window_size=DEFAULT_WINDOW_SIZE):
   """Get the aggregation window for the given unix time and window size."""
   return int(window_size * round(float(timestamp) / window_size))
 
+def _MakeCacheCounterName(cache_name, stat_name):
+  return 'cache/%s/%s' % (cache_name, stat_name)
+
 def _MakeLogPath(date, counter_name):
   # Make a path like: /_titan/stats/counters/2015/05/15/page/view/data-10s.json
   path = os.path.join(